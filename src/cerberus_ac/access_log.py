@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+
+"""Access log module providing sinks to record access attempts."""
+
+import atexit
+import logging
+import random
+import threading
+from collections import deque
+
+from django.core.signals import request_finished
+from django.db import close_old_connections
+
+from .apps import AppSettings, _import
+from .metrics import record_flush
+
+app_settings = AppSettings()
+
+logger = logging.getLogger(__name__)
+
+_sinks = {}
+_sinks_lock = threading.Lock()
+
+
+def write_attempts(attempts):
+    """
+    Write access attempts in the database.
+
+    When the ACCESS_LOG_ROLLUP setting is True, attempts are counted in
+    AccessRollup rows, and only denials and a sample of the other attempts
+    (see ACCESS_LOG_SAMPLE_RATE) are stored as AccessHistory rows.
+
+    Args:
+        attempts (list): AccessHistory instances.
+    """
+    if app_settings.metrics:
+        record_flush(attempts)
+
+    if app_settings.access_log_rollup:
+        from .models import AccessRollup
+        AccessRollup.record(attempts)
+        sample_rate = app_settings.access_log_sample_rate
+        attempts = [a for a in attempts
+                    if not a.response or random.random() < sample_rate]
+
+    if len(attempts) == 1:
+        attempts[0].save()
+    elif attempts:
+        attempts[0].__class__.objects.bulk_create(
+            attempts, batch_size=app_settings.access_log_batch_size)
+
+
+class SyncAccessLogSink(object):
+    """Sink writing access attempts as soon as they are recorded."""
+
+    def record(self, attempts):
+        """
+        Record access attempts.
+
+        Args:
+            attempts (list): AccessHistory instances.
+        """
+        write_attempts(attempts)
+
+    def flush(self):
+        """Write pending access attempts (nothing to do here)."""
+
+    def stats(self):
+        """Return the counters of this sink."""
+        return {}
+
+
+class BufferedAccessLogSink(object):
+    """
+    Sink buffering access attempts and writing them in batches.
+
+    Attempts are written with one bulk insert when the buffer reaches
+    ``batch_size`` attempts, or every ``flush_interval`` seconds from a
+    background thread, at the end of each request, and at interpreter exit.
+
+    When the buffer holds ``max_size`` attempts, the ``overflow`` policy
+    applies: ``block`` makes the recording thread write the buffer itself,
+    ``drop_oldest`` discards the oldest attempts, and ``sync`` writes the new
+    attempts directly, bypassing the buffer.
+    """
+
+    BLOCK = 'block'
+    DROP_OLDEST = 'drop_oldest'
+    SYNC = 'sync'
+
+    OVERFLOW_POLICIES = (BLOCK, DROP_OLDEST, SYNC)
+
+    def __init__(self,
+                 batch_size=None,
+                 flush_interval=None,
+                 max_size=None,
+                 overflow=None):
+        """
+        Initialization method.
+
+        Args:
+            batch_size (int): number of attempts triggering a write.
+            flush_interval (float): number of seconds between two writes
+                from the background thread, 0 to disable the thread.
+            max_size (int): maximum number of buffered attempts.
+            overflow (str): policy applied when the buffer is full.
+        """
+        if batch_size is None:
+            batch_size = app_settings.access_log_batch_size
+        if flush_interval is None:
+            flush_interval = app_settings.access_log_flush_interval
+        if max_size is None:
+            max_size = app_settings.access_log_max_buffer
+        if overflow is None:
+            overflow = app_settings.access_log_overflow
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError('overflow must be one of %s' % ', '.join(
+                self.OVERFLOW_POLICIES))
+
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.overflow = overflow
+
+        self.buffer = deque()
+        self.condition = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.thread = None
+
+        self.recorded = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+
+        request_finished.connect(self._request_finished, weak=False)
+        atexit.register(self.flush)
+
+    def record(self, attempts):
+        """
+        Buffer access attempts.
+
+        Args:
+            attempts (list): AccessHistory instances.
+        """
+        with self.condition:
+            self.recorded += len(attempts)
+        self._buffer(attempts)
+        if self.flush_interval and self.thread is None:
+            self._start()
+
+    def flush(self):
+        """Write every buffered access attempt."""
+        with self.flush_lock:
+            with self.condition:
+                attempts = list(self.buffer)
+                self.buffer.clear()
+            self._write(attempts)
+
+    def stats(self):
+        """Return the counters of this sink."""
+        with self.condition:
+            return {
+                'buffered': len(self.buffer),
+                'recorded': self.recorded,
+                'written': self.written,
+                'dropped': self.dropped,
+                'failed': self.failed,
+            }
+
+    def _buffer(self, attempts):
+        overflowing = []
+        with self.condition:
+            for attempt in attempts:
+                if len(self.buffer) >= self.max_size:
+                    if self.overflow == self.DROP_OLDEST:
+                        self.buffer.popleft()
+                        self.dropped += 1
+                    else:
+                        overflowing.append(attempt)
+                        continue
+                self.buffer.append(attempt)
+            full = len(self.buffer) >= self.batch_size
+            if full and self.flush_interval:
+                self.condition.notify()
+
+        if overflowing:
+            if self.overflow == self.SYNC:
+                self._write(overflowing)
+            else:
+                self.flush()
+                self._buffer(overflowing)
+        elif full and not self.flush_interval:
+            self.flush()
+
+    def _write(self, attempts):
+        if not attempts:
+            return
+        try:
+            write_attempts(attempts)
+        except Exception:  # noqa
+            logger.exception('Could not write %d access attempts',
+                             len(attempts))
+            with self.condition:
+                self.failed += len(attempts)
+        else:
+            with self.condition:
+                self.written += len(attempts)
+
+    def _start(self):
+        with self.condition:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(
+                target=self._run, name='cerberus-access-log')
+            self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.condition.wait(self.flush_interval)
+            self.flush()
+            close_old_connections()
+
+    def _request_finished(self, **kwargs):
+        self.flush()
+
+
+def get_access_log_sink():
+    """Return the access log sink set in the ACCESS_LOG_SINK setting."""
+    path = app_settings.access_log_sink
+    with _sinks_lock:
+        if path not in _sinks:
+            _sinks[path] = _import(path)()
+        return _sinks[path]
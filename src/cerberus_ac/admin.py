@@ -3,16 +3,24 @@
 """Admin module."""
 
 from django.contrib import admin
-from django.core.urlresolvers import reverse
+from django.contrib.admin.utils import quote
+from django.contrib.admin.views.main import ChangeList
+from django.core.urlresolvers import get_script_prefix, get_urlconf, reverse
 from django.utils.html import format_html
 from django.utils.translation import ugettext_lazy as _
 
 from .apps import AppSettings
 from .models import (
-    AccessHistory, PrivilegeHistory, Role, RoleHierarchy, RolePrivilege)
+    AccessHistory, AccessRollup, PrivilegeHistory, Role, RoleHierarchy,
+    RolePrivilege, RolePrivilegeRange)
+from .utils import EstimatedCountPaginator
 
 app_settings = AppSettings()
 
+PK_PLACEHOLDER = '__cerberus_ac_pk__'
+
+_change_urls = {}
+
 
 # class SecurityAdmin(AdminSite):
 #     pass
@@ -33,19 +41,44 @@ app_settings = AppSettings()
 # Use decorator like @security_admin_site.register(AccessHistory)
 
 
+def change_url(instance):
+    """
+    Return the admin change URL of an instance.
+
+    The URL is reversed once per model (and URLconf), then the primary key
+    of each instance is substituted in it.
+
+    Args:
+        instance (Model): a model instance.
+
+    Returns:
+        str: the URL of the instance change page.
+    """
+    key = (instance._meta.app_label, instance._meta.model_name,
+           get_script_prefix(), get_urlconf())
+    url = _change_urls.get(key)
+    if url is None:
+        url = reverse('admin:%s_%s_change' % key[:2],
+                      args=(PK_PLACEHOLDER,))
+        _change_urls[key] = url
+    return url.replace(PK_PLACEHOLDER, str(quote(instance.pk)))
+
+
 def obj_link_generator(type_attr, id_attr, short_description):
     def obj_link(obj):
         obj_type = getattr(obj, type_attr)
         obj_id = getattr(obj, id_attr)
-        instance = app_settings.mapping.get_instance(
-            obj_type, obj_id)
+        linked = getattr(obj, '_linked_instances', {})
+        if (obj_type, obj_id) in linked:
+            instance = linked[(obj_type, obj_id)]
+        else:
+            instance = app_settings.mapping.get_instance(obj_type, obj_id)
         if instance is None:
             return '-'
-        info = (instance._meta.app_label, instance._meta.model_name)
-        admin_url = reverse('admin:%s_%s_change' % info,
-                            args=(instance.pk,))
-        return format_html('<a href="{}">{}</a>', admin_url, instance)
+        return format_html(
+            '<a href="{}">{}</a>', change_url(instance), instance)
     obj_link.short_description = short_description
+    obj_link.link_attrs = (type_attr, id_attr)
     return obj_link
 
 
@@ -59,15 +92,59 @@ hierarchy_role_link_b = obj_link_generator(
     'role_type_b', 'role_id_b', _('Role link B'))
 
 
+def prefetch_linked_instances(objects, link_attrs):
+    """
+    Fetch the instances linked by a list of objects, in grouped queries.
+
+    The instances are stored in the ``_linked_instances`` attribute of each
+    object, where the links generated by ``obj_link_generator`` find them.
+
+    Args:
+        objects (iterable): the objects (rows of a changelist page).
+        link_attrs (list): (type_attr, id_attr) tuples.
+    """
+    objects = list(objects)
+    pairs = {(getattr(obj, type_attr), getattr(obj, id_attr))
+             for obj in objects for type_attr, id_attr in link_attrs}
+    pairs = list(pairs)
+    instances = dict(zip(
+        pairs, app_settings.mapping.get_instances(pairs)))
+    for obj in objects:
+        obj._linked_instances = instances
+
+
+class LinkPrefetchChangeList(ChangeList):
+    """Change list fetching the instances linked by its rows at once."""
+
+    def get_results(self, request):
+        """Fetch the page rows, then the instances they link to."""
+        super(LinkPrefetchChangeList, self).get_results(request)
+        link_attrs = [field.link_attrs for field in self.list_display
+                      if hasattr(field, 'link_attrs')]
+        if link_attrs:
+            prefetch_linked_instances(self.result_list, link_attrs)
+
+
+class LinkPrefetchMixin(object):
+    """Admin mixin using LinkPrefetchChangeList."""
+
+    def get_changelist(self, request, **kwargs):
+        """Return the change list class prefetching linked instances."""
+        return LinkPrefetchChangeList
+
+
 class RoleAdmin(admin.ModelAdmin):
     """Role admin class."""
 
     list_display = ('type', 'rid')
 
 
-class RolePrivilegeAdmin(admin.ModelAdmin):
+class RolePrivilegeAdmin(LinkPrefetchMixin, admin.ModelAdmin):
     """Role privilege admin class."""
 
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
     actions_on_top = True
     actions_on_bottom = True
 
@@ -97,7 +174,55 @@ class RolePrivilegeAdmin(admin.ModelAdmin):
         record.update_from_privilege(obj)
 
 
-class RoleHierarchyAdmin(admin.ModelAdmin):
+class RolePrivilegeRangeAdmin(LinkPrefetchMixin, admin.ModelAdmin):
+    """Role privilege range admin class."""
+
+    list_display = (
+        '__str__',
+        'role_type',
+        'role_id',
+        role_link,
+        'authorized',
+        'access_type',
+        'resource_type',
+        'start',
+        'end',
+        'creation_date',
+        'modification_date')
+
+    list_filter = (
+        'role_type', 'resource_type', 'authorized', 'access_type',
+        'modification_date')
+
+    def save_model(self, request, obj, form, change):
+        """Save the range and record the change in the privileges history."""
+        super().save_model(request, obj, form, change)
+        record = PrivilegeHistory(
+            user=request.user, action={False: PrivilegeHistory.CREATE}.get(
+                change, PrivilegeHistory.UPDATE))
+        record.update_from_range(obj)
+
+    def delete_model(self, request, obj):
+        """Record the deletion in the privileges history, then delete."""
+        record = PrivilegeHistory(
+            user=request.user, action=PrivilegeHistory.DELETE)
+        record.update_from_range(obj)
+        super().delete_model(request, obj)
+
+    def delete_queryset(self, request, queryset):
+        """Record the deletions in the privileges history, then delete."""
+        # used by the delete action since Django 2.1
+        records = []
+        for obj in queryset:
+            record = PrivilegeHistory(
+                user=request.user, action=PrivilegeHistory.DELETE)
+            record.update_from_range(obj, save=False)
+            records.append(record)
+        PrivilegeHistory.objects.bulk_create(records)
+        super().delete_queryset(request, queryset)
+
+
+class RoleHierarchyAdmin(LinkPrefetchMixin, admin.ModelAdmin):
     """Role hierarchy admin class."""
 
     list_display = (
@@ -110,9 +235,12 @@ class RoleHierarchyAdmin(admin.ModelAdmin):
         hierarchy_role_link_b)
 
 
-class AccessHistoryAdmin(admin.ModelAdmin):
+class AccessHistoryAdmin(LinkPrefetchMixin, admin.ModelAdmin):
     """Acces history admin class."""
 
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
     list_display = (
         'datetime',
         'role_type',
@@ -128,9 +256,38 @@ class AccessHistoryAdmin(admin.ModelAdmin):
         'conveyor_id')
 
 
-class PrivilegeHistoryAdmin(admin.ModelAdmin):
+class AccessRollupAdmin(LinkPrefetchMixin, admin.ModelAdmin):
+    """Access rollup admin class."""
+
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    list_display = (
+        'bucket',
+        'count',
+        'role_type',
+        'role_id',
+        role_link,
+        'response',
+        'response_type',
+        'access_type',
+        'resource_type',
+        resource_link,
+        'resource_id',
+        'conveyor_type',
+        'conveyor_id')
+
+    list_filter = ('response', 'response_type', 'role_type', 'resource_type')
+    date_hierarchy = 'bucket'
+
+
+class PrivilegeHistoryAdmin(LinkPrefetchMixin, admin.ModelAdmin):
     """Privilege history admin class."""
 
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    list_select_related = ('user', )
+
     list_display = (
         'datetime',
         'user',
@@ -151,7 +308,9 @@ class PrivilegeHistoryAdmin(admin.ModelAdmin):
 
 admin.site.register(Role, RoleAdmin)
 admin.site.register(RolePrivilege, RolePrivilegeAdmin)
+admin.site.register(RolePrivilegeRange, RolePrivilegeRangeAdmin)
 admin.site.register(RoleHierarchy, RoleHierarchyAdmin)
 admin.site.register(AccessHistory, AccessHistoryAdmin)
+admin.site.register(AccessRollup, AccessRollupAdmin)
 admin.site.register(PrivilegeHistory, PrivilegeHistoryAdmin)
 # admin.site.register(HierarchyHistory, HierarchyHistoryAdmin)
@@ -3,11 +3,17 @@
 """App module providing the application settings class."""
 
 import importlib
+import inspect
+import logging
 
 from django.apps import AppConfig
+from django.core.exceptions import ValidationError
+from django.db import DatabaseError
 
 import appsettings as aps
 
+logger = logging.getLogger(__name__)
+
 
 class CerberusACConfig(AppConfig):
     name = 'cerberus_ac'
@@ -15,17 +21,67 @@ class CerberusACConfig(AppConfig):
 
     def ready(self):
         AppSettings.check()
+        from . import signals  # noqa
+        if AppSettings.warmup_on_ready.get_value():
+            from .warmup import warmup
+            try:
+                warmup(AppSettings.warmup_top.get_value(), report=logger.info)
+            except DatabaseError:
+                logger.warning('Could not warm up the caches', exc_info=True)
+
+
+_imported = {}
 
 
 def _import(complete_path):
-    module_name = '.'.join(complete_path.split('.')[:-1])
+    try:
+        return _imported[complete_path]
+    except KeyError:
+        pass
+    module_name, _, name = complete_path.rpartition('.')
     imported_module = importlib.import_module(name=module_name)
-    function_or_class = getattr(imported_module, complete_path.split('.')[-1])
+    function_or_class = getattr(imported_module, name)
+    _imported[complete_path] = function_or_class
     return function_or_class
 
 
+def _in_bulk(cls, ids):
+    from .utils import chunked
+    pks = []
+    for id in ids:
+        if not id:
+            continue
+        try:
+            pks.append(cls._meta.pk.to_python(id))
+        except ValidationError:
+            pass
+    found = {}
+    for chunk in chunked(pks, 500):
+        found.update(cls.objects.in_bulk(chunk))
+    return found
+
+
+def _roles_in_bulk(pairs):
+    from .models import Role
+    from .utils import chunked
+    types = {t for t, _ in pairs}
+    rids = {r for _, r in pairs}
+    found = {}
+    for chunk in chunked(rids, 500):
+        for role in Role.objects.filter(type__in=types, rid__in=chunk):
+            found[(role.type, role.rid)] = role
+    return found
+
+
 class Mapping(object):
-    """Mapping class to map roles/resources names to their classes."""
+    """
+    Mapping class to map roles/resources names to their classes.
+
+    The mapping is compiled on first use into dictionaries indexed by name,
+    class path and class, so lookups do not scan the mapping.
+    """
+
+    ROLE_ATTRS = {'user', 'group', 'role'}
 
     def __init__(self, mapping):
         """
@@ -35,6 +91,33 @@ class Mapping(object):
             mapping (dict): CERBERUS_MAPPING setting.
         """
         self.mapping = mapping
+        self._paths = None
+        self._names = None
+        self._attrs = None
+        self._roles = None
+        self._types = None
+        self._resolved = {}
+
+    def compile(self):
+        """Index the mapping by name, class path and attribute."""
+        if self._paths is not None:
+            return
+        names, attrs, roles = {}, {}, []
+        for k, v in self.mapping:
+            names[k] = v['name']
+            for attr in v['attr'].split():
+                attrs.setdefault(attr, []).append(k)
+            if self.ROLE_ATTRS & set(v['attr'].split()):
+                roles.append(k)
+        self._names, self._attrs, self._roles = names, attrs, roles
+        self._paths = {v: k for k, v in names.items()}
+
+    def compile_types(self):
+        """Import the mapped classes and index them by class."""
+        if self._types is not None:
+            return
+        self.compile()
+        self._types = {_import(k): v for k, v in self._names.items()}
 
     def get_class(self, name):
         """
@@ -46,10 +129,11 @@ class Mapping(object):
         Returns:
             class: the corresponding the role/resource class.
         """
-        for k, v in self.mapping:
-            if v['name'] == name:
-                return _import(k)
-        return None
+        self.compile()
+        path = self._paths.get(name)
+        if path is None:
+            return None
+        return _import(path)
 
     def get_instance(self, name, id):
         """
@@ -76,57 +160,98 @@ class Mapping(object):
         except Role.DoesNotExist:
             return None
 
+    def get_instances(self, pairs):
+        """
+        Return the instances of several role/resource types and IDs.
+
+        Pairs are grouped by type, and each group is fetched with one query
+        (per chunk of 500 IDs). Pairs of unmapped types are looked up in
+        the Role model with one query.
+
+        Args:
+            pairs (iterable): (type, id) tuples.
+
+        Returns:
+            list: the instances, or None when not found, in input order.
+        """
+        pairs = list(pairs)
+        ids_by_type = {}
+        for name, id in pairs:
+            ids_by_type.setdefault(name, set()).add(id)
+
+        found = {}
+        unmapped = set()
+        for name, ids in ids_by_type.items():
+            cls = self.get_class(name)
+            if not cls:
+                unmapped.update((name, str(i)) for i in ids)
+            elif hasattr(cls, 'objects'):
+                for pk, instance in _in_bulk(cls, ids).items():
+                    found[(name, str(pk))] = instance
+        if unmapped:
+            found.update(_roles_in_bulk(unmapped))
+
+        return [found.get((name, str(id))) for name, id in pairs]
+
     def get_type(self, obj):
         """
         Return the type of a role/resource given a Python object.
 
+        The class of the object and its parents are looked up in order, so
+        subclasses and proxy models of a mapped class get its type. Unmapped
+        classes get their name as type.
+
         Args:
             obj (obj): a Python object (class are accepted).
 
         Returns:
             str: the role/resource type.
         """
-        if isinstance(obj, type):
-            class_name = obj.__name__
+        cls = obj if isinstance(obj, type) else obj.__class__
+        try:
+            return self._resolved[cls]
+        except KeyError:
+            pass
+        self.compile_types()
+        for base in inspect.getmro(cls):
+            if base in self._types:
+                name = self._types[base]
+                break
         else:
-            class_name = obj.__class__.__name__
-        for k, v in self.mapping:
-            # FIXME: use complete path, not just the end
-            if k.split('.')[-1] == class_name:
-                return v['name']
-        return class_name
+            name = self._names.get(
+                '%s.%s' % (cls.__module__, cls.__name__), cls.__name__)
+        self._resolved[cls] = name
+        return name
+
+    def _paths_with(self, attr):
+        self.compile()
+        if attr is None:
+            return self._roles
+        return self._attrs.get(attr, [])
 
     def user_classes(self):
         """Return the user-role classes."""
-        return [_import(k) for k, v in self.mapping
-                if 'user' in v['attr'].split()]
+        return [_import(k) for k in self._paths_with('user')]
 
     def group_classes(self):
         """Return the group-role classes."""
-        return [_import(k) for k, v in self.mapping
-                if 'group' in v['attr'].split()]
+        return [_import(k) for k in self._paths_with('group')]
 
     def role_types(self):
         """Return the role types."""
-        return [v['name'] for k, v in self.mapping
-                if len({'user', 'group', 'role'} &
-                       set(v['attr'].split())) > 0]
+        return [self._names[k] for k in self._paths_with(None)]
 
     def role_classes(self):
         """Return the role classes."""
-        return [_import(k) for k, v in self.mapping
-                if len({'user', 'group', 'role'} &
-                       set(v['attr'].split())) > 0]
+        return [_import(k) for k in self._paths_with(None)]
 
     def resource_types(self):
         """Return the resource types."""
-        return [v['name'] for k, v in self.mapping
-                if 'resource' in v['attr'].split()]
+        return [self._names[k] for k in self._paths_with('resource')]
 
     def resource_classes(self):
         """Return the resource classes."""
-        return [_import(k) for k, v in self.mapping
-                if 'resource' in v['attr'].split()]
+        return [_import(k) for k in self._paths_with('resource')]
 
 
 class MappingSetting(aps.Setting):
@@ -161,9 +286,34 @@ class AppSettings(aps.AppSettings):
     Settings:
     - default_response (bool):
     - skip_implicit (bool):
+    - type_privileges (bool):
+    - range_privileges (bool):
     - log_access (bool):
+    - access_log_sink (str):
+    - access_log_batch_size (int):
+    - access_log_flush_interval (float):
+    - access_log_max_buffer (int):
+    - access_log_overflow (str):
+    - access_log_rollup (bool):
+    - access_log_rollup_interval (int):
+    - access_log_sample_rate (float):
     - log_privileges (bool):
     - log_hierarchy (bool):
+    - hierarchy_closure (bool):
+    - hierarchy_cache (bool):
+    - hierarchy_cache_timeout (int):
+    - decision_cache_size (int):
+    - shared_cache (str):
+    - shared_cache_timeout (int):
+    - rule_cache (str):
+    - access_types (list):
+    - count_queries (bool):
+    - metrics (bool):
+    - metrics_cache (str):
+    - metrics_token (str):
+    - metrics_publish_interval (int):
+    - warmup_on_ready (bool):
+    - warmup_top (int):
     - mapping (tuple):
     - namespace (str):
     """
@@ -171,11 +321,37 @@ class AppSettings(aps.AppSettings):
     allow_update_own_privileges = aps.BooleanSetting(default=False)
     default_response = aps.BooleanSetting(default=False)
     skip_implicit = aps.BooleanSetting(default=False)
+    type_privileges = aps.BooleanSetting(default=False)
+    range_privileges = aps.BooleanSetting(default=False)
     log_access = aps.BooleanSetting(default=True)
+    access_log_sink = aps.StringSetting(
+        default='cerberus_ac.access_log.SyncAccessLogSink')
+    access_log_batch_size = aps.PositiveIntegerSetting(default=500)
+    access_log_flush_interval = aps.PositiveFloatSetting(default=1.0)
+    access_log_max_buffer = aps.PositiveIntegerSetting(default=10000)
+    access_log_overflow = aps.StringSetting(default='block')
+    access_log_rollup = aps.BooleanSetting(default=False)
+    access_log_rollup_interval = aps.PositiveIntegerSetting(default=3600)
+    access_log_sample_rate = aps.PositiveFloatSetting(default=0.0)
     log_privileges = aps.BooleanSetting(default=True)
     log_hierarchy = aps.BooleanSetting(default=True)
+    hierarchy_closure = aps.BooleanSetting(default=True)
+    hierarchy_cache = aps.BooleanSetting(default=False)
+    hierarchy_cache_timeout = aps.PositiveIntegerSetting(default=60)
+    decision_cache_size = aps.PositiveIntegerSetting(default=1000)
+    shared_cache = aps.StringSetting(default='')
+    shared_cache_timeout = aps.PositiveIntegerSetting(default=300)
+    rule_cache = aps.StringSetting(default='')
     namespace = aps.StringSetting(default='')
-    mapping = MappingSetting(default=())
+    mapping = MappingSetting(default=(), transform_default=True)
+    access_types = aps.ListSetting(default=['read', 'update', 'delete'])
+    count_queries = aps.BooleanSetting(default=False)
+    metrics = aps.BooleanSetting(default=False)
+    metrics_cache = aps.StringSetting(default='')
+    metrics_token = aps.StringSetting(default='')
+    metrics_publish_interval = aps.PositiveIntegerSetting(default=60)
+    warmup_on_ready = aps.BooleanSetting(default=False)
+    warmup_top = aps.PositiveIntegerSetting(default=0)
     access_permission = aps.StringSetting(default='read')
 
     class Meta:
@@ -0,0 +1,571 @@
+# -*- coding: utf-8 -*-
+
+"""Cache module providing memoization of authorization decisions."""
+
+import functools
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.core.cache import caches
+from django.db import transaction
+
+from .apps import AppSettings
+from .utils import get_role_type_and_id
+
+try:
+    from django.utils.deprecation import MiddlewareMixin
+except ImportError:
+    MiddlewareMixin = object
+
+app_settings = AppSettings()
+
+_local = threading.local()
+
+GENERATION_KEY = 'cerberus_ac:generation'
+
+_rule_cache_stats = {}
+
+_hierarchy = {'index': None, 'generation': 0}
+
+
+class DecisionCache(object):
+    """Bounded cache of authorization decisions with LRU eviction."""
+
+    def __init__(self, max_size=None):
+        """
+        Initialization method.
+
+        Args:
+            max_size (int): maximum number of decisions to keep,
+                defaults to the DECISION_CACHE_SIZE setting.
+        """
+        if max_size is None:
+            max_size = app_settings.decision_cache_size
+        self.max_size = max_size
+        self.decisions = OrderedDict()
+
+    def __len__(self):
+        """Return the number of cached decisions."""
+        return len(self.decisions)
+
+    def get(self, key):
+        """
+        Return a cached decision and mark it as recently used.
+
+        Args:
+            key (tuple): the decision key.
+
+        Returns:
+            tuple: the cached decision or None.
+        """
+        try:
+            decision = self.decisions.pop(key)
+        except KeyError:
+            return None
+        self.decisions[key] = decision
+        return decision
+
+    def set(self, key, decision):
+        """
+        Cache a decision, evicting the least recently used ones if needed.
+
+        Args:
+            key (tuple): the decision key.
+            decision (tuple): the decision to cache.
+        """
+        self.decisions.pop(key, None)
+        self.decisions[key] = decision
+        while len(self.decisions) > self.max_size:
+            self.decisions.popitem(last=False)
+
+    def clear(self):
+        """Forget every cached decision."""
+        self.decisions.clear()
+
+
+def get_decision_cache():
+    """Return the decision cache active in this thread, or None."""
+    return getattr(_local, 'decision_cache', None)
+
+
+@contextmanager
+def decision_cache(max_size=None):
+    """
+    Context manager activating a decision cache for the enclosed code.
+
+    Use it in code running outside of HTTP requests (management commands,
+    tasks, scripts). If a cache is already active, it is reused.
+
+    Args:
+        max_size (int): maximum number of decisions to keep.
+
+    Yields:
+        DecisionCache: the active decision cache.
+    """
+    previous = get_decision_cache()
+    if previous is not None:
+        yield previous
+        return
+    _local.decision_cache = DecisionCache(max_size)
+    try:
+        yield _local.decision_cache
+    finally:
+        _local.decision_cache = None
+
+
+def get_policy_generation(cache):
+    """
+    Return the current policy generation stored in a Django cache.
+
+    When the counter is missing (never set, or evicted), it is initialized
+    with the current time in milliseconds, so that it never goes back to a
+    value already used to store decisions.
+
+    Args:
+        cache (BaseCache): a Django cache.
+
+    Returns:
+        int: the policy generation.
+    """
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        cache.add(GENERATION_KEY, int(time.time() * 1000), timeout=None)
+        generation = cache.get(GENERATION_KEY)
+    return generation
+
+
+def bump_policy_generation(cache):
+    """
+    Increment the policy generation stored in a Django cache.
+
+    Args:
+        cache (BaseCache): a Django cache.
+    """
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        get_policy_generation(cache)
+
+
+class SharedDecisionCache(object):
+    """Cross-process cache of authorization decisions."""
+
+    def __init__(self, cache, timeout=None):
+        """
+        Initialization method.
+
+        Decisions are stored under keys namespaced by the policy generation,
+        which is read once per instance.
+
+        Args:
+            cache (BaseCache): the Django cache to store decisions in.
+            timeout (int): number of seconds decisions are kept.
+        """
+        self.cache = cache
+        self.timeout = timeout
+        self._generation = None
+
+    @property
+    def generation(self):
+        """Return the policy generation used to namespace keys."""
+        if self._generation is None:
+            self._generation = get_policy_generation(self.cache)
+        return self._generation
+
+    def make_key(self, key):
+        """
+        Return the cache key of a decision.
+
+        Args:
+            key (tuple): the decision key.
+
+        Returns:
+            str: the cache key.
+        """
+        digest = hashlib.md5(repr(key).encode('utf-8')).hexdigest()
+        return 'cerberus_ac:decision:%s:%s' % (self.generation, digest)
+
+    def get(self, key):
+        """
+        Return a cached decision.
+
+        Args:
+            key (tuple): the decision key.
+
+        Returns:
+            tuple: the cached decision or None.
+        """
+        return self.cache.get(self.make_key(key))
+
+    def set(self, key, decision):
+        """
+        Cache a decision.
+
+        Args:
+            key (tuple): the decision key.
+            decision (tuple): the decision to cache.
+        """
+        self.cache.set(self.make_key(key), decision, self.timeout)
+
+
+def get_shared_decision_cache():
+    """Return the shared decision cache, or None if it is disabled."""
+    if not app_settings.shared_cache:
+        return None
+    return SharedDecisionCache(
+        caches[app_settings.shared_cache], app_settings.shared_cache_timeout)
+
+
+def memoize_decision(key, decide):
+    """
+    Return a decision from the active caches, or compute and cache it.
+
+    The request-scoped cache is consulted first, then the shared cache.
+
+    Args:
+        key (tuple): the decision key.
+        decide (callable): function computing the decision.
+
+    Returns:
+        tuple: the decision.
+    """
+    local_cache = get_decision_cache()
+    shared_cache = get_shared_decision_cache()
+
+    if local_cache is not None:
+        decision = local_cache.get(key)
+        if decision is not None:
+            return decision
+
+    if shared_cache is not None:
+        decision = shared_cache.get(key)
+        if decision is not None:
+            if local_cache is not None:
+                local_cache.set(key, decision)
+            return decision
+
+    decision = decide()
+    if local_cache is not None:
+        local_cache.set(key, decision)
+    if shared_cache is not None:
+        shared_cache.set(key, decision)
+    return decision
+
+
+def memoize_decisions(keys, decide_many):
+    """
+    Return several decisions from the active caches, computing the others.
+
+    Args:
+        keys (list): the decision keys.
+        decide_many (callable): function receiving the list of keys missing
+            from the caches, and returning a dict of decisions by key.
+
+    Returns:
+        dict: the decisions by key.
+    """
+    local_cache = get_decision_cache()
+    shared_cache = get_shared_decision_cache()
+    decisions = {}
+
+    for key in keys:
+        decision = None
+        if local_cache is not None:
+            decision = local_cache.get(key)
+        if decision is None and shared_cache is not None:
+            decision = shared_cache.get(key)
+            if decision is not None and local_cache is not None:
+                local_cache.set(key, decision)
+        if decision is not None:
+            decisions[key] = decision
+
+    missing = [key for key in keys if key not in decisions]
+    if missing:
+        computed = decide_many(missing)
+        for key, decision in computed.items():
+            if local_cache is not None:
+                local_cache.set(key, decision)
+            if shared_cache is not None:
+                shared_cache.set(key, decision)
+        decisions.update(computed)
+    return decisions
+
+
+def invalidate_decisions(using=None):
+    """
+    Invalidate cached decisions.
+
+    The decision cache active in this thread is cleared, the in-process
+    hierarchy index is outdated, and the policy generation of the shared
+    cache is bumped, making every decision stored in it unreachable.
+
+    Inside a transaction, this is done again when it commits: until then,
+    other processes still read the old rows, and could store decisions
+    computed from them under the new generation.
+
+    Args:
+        using (str): alias of the database written to, default to the
+            default database.
+    """
+    _invalidate_decisions()
+    connection = transaction.get_connection(using)
+    if connection.in_atomic_block and not any(
+            callback[1] is _invalidate_decisions
+            for callback in connection.run_on_commit):
+        transaction.on_commit(_invalidate_decisions, using=using)
+
+
+def _invalidate_decisions():
+    cache = get_decision_cache()
+    if cache is not None:
+        cache.clear()
+    _hierarchy['generation'] += 1
+    if app_settings.shared_cache:
+        bump_policy_generation(caches[app_settings.shared_cache])
+
+
+class RuleResultCache(object):
+    """Process-local cache of implicit rule results, with expiry."""
+
+    def __init__(self, max_size=10000):
+        """
+        Initialization method.
+
+        Args:
+            max_size (int): maximum number of results to keep.
+        """
+        self.max_size = max_size
+        self.results = OrderedDict()
+
+    def get(self, key, default=None):
+        """
+        Return a cached result, or default if missing or expired.
+
+        Args:
+            key (str): the result key.
+            default (obj): the value returned when the result is missing.
+
+        Returns:
+            obj: the cached result.
+        """
+        try:
+            expires, value = self.results[key]
+        except KeyError:
+            return default
+        if expires is not None and expires <= time.time():
+            del self.results[key]
+            return default
+        return value
+
+    def set(self, key, value, timeout=None):
+        """
+        Cache a result, evicting the oldest ones if needed.
+
+        Args:
+            key (str): the result key.
+            value (obj): the result.
+            timeout (int): number of seconds the result is kept.
+        """
+        expires = time.time() + timeout if timeout is not None else None
+        self.results.pop(key, None)
+        self.results[key] = (expires, value)
+        while len(self.results) > self.max_size:
+            self.results.popitem(last=False)
+
+    def clear(self):
+        """Forget every cached result."""
+        self.results.clear()
+
+
+rule_result_cache = RuleResultCache()
+
+
+def get_rule_cache():
+    """
+    Return the cache storing implicit rule results.
+
+    This is the Django cache named by the RULE_CACHE setting, or the
+    process-local ``rule_result_cache``.
+    """
+    if app_settings.rule_cache:
+        return caches[app_settings.rule_cache]
+    return rule_result_cache
+
+
+def get_rule_cache_stats():
+    """
+    Return the hit and miss counters of cached implicit rules.
+
+    Returns:
+        dict: {'hits': int, 'misses': int} dicts by rule name.
+    """
+    return {name: dict(stats) for name, stats in _rule_cache_stats.items()}
+
+
+def reset_rule_cache_stats():
+    """Reset the hit and miss counters of cached implicit rules."""
+    for stats in _rule_cache_stats.values():
+        stats.update(hits=0, misses=0)
+
+
+def cached_rule(ttl, version=None):
+    """
+    Decorator caching the results of an implicit rule for some time.
+
+    Use it on the ``can_<perm>...`` methods of role classes that run
+    expensive checks. Results are keyed on the rule, the role, the resource
+    type and ID given to the rule, and the version key, and stored in the
+    cache returned by ``get_rule_cache``.
+
+    Args:
+        ttl (int): number of seconds results are kept.
+        version (obj/callable): a version key, or a function returning it,
+            to change when the data the rule depends on changes.
+
+    Returns:
+        func: the decorator.
+    """
+    def decorator(rule):
+        name = getattr(rule, '__qualname__', rule.__name__)
+        stats = _rule_cache_stats.setdefault(name, {'hits': 0, 'misses': 0})
+
+        @functools.wraps(rule)
+        def wrapper(self, *args, **kwargs):
+            role_type, role_id = get_role_type_and_id(self)
+            key = (name, role_type, role_id,
+                   kwargs.get('resource_type'), kwargs.get('resource_id'),
+                   version() if callable(version) else version)
+            key = 'cerberus_ac:rule:%s' % hashlib.md5(
+                repr(key).encode('utf-8')).hexdigest()
+            cache = get_rule_cache()
+            result = cache.get(key)
+            if result is not None:
+                stats['hits'] += 1
+                return result[0]
+            stats['misses'] += 1
+            value = rule(self, *args, **kwargs)
+            cache.set(key, (value, ), ttl)
+            return value
+
+        wrapper.cache_ttl = ttl
+        return wrapper
+    return decorator
+
+
+class HierarchyIndex(object):
+    """In-process copy of the role hierarchy."""
+
+    def __init__(self, links, generation):
+        """
+        Initialization method.
+
+        Args:
+            links (iterable): (heir type, heir ID, conveyor type, conveyor ID)
+                tuples.
+            generation (tuple): the generation the links were read at.
+        """
+        self.conveyors = {}
+        for heir_type, heir_id, conveyor_type, conveyor_id in links:
+            self.conveyors.setdefault((heir_type, heir_id), []).append(
+                (conveyor_type, conveyor_id))
+        self.generation = generation
+        self.loaded = time.time()
+        self._layers = {}
+
+    def __len__(self):
+        """Return the number of indexed hierarchy links."""
+        return sum(len(c) for c in self.conveyors.values())
+
+    def layers(self, role_type, role_id):
+        """
+        Return the conveyors of a role grouped by depth.
+
+        Layers are the ones of ``RoleHierarchy.all_conveyors``, and are
+        memoized for each role.
+
+        Args:
+            role_type (str): string describing the role type.
+            role_id (str): unique ID of the role.
+
+        Returns:
+            list of lists: list of layers,
+                layers beings lists of (role_type, role_id) conveyors.
+        """
+        role = (role_type, role_id)
+        layers = self._layers.get(role)
+        if layers is None:
+            layers, seen, layer = [], {role}, [role]
+            while layer:
+                layer = sorted({conveyor for heir in layer
+                                for conveyor in self.conveyors.get(heir, ())
+                                if conveyor not in seen})
+                seen.update(layer)
+                if layer:
+                    layers.append(layer)
+            self._layers[role] = layers
+        return [list(layer) for layer in layers]
+
+
+def get_hierarchy_generation():
+    """
+    Return the current generation of the role hierarchy.
+
+    It changes when decisions are invalidated in this process, or in any
+    process when the SHARED_CACHE setting is set.
+    """
+    shared_generation = None
+    if app_settings.shared_cache:
+        shared_generation = get_policy_generation(
+            caches[app_settings.shared_cache])
+    return _hierarchy['generation'], shared_generation
+
+
+def load_hierarchy_index():
+    """Load the role hierarchy in memory and return the index."""
+    from .models import RoleHierarchy
+
+    generation = get_hierarchy_generation()
+    index = HierarchyIndex(RoleHierarchy.objects.values_list(
+        'role_type_a', 'role_id_a', 'role_type_b', 'role_id_b').iterator(),
+        generation)
+    _hierarchy['index'] = index
+    return index
+
+
+def get_hierarchy_index():
+    """
+    Return the in-process hierarchy index, loading it if needed.
+
+    The index is used only when the HIERARCHY_CACHE setting is True. It is
+    reloaded when its generation is outdated, or after
+    HIERARCHY_CACHE_TIMEOUT seconds, which bounds the time changes made by
+    other processes stay unseen when the SHARED_CACHE setting is not set.
+
+    Returns:
+        HierarchyIndex: the index, or None if disabled.
+    """
+    if not app_settings.hierarchy_cache:
+        return None
+    index = _hierarchy['index']
+    if (index is None or
+            index.generation != get_hierarchy_generation() or
+            time.time() - index.loaded >
+            app_settings.hierarchy_cache_timeout):
+        index = load_hierarchy_index()
+    return index
+
+
+class DecisionCacheMiddleware(MiddlewareMixin):
+    """Middleware activating a decision cache for each request."""
+
+    def process_request(self, request):
+        """Activate a new decision cache for the request."""
+        _local.decision_cache = DecisionCache()
+
+    def process_response(self, request, response):
+        """Deactivate the decision cache of the request."""
+        _local.decision_cache = None
+        return response
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+
+"""Closure module, storing the transitive closure of the role hierarchy."""
+
+from django.db import models, transaction
+from django.utils.translation import ugettext_lazy as _
+
+from .utils import chunked, roles_filter, transitive_closure
+
+
+class RoleHierarchyClosure(models.Model):
+    """
+    Transitive closure of the role hierarchy.
+
+    Each row tells that the descendant role inherits privileges from the
+    ancestor role, through a chain of ``depth`` hierarchy links (the shortest
+    one). Rows are maintained when RoleHierarchy rows are saved or deleted,
+    and can be rebuilt with the ``cerberus_rebuild_closure`` command.
+
+    Rows are maintained by signals, so writes that send none leave the
+    closure outdated: ``QuerySet.update``, ``QuerySet.bulk_create``, raw
+    SQL, or deletions bypassing signals. After such writes, call
+    ``RoleHierarchyClosure.rebuild()`` or run the command. Raw saves (for
+    example from ``loaddata``) schedule a rebuild when their transaction
+    commits.
+    """
+
+    ancestor_type = models.CharField(_('Ancestor type'), max_length=255)
+    ancestor_id = models.CharField(
+        _('Ancestor ID'), max_length=255, blank=True)
+    descendant_type = models.CharField(_('Descendant type'), max_length=255)
+    descendant_id = models.CharField(
+        _('Descendant ID'), max_length=255, blank=True)
+    depth = models.PositiveIntegerField(_('Depth'))
+
+    class Meta:
+        """Meta class for Django."""
+
+        verbose_name = _('Role hierarchy closure')
+        verbose_name_plural = _('Role hierarchy closure')
+        unique_together = (
+            'descendant_type', 'descendant_id',
+            'ancestor_type', 'ancestor_id'
+        )
+        index_together = (('ancestor_type', 'ancestor_id'),)
+
+    def __str__(self):
+        """Return the closure row as text."""
+        descendant = self.descendant_type
+        if self.descendant_id:
+            descendant += ' %s' % self.descendant_id
+        ancestor = self.ancestor_type
+        if self.ancestor_id:
+            ancestor += ' %s' % self.ancestor_id
+
+        return '%s inherits from %s (depth %d)' % (
+            descendant, ancestor, self.depth)
+
+    @staticmethod
+    def layers(role_type, role_id, ancestors=True):
+        """
+        Return the ancestors or descendants of a role, grouped by depth.
+
+        Args:
+            role_type (str): string describing the role type.
+            role_id (str): unique ID of the role.
+            ancestors (bool): return ancestors, or descendants if False.
+
+        Returns:
+            list of lists: list of layers,
+                layers beings lists of (role_type, role_id) tuples.
+        """
+        if ancestors:
+            rows = RoleHierarchyClosure.objects.filter(
+                descendant_type=role_type, descendant_id=role_id
+            ).order_by('depth', 'ancestor_type', 'ancestor_id').values_list(
+                'ancestor_type', 'ancestor_id', 'depth')
+        else:
+            rows = RoleHierarchyClosure.objects.filter(
+                ancestor_type=role_type, ancestor_id=role_id
+            ).order_by(
+                'depth', 'descendant_type', 'descendant_id').values_list(
+                'descendant_type', 'descendant_id', 'depth')
+
+        layers = []
+        for other_role_type, other_role_id, depth in rows:
+            if depth > len(layers):
+                layers.append([])
+            layers[-1].append((other_role_type, other_role_id))
+        return layers
+
+    @staticmethod
+    def depths(role_type, role_id, ancestors=True):
+        """
+        Return the ancestors or descendants of a role with their depth.
+
+        Args:
+            role_type (str): string describing the role type.
+            role_id (str): unique ID of the role.
+            ancestors (bool): return ancestors, or descendants if False.
+
+        Returns:
+            dict: depth for each (role_type, role_id), role included (0).
+        """
+        depths = {(role_type, role_id): 0}
+        for depth, layer in enumerate(RoleHierarchyClosure.layers(
+                role_type, role_id, ancestors), 1):
+            depths.update((role, depth) for role in layer)
+        return depths
+
+    @staticmethod
+    def add_link(heir_type, heir_id, conveyor_type, conveyor_id):
+        """
+        Update the closure after a hierarchy link was added.
+
+        Every descendant of the heir (itself included) gets every ancestor
+        of the conveyor (itself included), with the shortest depth.
+
+        Args:
+            heir_type (str): type of the role inheriting privileges.
+            heir_id (str): ID of the role inheriting privileges.
+            conveyor_type (str): type of the role conveying privileges.
+            conveyor_id (str): ID of the role conveying privileges.
+        """
+        descendants = RoleHierarchyClosure.depths(
+            heir_type, heir_id, ancestors=False)
+        ancestors = RoleHierarchyClosure.depths(conveyor_type, conveyor_id)
+
+        existing = {}
+        for chunk in chunked(descendants, 250):
+            for row in RoleHierarchyClosure.objects.filter(
+                    descendant_type__in={t for t, _ in chunk},
+                    descendant_id__in={i for _, i in chunk},
+                    ancestor_type__in={t for t, _ in ancestors}).values_list(
+                    'pk', 'descendant_type', 'descendant_id',
+                    'ancestor_type', 'ancestor_id', 'depth'):
+                existing[(row[1], row[2]), (row[3], row[4])] = row[0], row[5]
+
+        to_create = []
+        to_update = {}
+        for descendant, descendant_depth in descendants.items():
+            for ancestor, ancestor_depth in ancestors.items():
+                if descendant == ancestor:
+                    continue
+                depth = descendant_depth + 1 + ancestor_depth
+                if (descendant, ancestor) not in existing:
+                    to_create.append(RoleHierarchyClosure(
+                        descendant_type=descendant[0],
+                        descendant_id=descendant[1],
+                        ancestor_type=ancestor[0], ancestor_id=ancestor[1],
+                        depth=depth))
+                elif depth < existing[descendant, ancestor][1]:
+                    to_update.setdefault(depth, []).append(
+                        existing[descendant, ancestor][0])
+
+        with transaction.atomic():
+            RoleHierarchyClosure.objects.bulk_create(
+                to_create, batch_size=500)
+            for depth, pks in to_update.items():
+                for chunk in chunked(pks, 500):
+                    RoleHierarchyClosure.objects.filter(
+                        pk__in=chunk).update(depth=depth)
+
+    @staticmethod
+    def remove_link(heir_type, heir_id):
+        """
+        Update the closure after a hierarchy link of the heir was removed.
+
+        The rows of the heir and of each of its descendants are recomputed
+        together, see ``refresh``.
+
+        Args:
+            heir_type (str): type of the role that inherited privileges.
+            heir_id (str): ID of the role that inherited privileges.
+        """
+        RoleHierarchyClosure.refresh(RoleHierarchyClosure.depths(
+            heir_type, heir_id, ancestors=False))
+
+    @staticmethod
+    def refresh(roles):
+        """
+        Recompute the closure rows of the given descendant roles.
+
+        The roles must include every descendant of the changed links. The
+        links of the roles are read, along with the closure rows of the
+        roles they lead to outside of the given ones, which are not
+        affected. The rows of every role are then computed together, and
+        replaced with one delete and one bulk insert per chunk.
+
+        Args:
+            roles (iterable): (role_type, role_id) tuples.
+        """
+        from .models import RoleHierarchy
+
+        roles = set(roles)
+        links = []
+        for chunk in chunked(roles, 250):
+            for a_type, a_id, b_type, b_id in RoleHierarchy.objects.filter(
+                    roles_filter(chunk, 'role_type_a', 'role_id_a')
+            ).values_list('role_type_a', 'role_id_a',
+                          'role_type_b', 'role_id_b'):
+                links.append(((a_type, a_id), (b_type, b_id)))
+
+        outside = {conveyor for _, conveyor in links} - roles
+        above = {}
+        for chunk in chunked(outside, 250):
+            for d_type, d_id, a_type, a_id, depth in \
+                    RoleHierarchyClosure.objects.filter(roles_filter(
+                        chunk, 'descendant_type', 'descendant_id')
+                    ).values_list('descendant_type', 'descendant_id',
+                                  'ancestor_type', 'ancestor_id', 'depth'):
+                above.setdefault((d_type, d_id), []).append(
+                    ((a_type, a_id), depth))
+
+        depths = {}
+        for descendant, conveyor, depth in transitive_closure(links):
+            reached = [(conveyor, depth)] + [
+                (ancestor, depth + extra)
+                for ancestor, extra in above.get(conveyor, ())]
+            for ancestor, ancestor_depth in reached:
+                key = descendant, ancestor
+                if ancestor != descendant and ancestor_depth < depths.get(
+                        key, ancestor_depth + 1):
+                    depths[key] = ancestor_depth
+
+        with transaction.atomic():
+            for chunk in chunked(roles, 250):
+                RoleHierarchyClosure.objects.filter(roles_filter(
+                    chunk, 'descendant_type', 'descendant_id')).delete()
+            RoleHierarchyClosure.objects.bulk_create([
+                RoleHierarchyClosure(
+                    descendant_type=descendant[0],
+                    descendant_id=descendant[1],
+                    ancestor_type=ancestor[0], ancestor_id=ancestor[1],
+                    depth=depth)
+                for (descendant, ancestor), depth in depths.items()
+            ], batch_size=500)
+
+    @staticmethod
+    def rebuild(batch_size=1000):
+        """
+        Rebuild the whole closure from the RoleHierarchy rows.
+
+        Args:
+            batch_size (int): number of rows inserted per query.
+
+        Returns:
+            int: the number of closure rows created.
+        """
+        from .models import RoleHierarchy
+
+        links = (((a_type, a_id), (b_type, b_id))
+                 for a_type, a_id, b_type, b_id in
+                 RoleHierarchy.objects.values_list(
+                     'role_type_a', 'role_id_a', 'role_type_b', 'role_id_b'
+                 ).iterator())
+        rows = (RoleHierarchyClosure(
+            descendant_type=descendant[0], descendant_id=descendant[1],
+            ancestor_type=ancestor[0], ancestor_id=ancestor[1], depth=depth)
+            for descendant, ancestor, depth in transitive_closure(links))
+
+        count = 0
+        with transaction.atomic():
+            RoleHierarchyClosure.objects.all().delete()
+            for chunk in chunked(rows, batch_size):
+                RoleHierarchyClosure.objects.bulk_create(chunk)
+                count += len(chunk)
+        return count
@@ -0,0 +1,811 @@
+# -*- coding: utf-8 -*-
+
+"""
+Decisions module, resolving the authorization checks of the roles.
+
+The methods of ``AuthorizationMixin`` are the authorization engine of
+``RolePrivilege``: explicit privileges of the role and its conveyors,
+implicit rules of the role classes, default response, and the database
+filtering of accessible resources.
+"""
+
+import time
+from collections import OrderedDict
+
+from django.db import connections, models, router
+from django.db.models import Case, Q, Value, When
+from django.db.models.functions import Coalesce
+from django.dispatch import Signal
+from django.utils.functional import SimpleLazyObject
+
+from .access_log import get_access_log_sink
+from .apps import AppSettings
+from .cache import memoize_decision, memoize_decisions
+from .history import AccessHistory
+from .ranges import layer_range_filters, resolve_ranges
+from .utils import QueryCounter, chunked, roles_filter
+
+try:
+    from django.db.models import Exists, OuterRef
+    from django.db.models.functions import Cast
+except ImportError:  # Django < 1.11
+    Exists = OuterRef = Cast = None
+
+app_settings = AppSettings()
+
+# Sent by RolePrivilege.authorize when it has receivers, with arguments:
+# role_type, role_id, perm, resource_type, resource_id, response,
+# response_type, conveyor_type, conveyor_id, cache_hit, timings (seconds
+# spent in each phase), queries (None unless the COUNT_QUERIES setting is
+# True), layers and depth (None on cache hits).
+authorization_checked = Signal()
+
+# Sent once by RolePrivilege.authorize_bulk when it has receivers, with
+# arguments: role_type, role_id, results (response, response_type,
+# conveyor_type and conveyor_id of each check), cache_hits (number of
+# decisions found in caches), timings, layers (None when every decision was
+# cached) and depths (of the decisive conveyor of each computed check).
+authorization_bulk_checked = Signal()
+
+# Sent by RolePrivilege.filter_accessible when it has receivers, with
+# arguments: role_type, role_id, perm, resource_type and layers (None when
+# the filter falls back to authorize_bulk).
+accessible_filtered = Signal()
+
+_implicit_rule_names = {}
+_implicit_rules = {}
+
+
+class AuthorizationMixin(object):
+    """Authorization methods of the role privilege model."""
+
+    @classmethod
+    def authorize(cls,
+                  role_type,
+                  role_id,
+                  perm,
+                  resource_type,
+                  resource_id,
+                  skip_implicit=None,
+                  log=None):
+        """
+        Authorize access to a resource to a role.
+
+        This method checks if a role has access to a resource or a type of
+        resource. Calling this method will also try to record an entry log
+        in the corresponding access attempt model.
+
+        When a decision cache is active (see ``DecisionCacheMiddleware`` and
+        ``decision_cache``), or when the SHARED_CACHE setting is set,
+        repeated checks are answered from the cache.
+
+        Call will not break if there is no access attempt model. Simply,
+        nothing will be recorded. Attempts are recorded through the sink set
+        in the ACCESS_LOG_SINK setting, which may buffer them.
+
+        Args:
+            role_type (str): the string describing the role.
+            role_id (str): the unique ID of the role.
+            perm (Permission's constant): one of the permissions available
+                in Permission class.
+            resource_type (str): the string describing the resource.
+            resource_id (str): the unique ID of the resource.
+            log (bool): record an entry in access history model or not.
+            skip_implicit (bool): whether to skip implicit authorization.
+                It will always be skipped if you set ACCESS_CONTROL_IMPLICIT
+                setting to False.
+
+        Returns:
+            bool: role has perm on resource (or not).
+        """
+        if skip_implicit is None:
+            skip_implicit = app_settings.skip_implicit
+
+        if log is None:
+            log = app_settings.log_access
+
+        if not authorization_checked.has_listeners(cls):
+            return cls.check(
+                role_type, role_id, perm, resource_type, resource_id,
+                skip_implicit, log)[0]
+
+        stats = {'timings': {}, 'cache_hit': True, 'layers': None,
+                 'depth': None}
+        started = time.time()
+        if app_settings.count_queries:
+            with QueryCounter(
+                    connections[router.db_for_read(cls)]) as queries:
+                decision = cls.check(
+                    role_type, role_id, perm, resource_type, resource_id,
+                    skip_implicit, log, stats)
+            queries = queries.count
+        else:
+            queries = None
+            decision = cls.check(
+                role_type, role_id, perm, resource_type, resource_id,
+                skip_implicit, log, stats)
+        stats['timings']['total'] = time.time() - started
+        response, response_type, conveyor_type, conveyor_id = decision
+
+        authorization_checked.send(
+            sender=cls, role_type=role_type, role_id=role_id,
+            perm=perm, resource_type=resource_type, resource_id=resource_id,
+            response=response, response_type=response_type,
+            conveyor_type=conveyor_type, conveyor_id=conveyor_id,
+            queries=queries, **stats)
+        return response
+
+    @classmethod
+    def check(cls,
+              role_type,
+              role_id,
+              perm,
+              resource_type,
+              resource_id,
+              skip_implicit,
+              log,
+              stats=None):
+        """
+        Decide (or get from the caches) and log an authorization check.
+
+        Args:
+            role_type (str): the string describing the role.
+            role_id (str): the unique ID of the role.
+            perm (str): the permission to check.
+            resource_type (str): the string describing the resource.
+            resource_id (str): the unique ID of the resource.
+            skip_implicit (bool): whether to skip implicit authorization.
+            log (bool): record an entry in access history model or not.
+            stats (dict): if given, filled with the durations of the phases
+                in ``timings``, and with ``cache_hit``, ``layers`` and
+                ``depth`` (see ``decide_many``).
+
+        Returns:
+            tuple: response, response type, conveyor type and conveyor ID.
+        """
+        def decide():
+            if stats is not None:
+                stats['cache_hit'] = False
+            return cls.decide(
+                role_type, role_id, perm, resource_type, resource_id,
+                skip_implicit, stats)
+
+        started = time.time() if stats is not None else None
+        decision = memoize_decision(
+            (role_type, role_id, perm, resource_type, resource_id,
+             skip_implicit), decide)
+        response, response_type, conveyor_type, conveyor_id = decision
+
+        if stats is not None:
+            timings = stats['timings']
+            timings['cache'] = time.time() - started - sum(timings.values())
+            started = time.time()
+
+        if log:
+            get_access_log_sink().record([AccessHistory(
+                role_type=role_type, role_id=role_id,
+                resource_type=resource_type, resource_id=resource_id,
+                access_type=perm, response=response,
+                response_type=response_type,
+                conveyor_type=conveyor_type, conveyor_id=conveyor_id)])
+
+        if stats is not None:
+            stats['timings']['log'] = time.time() - started
+
+        return decision
+
+    @classmethod
+    def decide(cls,
+               role_type,
+               role_id,
+               perm,
+               resource_type,
+               resource_id,
+               skip_implicit=False,
+               stats=None):
+        """
+        Compute the decision of an authorization check, without logging it.
+
+        Args:
+            role_type (str): the string describing the role.
+            role_id (str): the unique ID of the role.
+            perm (str): the permission to check.
+            resource_type (str): the string describing the resource.
+            resource_id (str): the unique ID of the resource.
+            skip_implicit (bool): whether to skip implicit authorization.
+            stats (dict): if given, filled as in ``decide_many``, with
+                ``depth`` the depth of the decisive conveyor.
+
+        Returns:
+            tuple: response, response type, conveyor type and conveyor ID.
+        """
+        check = (perm, resource_type, resource_id)
+        decision = cls.decide_many(
+            role_type, role_id, [check], skip_implicit, stats)[check]
+        if stats is not None:
+            stats['depth'] = stats.pop('depths')[check]
+        return decision
+
+    @classmethod
+    def authorize_bulk(cls,
+                       role_type,
+                       role_id,
+                       checks,
+                       skip_implicit=None,
+                       log=None):
+        """
+        Authorize several accesses to resources to a role at once.
+
+        The conveyors of the role are computed once, explicit privileges are
+        loaded in a bounded number of queries, implicit authorization is only
+        run for undecided checks, and access attempts are recorded with one
+        bulk insert.
+
+        Args:
+            role_type (str): the string describing the role.
+            role_id (str): the unique ID of the role.
+            checks (iterable): (perm, resource_type, resource_id) tuples.
+            skip_implicit (bool): whether to skip implicit authorization.
+            log (bool): record entries in access history model or not.
+
+        Returns:
+            dict: True or False for each check.
+        """
+        if skip_implicit is None:
+            skip_implicit = app_settings.skip_implicit
+
+        if log is None:
+            log = app_settings.log_access
+
+        checks = list(OrderedDict.fromkeys(tuple(c) for c in checks))
+        stats = None
+        if authorization_bulk_checked.has_listeners(cls):
+            stats = {'timings': {}, 'layers': None, 'depths': {}}
+        started = time.time()
+
+        def key(check):
+            return (role_type, role_id) + check + (skip_implicit,)
+
+        def decide_many(keys):
+            decisions = cls.decide_many(
+                role_type, role_id, [k[2:5] for k in keys], skip_implicit,
+                stats)
+            return {key(c): decision for c, decision in decisions.items()}
+
+        decisions = memoize_decisions([key(c) for c in checks], decide_many)
+        decisions = OrderedDict(
+            (check, decisions[key(check)]) for check in checks)
+
+        if log:
+            attempts = []
+            for check, decision in decisions.items():
+                perm, resource_type, resource_id = check
+                response, response_type, conveyor_type, conveyor_id = decision
+                attempts.append(AccessHistory(
+                    role_type=role_type, role_id=role_id,
+                    resource_type=resource_type, resource_id=resource_id,
+                    access_type=perm, response=response,
+                    response_type=response_type,
+                    conveyor_type=conveyor_type, conveyor_id=conveyor_id))
+            get_access_log_sink().record(attempts)
+
+        if stats is not None:
+            stats['timings']['total'] = time.time() - started
+            authorization_bulk_checked.send(
+                sender=cls, role_type=role_type, role_id=role_id,
+                results=decisions,
+                cache_hits=len(checks) - len(stats['depths']), **stats)
+
+        return {check: decision[0] for check, decision in decisions.items()}
+
+    @classmethod
+    def decide_many(cls, role_type, role_id, checks, skip_implicit=False,
+                    stats=None):
+        """
+        Compute the decisions of several checks, without logging them.
+
+        Args:
+            role_type (str): the string describing the role.
+            role_id (str): the unique ID of the role.
+            checks (list): (perm, resource_type, resource_id) tuples.
+            skip_implicit (bool): whether to skip implicit authorization.
+            stats (dict): if given, filled with the durations of the
+                ``hierarchy``, ``explicit`` and ``implicit`` phases in
+                ``timings``, the number of conveyor ``layers``, and the
+                ``depths`` of the decisive conveyor of each check (None for
+                default responses).
+
+        Returns:
+            dict: response, response type, conveyor type and conveyor ID
+                for each check.
+        """
+        from .models import RoleHierarchy
+
+        if stats is not None:
+            timings = stats.setdefault('timings', {})
+            started = time.time()
+
+        depths = RoleHierarchy.conveyor_depths(role_type, role_id)
+        if stats is not None:
+            timings['hierarchy'] = time.time() - started
+            started = time.time()
+
+        explicit = cls.resolve_explicit_many(depths, checks)
+        if stats is not None:
+            timings['explicit'] = time.time() - started
+            started = time.time()
+
+        conveyors = sorted(depths, key=lambda r: (depths[r], r))
+        decisions = {}
+        decisive_depths = {}
+
+        for check in checks:
+            response_type = AccessHistory.EXPLICIT
+
+            # Check role and inherited explicit perms
+            response, conveyor = explicit.get(check, (None, None))
+
+            # Else check role and inherited implicit perms
+            if response is None and not skip_implicit:
+                response_type = AccessHistory.IMPLICIT
+                response, conveyor = cls.resolve_implicit(conveyors, check)
+
+            # Else give default response
+            if response is None:
+                decisions[check] = (app_settings.default_response,
+                                    AccessHistory.DEFAULT, '', '')
+                decisive_depths[check] = None
+            elif depths[conveyor] == 0:
+                decisions[check] = (response, response_type, '', '')
+                decisive_depths[check] = 0
+            else:
+                decisions[check] = (
+                    response, response_type, conveyor[0], conveyor[1])
+                decisive_depths[check] = depths[conveyor]
+
+        if stats is not None:
+            timings['implicit'] = time.time() - started
+            stats['layers'] = max(depths.values())
+            stats['depths'] = decisive_depths
+
+        return decisions
+
+    @classmethod
+    def resolve_implicit(cls, conveyors, check):
+        """
+        Find the first conveyor implicitly deciding a check.
+
+        Args:
+            conveyors (list): (role_type, role_id) tuples, nearest first.
+            check (tuple): perm, resource_type and resource_id.
+
+        Returns:
+            tuple: the response (None when undecided) and the conveyor.
+        """
+        for conveyor in conveyors:
+            response = cls.authorize_implicit(
+                conveyor[0], conveyor[1], *check)
+            if response is not None:
+                return response, conveyor
+        return None, None
+
+    @classmethod
+    def resolve_explicit(cls, depths, perm, resource_type, resource_id=''):
+        """
+        Find the decisive explicit privilege among several roles.
+
+        Args:
+            depths (dict): depth of each (role_type, role_id) to consider,
+                as returned by ``RoleHierarchy.conveyor_depths``.
+            perm (str): one of the permissions available in Permission class.
+            resource_type (str): a string describing the type of resource.
+            resource_id (str): the resource's ID.
+
+        Returns:
+            tuple: authorized (bool or None) and (role_type, role_id) of the
+                role owning the decisive privilege (or None).
+        """
+        check = (perm, resource_type, resource_id)
+        return cls.resolve_explicit_many(depths, [check]).get(
+            check, (None, None))
+
+    @classmethod
+    def resolve_explicit_many(cls, depths, checks):
+        """
+        Find the decisive explicit privileges of several checks.
+
+        Privileges of every given role are fetched at once, in chunks of
+        resource IDs and roles. The privilege of the nearest layer wins.
+        Inside a layer, a denial wins over an authorization, then roles are
+        ordered by type and ID.
+
+        When the TYPE_PRIVILEGES setting is True, privileges with an empty
+        resource ID are type-level privileges: they apply to every resource
+        of their type, and are fetched in the same queries. Inside a layer,
+        an object-level privilege wins over a type-level one.
+
+        When the RANGE_PRIVILEGES setting is True, the range privileges
+        (see ``RolePrivilegeRange``) containing the integer resource IDs are
+        fetched too, with one more query per chunk of roles. They have the
+        precedence of object-level privileges.
+
+        Args:
+            depths (dict): depth of each (role_type, role_id) to consider,
+                as returned by ``RoleHierarchy.conveyor_depths``.
+            checks (list): (perm, resource_type, resource_id) tuples.
+
+        Returns:
+            dict: authorized (bool) and (role_type, role_id) of the role
+                owning the decisive privilege, for each decided check.
+        """
+        wanted, by_perm = {}, {}
+        for check in checks:
+            perm, resource_type, resource_id = check
+            if resource_id is not None:
+                wanted.setdefault(resource_type, {}).setdefault(
+                    (perm, str(resource_id)), []).append(check)
+                by_perm.setdefault((resource_type, perm), []).append(check)
+
+        candidates = {}
+
+        def consider(checks, role, type_level, authorized):
+            # type-level privileges come after object-level ones of the
+            # same layer
+            candidate = (depths[role], type_level, authorized, role)
+            for check in checks:
+                if check not in candidates or candidate < candidates[check]:
+                    candidates[check] = candidate
+
+        for resource_type, by_perm_and_id in wanted.items():
+            cls.resolve_privileges(
+                depths, resource_type, by_perm_and_id, by_perm, consider)
+            if app_settings.range_privileges:
+                resolve_ranges(
+                    depths, resource_type, by_perm_and_id, consider)
+
+        return {check: (authorized, role)
+                for check, (_, _, authorized, role) in candidates.items()}
+
+    @classmethod
+    def resolve_privileges(cls, depths, resource_type, by_perm_and_id,
+                           by_perm, consider):
+        """
+        Find the privileges of the roles on resources of a type.
+
+        Privileges are fetched in chunks of resource IDs and roles. When the
+        TYPE_PRIVILEGES setting is True, type-level privileges are fetched in
+        the same queries.
+
+        Args:
+            depths (dict): depth of each (role_type, role_id) to consider.
+            resource_type (str): a string describing the type of resource.
+            by_perm_and_id (dict): checks for each (perm, resource_id).
+            by_perm (dict): checks for each (resource_type, perm).
+            consider (callable): function receiving the checks matched by a
+                privilege, the role owning it, whether it is type-level and
+                its authorization.
+        """
+        type_privileges = app_settings.type_privileges
+        perms = {perm for perm, _ in by_perm_and_id}
+        resource_ids = {i for _, i in by_perm_and_id}
+        if type_privileges:
+            resource_ids.add('')
+        for ids_chunk in chunked(resource_ids, 400):
+            for roles_chunk in chunked(depths, 400):
+                rows = cls.objects.filter(
+                    resource_type=resource_type, access_type__in=perms,
+                    resource_id__in=ids_chunk,
+                    role_type__in={t for t, _ in roles_chunk},
+                    role_id__in={i for _, i in roles_chunk}
+                ).values_list('role_type', 'role_id', 'access_type',
+                              'resource_id', 'authorized')
+                for p_role_type, p_role_id, perm, resource_id, \
+                        authorized in rows:
+                    role = (p_role_type, p_role_id)
+                    if role not in depths:
+                        continue
+                    if type_privileges and not resource_id:
+                        consider([c for c in by_perm.get(
+                            (resource_type, perm), ()) if c[2] != ''],
+                            role, True, authorized)
+                    consider(by_perm_and_id.get((perm, resource_id), ()),
+                             role, False, authorized)
+
+    @classmethod
+    def filter_accessible(cls,
+                          role_type,
+                          role_id,
+                          perm,
+                          queryset,
+                          resource_type=None):
+        """
+        Filter a queryset of resources on the privileges of a role.
+
+        For each layer of conveyors (the role itself first), two EXISTS
+        subqueries check for authorizations and denials on each resource
+        (on Django < 1.11, the resources are checked with ``authorize_bulk``
+        and the result is not lazy).
+        The nearest layer with a privilege decides, a denial winning over
+        an authorization, as in ``authorize``. Resources without privilege
+        get the default response. Implicit authorization is not applied.
+
+        When the TYPE_PRIVILEGES setting is True, type-level privileges are
+        loaded first, with one query. In their layer, they decide for every
+        resource without an object-level privilege, so the deeper layers
+        are not checked.
+
+        When the RANGE_PRIVILEGES setting is True and the primary key of
+        the resources is an integer, the range privileges of the roles are
+        loaded with one query, and added to their layer as primary key
+        range filters.
+
+        Args:
+            role_type (str): the string describing the role.
+            role_id (str): the unique ID of the role.
+            perm (str): the privilege.
+            queryset (QuerySet): the resources to filter.
+            resource_type (str): type of the resources, default to the
+                type of the queryset model.
+
+        Returns:
+            QuerySet: the lazy filtered queryset.
+        """
+        from .models import RoleHierarchy
+
+        if resource_type is None:
+            resource_type = app_settings.mapping.get_type(queryset.model)
+
+        if Exists is None:
+            cls.send_accessible_filtered(
+                role_type, role_id, perm, resource_type, None)
+            pks = list(queryset.values_list('pk', flat=True))
+            checks = [(perm, resource_type, str(pk)) for pk in pks]
+            decisions = cls.authorize_bulk(
+                role_type, role_id, checks, skip_implicit=True, log=False)
+            return queryset.filter(pk__in=[
+                pk for pk, check in zip(pks, checks) if decisions[check]])
+
+        layers = {}
+        depths = RoleHierarchy.conveyor_depths(role_type, role_id)
+        for role, depth in depths.items():
+            layers.setdefault(depth, []).append(role)
+        cls.send_accessible_filtered(
+            role_type, role_id, perm, resource_type, max(layers))
+
+        type_decisions = {}
+        if app_settings.type_privileges:
+            type_decisions = cls.layer_type_decisions(
+                depths, perm, resource_type)
+
+        # primary key ranges of each layer, for denials and authorizations
+        ranges = {False: {}, True: {}}
+        if app_settings.range_privileges:
+            ranges = layer_range_filters(
+                depths, perm, resource_type, queryset.model)
+
+        privileges = cls.objects.filter(
+            access_type=perm, resource_type=resource_type,
+            resource_id=OuterRef('cerberus_resource_id'))
+
+        annotations, decisions = {}, []
+        for depth in sorted(layers):
+            roles = roles_filter(layers[depth])
+            type_decision = type_decisions.get(depth)
+
+            # 0 if denied, 1 if allowed, NULL if the layer has no privilege;
+            # object-level denials always come first, as in authorize, even
+            # with a type-level denial an object-level allow would override
+            deny = 'cerberus_deny_%d' % depth
+            annotations[deny] = Exists(
+                privileges.filter(roles, authorized=False))
+            whens = [When(
+                Q(**{deny: True}) | ranges[False].get(depth, Q()),
+                then=Value(0))]
+            if type_decision is not True:
+                allow = 'cerberus_allow_%d' % depth
+                annotations[allow] = Exists(
+                    privileges.filter(roles, authorized=True))
+                whens.append(When(
+                    Q(**{allow: True}) | ranges[True].get(depth, Q()),
+                    then=Value(1)))
+            if type_decision is None:
+                decisions.append(Case(
+                    *whens, output_field=models.IntegerField()))
+                continue
+
+            # a type-level privilege decides for the resources without
+            # object-level privilege in this layer: deeper layers are not
+            # needed (a type-level allow of the role itself only excludes
+            # its explicit denials)
+            decisions.append(Case(
+                *whens, default=Value(int(type_decision)),
+                output_field=models.IntegerField()))
+            break
+
+        # the nearest layer with a privilege decides (a flat expression,
+        # as deeply nested conditions overflow the SQLite parser)
+        decisions.append(Value(int(app_settings.default_response)))
+        return queryset.annotate(
+            cerberus_resource_id=Cast('pk', models.CharField(max_length=255))
+        ).annotate(**annotations).annotate(
+            cerberus_access=Coalesce(*decisions)
+        ).filter(cerberus_access=1)
+
+    @classmethod
+    def send_accessible_filtered(cls, role_type, role_id, perm,
+                                 resource_type, layers):
+        """
+        Send the ``accessible_filtered`` signal, if it has receivers.
+
+        Args:
+            role_type (str): the string describing the role.
+            role_id (str): the unique ID of the role.
+            perm (str): the access type.
+            resource_type (str): the string describing the resources.
+            layers (int): the number of conveyor layers, or None.
+        """
+        if accessible_filtered.has_listeners(cls):
+            accessible_filtered.send(
+                sender=cls, role_type=role_type, role_id=role_id, perm=perm,
+                resource_type=resource_type, layers=layers)
+
+    @classmethod
+    def layer_type_decisions(cls, depths, perm, resource_type):
+        """
+        Return the type-level decision of each layer, a denial winning.
+
+        Args:
+            depths (dict): depth of each (role_type, role_id) to consider.
+            perm (str): the privilege.
+            resource_type (str): a string describing the type of resource.
+
+        Returns:
+            dict: True or False for each depth having type-level privileges.
+        """
+        type_decisions = {}
+        for p_role_type, p_role_id, authorized in cls.objects.filter(
+                roles_filter(depths), access_type=perm,
+                resource_type=resource_type, resource_id=''
+        ).values_list('role_type', 'role_id', 'authorized'):
+            depth = depths.get((p_role_type, p_role_id))
+            if depth is not None:
+                type_decisions[depth] = authorized and (
+                    type_decisions.get(depth, True))
+        return type_decisions
+
+    @classmethod
+    def authorize_explicit(cls,
+                           role_type,
+                           role_id,
+                           perm,
+                           resource_type,
+                           resource_id=''):
+        """
+        Run an explicit authorization check.
+
+        When the TYPE_PRIVILEGES setting is True, the type-level privilege
+        (empty resource ID) is used if there is no object-level one.
+
+        Args:
+            role_type (str): a string describing the type of role.
+            role_id (str): the role's ID.
+            perm (str): one of the permissions available in Permission class.
+            resource_type (str): a string describing the type of resource.
+            resource_id (str): the resource's ID.
+
+        Returns:
+
+        """
+        resource_ids = [str(resource_id)]
+        if app_settings.type_privileges and resource_id:
+            resource_ids.append('')
+        privileges = dict(cls.objects.filter(
+            role_type=role_type, role_id=role_id,
+            resource_type=resource_type, resource_id__in=resource_ids,
+            access_type=perm).values_list('resource_id', 'authorized'))
+        for resource_id in resource_ids:
+            if resource_id in privileges:
+                return privileges[resource_id]
+        return None
+
+    @classmethod
+    def authorize_implicit(cls,
+                           role_type,
+                           role_id,
+                           perm,
+                           resource_type,
+                           resource_id=''):
+        """
+        Run an implicit authorization check.
+
+        The rules of the role class are looked up in a dispatch table (see
+        ``implicit_rules``), so the role instance is only loaded when a rule
+        applies. The resource instance given to ``can_<perm>`` rules is
+        lazy: it is only loaded if the rule uses it (and then evaluates as
+        false if the resource does not exist).
+
+        Args:
+            role_type (str): a string describing the type of role.
+            role_id (str): the role's ID.
+            perm (str): one of the permissions available in Permission class.
+            resource_type (str): a string describing the type of resource.
+            resource_id (str): the resource's ID.
+
+        Returns:
+            bool: denied(perm) or allowed(perm) found in implicit_perms().
+            None: if ACCESS_CONTROL_IMPLICIT is False,
+                or perm is in ignored_perms.
+        """
+        from .models import Role
+
+        role_class = app_settings.mapping.get_class(role_type) or Role
+        resource_ids, type_rule, perm_rule = cls.implicit_rules(
+            role_class, perm, resource_type)
+        if resource_id and str(resource_id) in resource_ids:
+            attr_name = 'can_%s_%s_%s' % (perm, resource_type, resource_id)
+        elif type_rule:
+            attr_name = type_rule
+        elif perm_rule:
+            attr_name = perm_rule
+        else:
+            return None
+
+        role_instance = app_settings.mapping.get_instance(
+            role_type, role_id)
+        if role_instance is None:
+            return None
+        attr = getattr(role_instance, attr_name)
+        if not callable(attr):
+            return attr
+        if attr_name == type_rule:
+            return attr(resource_id=resource_id)
+        elif attr_name == perm_rule:
+            return attr(
+                instance=SimpleLazyObject(
+                    lambda: app_settings.mapping.get_instance(
+                        resource_type, resource_id)),
+                resource_type=resource_type, resource_id=resource_id)
+        return attr()
+
+    @classmethod
+    def implicit_rules(cls, role_class, perm, resource_type):
+        """
+        Return the implicit rules of a role class for a perm and a type.
+
+        Rules are the ``can_<perm>_<type>_<id>``, ``can_<perm>_<type>`` and
+        ``can_<perm>`` attributes of the class (methods or values), not
+        counting the methods of RoleMixin. The attribute names of a class
+        are read once, and the result is memoized for each perm and type.
+
+        Args:
+            role_class (class): the role class.
+            perm (str): the permission.
+            resource_type (str): the type of resource.
+
+        Returns:
+            tuple: the set of resource IDs having a rule, the name of the
+                resource type rule and the name of the permission rule
+                (or None).
+        """
+        from .models import RoleMixin
+
+        key = (role_class, perm, resource_type)
+        try:
+            return _implicit_rules[key]
+        except KeyError:
+            pass
+        names = _implicit_rule_names.get(role_class)
+        if names is None:
+            names = frozenset(
+                name for name in dir(role_class)
+                if name.startswith('can_') and name not in dir(RoleMixin))
+            _implicit_rule_names[role_class] = names
+        type_rule = 'can_%s_%s' % (perm, resource_type)
+        perm_rule = 'can_%s' % perm
+        rules = (
+            frozenset(name[len(type_rule) + 1:] for name in names
+                      if name.startswith(type_rule + '_')),
+            type_rule if type_rule in names else None,
+            perm_rule if perm_rule in names else None)
+        _implicit_rules[key] = rules
+        return rules
@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+
+"""History module, recording privilege changes and access attempts."""
+
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, models, transaction
+from django.utils import timezone
+from django.utils.translation import ugettext_lazy as _
+
+from .apps import AppSettings
+
+app_settings = AppSettings()
+
+
+class PrivilegeHistory(models.Model):
+    """Privilege history model."""
+
+    CREATE = 'c'
+    # READ = 'r'  # makes no sense here
+    UPDATE = 'u'
+    DELETE = 'd'
+
+    ACTIONS_VERBOSE = {
+        CREATE: 'create',
+        # READ: 'read',
+        UPDATE: 'update',
+        DELETE: 'delete'
+    }
+
+    ACTIONS = (
+        (CREATE, _(ACTIONS_VERBOSE[CREATE])),
+        # (READ, _(ACTIONS_VERBOSE[READ])),
+        (UPDATE, _(ACTIONS_VERBOSE[UPDATE])),
+        (DELETE, _(ACTIONS_VERBOSE[DELETE])),
+    )
+
+    privilege_id = models.PositiveIntegerField(
+        _('Privilege reference ID'), null=True)
+    reference = models.ForeignKey(
+        'RolePrivilege', on_delete=models.SET_NULL, null=True,
+        verbose_name=_('Privilege reference'), related_name='history')
+    action = models.CharField(_('Action'), max_length=1, choices=ACTIONS)
+    datetime = models.DateTimeField(
+        _('Date and time'), auto_now_add=True, db_index=True)
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.SET_NULL,
+        verbose_name=_('User'), related_name='privileges_changes',
+        null=True)
+
+    role_type = models.CharField(_('Role type'), max_length=255, blank=True)
+    role_id = models.CharField(_('Role ID'), max_length=255, blank=True)
+
+    authorized = models.NullBooleanField(_('Authorized'), default=None)
+    access_type = models.CharField(
+        _('Access type'), max_length=255, blank=True)
+
+    resource_type = models.CharField(
+        _('Resource type'), max_length=255, blank=True)
+    resource_id = models.CharField(_('Resource ID'), max_length=255, blank=True)  # noqa
+
+    class Meta:
+        """Meta class for Django."""
+
+        verbose_name = _('Privilege history')
+        verbose_name_plural = _('Privilege history')
+        index_together = (
+            ('role_type', 'role_id', 'datetime'),
+            ('resource_type', 'resource_id', 'datetime'),
+        )
+
+    def __str__(self):
+        """Return the privilege change as text."""
+        from .models import RolePrivilege
+
+        if self.reference:
+            privilege = str(self.reference)
+        else:
+            privilege = RolePrivilege(
+                role_type=self.role_type,
+                role_id=self.role_id,
+                authorized=self.authorized,
+                access_type=self.access_type,
+                resource_type=self.resource_type,
+                resource_id=self.resource_id)
+
+        return '[%s] user %s has %sd privilege <%s: %s>' % (
+            self.datetime, self.user,
+            PrivilegeHistory.ACTIONS_VERBOSE[str(self.action)],
+            self.privilege_id, privilege)
+
+    def update_from_privilege(self, privilege, save=True):
+        """
+        Update this object with given privilege's attributes.
+
+        Args:
+            privilege (RolePrivilege): privilege to update from.
+            save (bool): whether to commit the changes to the database.
+        """
+        self.reference = privilege
+        self.privilege_id = privilege.id
+        self.role_type = privilege.role_type
+        self.role_id = privilege.role_id
+        self.authorized = privilege.authorized
+        self.access_type = privilege.access_type
+        self.resource_type = privilege.resource_type
+        self.resource_id = privilege.resource_id
+        if save:
+            self.save()
+
+    def update_from_range(self, privilege_range, save=True):
+        """
+        Update this object with given range privilege's attributes.
+
+        The resource ID is recorded as ``start-end``, without reference.
+
+        Args:
+            privilege_range (RolePrivilegeRange): range to update from.
+            save (bool): whether to commit the changes to the database.
+        """
+        self.reference = None
+        self.privilege_id = None
+        self.role_type = privilege_range.role_type
+        self.role_id = privilege_range.role_id
+        self.authorized = privilege_range.authorized
+        self.access_type = privilege_range.access_type
+        self.resource_type = privilege_range.resource_type
+        self.resource_id = '%s-%s' % (
+            privilege_range.start, privilege_range.end)
+        if save:
+            self.save()
+
+
+class AccessHistory(models.Model):
+    """Access history model."""
+
+    DEFAULT = 'd'
+    IMPLICIT = 'i'
+    EXPLICIT = 'e'
+
+    RESPONSE_TYPE_VERBOSE = {
+        DEFAULT: 'by default',
+        IMPLICIT: 'implicitly',
+        EXPLICIT: 'explicitly'
+    }
+
+    RESPONSE_TYPE = (
+        (DEFAULT, _(RESPONSE_TYPE_VERBOSE[DEFAULT])),
+        (IMPLICIT, _(RESPONSE_TYPE_VERBOSE[IMPLICIT])),
+        (EXPLICIT, _(RESPONSE_TYPE_VERBOSE[EXPLICIT]))
+    )
+
+    role_type = models.CharField(_('Role type'), max_length=255, blank=True)
+    role_id = models.CharField(_('Role ID'), max_length=255, blank=True)
+
+    # We don't want to store false info, None says "we don't know"
+    response = models.NullBooleanField(_('Response'), default=None)
+    response_type = models.CharField(
+        _('Response type'), max_length=1, choices=RESPONSE_TYPE)
+    access_type = models.CharField(_('Access'), max_length=255)
+
+    resource_type = models.CharField(_('Resource type'), max_length=255)
+    resource_id = models.CharField(_('Resource ID'), max_length=255, blank=True)  # noqa
+
+    datetime = models.DateTimeField(
+        _('Date and time'), default=timezone.now, db_index=True)
+
+    conveyor_type = models.CharField(_('Conveyor type'), max_length=255, blank=True)  # noqa
+    conveyor_id = models.CharField(_('Conveyor ID'), max_length=255, blank=True)  # noqa
+
+    class Meta:
+        """Meta class for Django."""
+
+        verbose_name = _('Access history')
+        verbose_name_plural = _('Access history')
+        index_together = (
+            ('role_type', 'role_id', 'datetime'),
+            ('resource_type', 'resource_id', 'datetime'),
+        )
+
+    def __str__(self):
+        """Return the access attempt as text."""
+        inherited = ''
+
+        if self.role_id:
+            role = '%s %s' % (self.role_type, self.role_id)
+        else:
+            role = self.role_type
+
+        if self.conveyor_type:
+            if self.conveyor_id:
+                inherited = ' (inherited from %s %s)' % (
+                    self.conveyor_type, self.conveyor_id)
+            else:
+                inherited = self.conveyor_type
+
+        authorized = 'authorized' if self.response else 'unauthorized'
+        string = '[%s] %s was %s %s to %s %s %s' % (
+            self.datetime, role,
+            AccessHistory.RESPONSE_TYPE_VERBOSE[str(self.response_type)],
+            authorized, self.access_type, self.resource_type, self.resource_id)
+        if inherited:
+            return string + inherited
+        return string
+
+
+class AccessRollup(models.Model):
+    """
+    Access rollup model.
+
+    Count identical access attempts per time bucket, instead of storing one
+    AccessHistory row per attempt. Used when the ACCESS_LOG_ROLLUP setting
+    is True.
+    """
+
+    bucket = models.DateTimeField(_('Time bucket'), db_index=True)
+
+    role_type = models.CharField(_('Role type'), max_length=255, blank=True)
+    role_id = models.CharField(_('Role ID'), max_length=255, blank=True)
+
+    response = models.NullBooleanField(_('Response'), default=None)
+    response_type = models.CharField(
+        _('Response type'), max_length=1,
+        choices=AccessHistory.RESPONSE_TYPE)
+    access_type = models.CharField(_('Access'), max_length=255)
+
+    resource_type = models.CharField(_('Resource type'), max_length=255)
+    resource_id = models.CharField(_('Resource ID'), max_length=255, blank=True)  # noqa
+
+    conveyor_type = models.CharField(_('Conveyor type'), max_length=255, blank=True)  # noqa
+    conveyor_id = models.CharField(_('Conveyor ID'), max_length=255, blank=True)  # noqa
+
+    count = models.PositiveIntegerField(_('Count'), default=0)
+
+    KEY_FIELDS = (
+        'bucket', 'role_type', 'role_id', 'response', 'response_type',
+        'access_type', 'resource_type', 'resource_id',
+        'conveyor_type', 'conveyor_id')
+
+    class Meta:
+        """Meta class for Django."""
+
+        verbose_name = _('Access rollup')
+        verbose_name_plural = _('Access rollups')
+        unique_together = (
+            'bucket', 'role_type', 'role_id', 'response', 'response_type',
+            'access_type', 'resource_type', 'resource_id',
+            'conveyor_type', 'conveyor_id'
+        )
+
+    def __str__(self):
+        """Return the rollup as text."""
+        return '[%s] %s x %s' % (self.bucket, self.count, AccessHistory(
+            role_type=self.role_type, role_id=self.role_id,
+            response=self.response, response_type=self.response_type,
+            access_type=self.access_type, resource_type=self.resource_type,
+            resource_id=self.resource_id, datetime=self.bucket,
+            conveyor_type=self.conveyor_type, conveyor_id=self.conveyor_id))
+
+    @staticmethod
+    def get_bucket(moment, interval):
+        """
+        Return the start of the time bucket containing a datetime.
+
+        Args:
+            moment (datetime): an aware or naive datetime.
+            interval (int): the size of buckets in seconds.
+
+        Returns:
+            datetime: the start of the bucket.
+        """
+        midnight = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+        seconds = int((moment - midnight).total_seconds())
+        return midnight + timedelta(seconds=seconds - seconds % interval)
+
+    @staticmethod
+    def record(attempts, interval=None):
+        """
+        Count access attempts in their rollups.
+
+        Attempts are first aggregated in memory. The existing rollups of
+        the batch are read with one query, incremented with one UPDATE per
+        distinct increment, and the missing ones are created with one bulk
+        insert. If a concurrent writer created some of them first, they are
+        incremented or created one by one instead.
+
+        Args:
+            attempts (list): AccessHistory instances.
+            interval (int): the size of buckets in seconds, defaults to
+                the ACCESS_LOG_ROLLUP_INTERVAL setting.
+        """
+        if interval is None:
+            interval = app_settings.access_log_rollup_interval
+
+        counts = OrderedDict()
+        for attempt in attempts:
+            key = (AccessRollup.get_bucket(attempt.datetime, interval),) + \
+                tuple(getattr(attempt, f) for f in AccessRollup.KEY_FIELDS[1:])
+            counts[key] = counts.get(key, 0) + 1
+        if not counts:
+            return
+
+        with transaction.atomic():
+            existing = AccessRollup.find(counts)
+            by_increment = {}
+            missing = []
+            for key, count in counts.items():
+                if key in existing:
+                    by_increment.setdefault(count, []).append(existing[key])
+                else:
+                    missing.append(AccessRollup(count=count, **dict(
+                        zip(AccessRollup.KEY_FIELDS, key))))
+            for count, ids in sorted(by_increment.items()):
+                AccessRollup.objects.filter(id__in=ids).update(
+                    count=models.F('count') + count)
+            if missing:
+                AccessRollup.create_many(missing)
+
+    @staticmethod
+    def find(keys):
+        """
+        Return the IDs of the existing rollups of several keys.
+
+        Args:
+            keys (iterable): tuples of values of ``KEY_FIELDS``.
+
+        Returns:
+            dict: the ID of each key found.
+        """
+        keys = set(keys)
+        rows = AccessRollup.objects.filter(
+            bucket__in={key[0] for key in keys},
+            role_id__in={key[2] for key in keys},
+            resource_id__in={key[7] for key in keys}
+        ).values_list('id', *AccessRollup.KEY_FIELDS)
+        return {row[1:]: row[0] for row in rows if row[1:] in keys}
+
+    @staticmethod
+    def create_many(rollups):
+        """
+        Create rollups with one bulk insert, or one by one on conflict.
+
+        Args:
+            rollups (list): unsaved AccessRollup instances.
+        """
+        try:
+            with transaction.atomic():
+                AccessRollup.objects.bulk_create(rollups)
+        except IntegrityError:
+            for rollup in rollups:
+                AccessRollup.increment(rollup)
+
+    @staticmethod
+    def increment(rollup):
+        """
+        Increment a rollup by the count of an unsaved one, or create it.
+
+        Args:
+            rollup (AccessRollup): an unsaved instance.
+        """
+        lookup = {f: getattr(rollup, f) for f in AccessRollup.KEY_FIELDS}
+        if AccessRollup.objects.filter(**lookup).update(
+                count=models.F('count') + rollup.count):
+            return
+        try:
+            with transaction.atomic():
+                rollup.save()
+        except IntegrityError:
+            AccessRollup.objects.filter(**lookup).update(
+                count=models.F('count') + rollup.count)
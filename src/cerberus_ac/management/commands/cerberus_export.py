@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+"""Command to export privileges and hierarchy links."""
+
+import io
+
+from django.core.management.base import BaseCommand
+
+from ...transfer import (
+    FORMATS, HIERARCHY, PRIVILEGE, RANGE, iter_records, write_records)
+
+
+class Command(BaseCommand):
+    """Export privileges, ranges and links as JSON lines or CSV."""
+
+    help = ('Export privileges, privilege ranges and hierarchy links as '
+            'JSON lines or CSV, '
+            'reading the database one chunk at a time.')
+
+    def add_arguments(self, parser):
+        """Add the arguments of the command."""
+        parser.add_argument(
+            '--format', choices=FORMATS, default='jsonl',
+            help='Output format.')
+        parser.add_argument(
+            '--model', choices=(PRIVILEGE, RANGE, HIERARCHY), action='append',
+            dest='models',
+            help='Only export this model (can be repeated).')
+        parser.add_argument(
+            '--output', default='-',
+            help='Output file, default to the standard output.')
+        parser.add_argument(
+            '--chunk-size', type=int, default=2000,
+            help='Number of rows read per query.')
+
+    def handle(self, *args, **options):
+        """Export the privileges, ranges and links."""
+        records = iter_records(
+            options['models'] or (PRIVILEGE, RANGE, HIERARCHY),
+            options['chunk_size'])
+        if options['output'] == '-':
+            write_records(records, self.stdout, options['format'])
+            return
+        with io.open(options['output'], 'w', newline='') as stream:
+            count = write_records(records, stream, options['format'])
+        self.stdout.write('Exported %d records to %s.' % (
+            count, options['output']))
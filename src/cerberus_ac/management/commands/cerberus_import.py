@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+"""Command to import privileges and hierarchy links."""
+
+import io
+import sys
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from ...apps import AppSettings
+from ...models import RolePrivilegeRange
+from ...transfer import (
+    FORMATS, HIERARCHY, PRIVILEGE, RANGE, import_records, read_records)
+
+app_settings = AppSettings()
+
+
+class Command(BaseCommand):
+    """Import privileges, ranges and links from JSON lines or CSV."""
+
+    help = ('Import privileges, privilege ranges and hierarchy links from '
+            'JSON lines or CSV, in chunked transactions. A null authorized '
+            'value forgets the privilege, a true forget value removes the '
+            'hierarchy link.')
+
+    def add_arguments(self, parser):
+        """Add the arguments of the command."""
+        parser.add_argument(
+            'input', nargs='?',
+            help='Input file, default to the standard input (or to no '
+                 'input with --coalesce), - for the standard input.')
+        parser.add_argument(
+            '--format', choices=FORMATS, default='jsonl',
+            help='Input format.')
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of records applied per transaction.')
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only report the changes (one per line with -v 2).')
+        parser.add_argument(
+            '--user',
+            help='Username recorded in the privileges history.')
+        parser.add_argument(
+            '--no-history', action='store_false', dest='log',
+            help='Do not record the changes in the privileges history.')
+        parser.add_argument(
+            '--coalesce', type=int, metavar='MIN_SIZE',
+            help='After the import, replace runs of at least MIN_SIZE '
+                 'privileges on consecutive integer resource IDs with '
+                 'range privileges.')
+
+    def handle(self, *args, **options):
+        """Import the records, then coalesce if asked."""
+        user = self.get_user(options['user']) if options['user'] else None
+
+        report = None
+        if options['dry_run'] and options['verbosity'] > 1:
+            report = self.stdout.write
+
+        if options['coalesce'] and not app_settings.range_privileges:
+            raise CommandError(
+                '--coalesce requires the RANGE_PRIVILEGES setting.')
+
+        if options['input'] is None and options['coalesce']:
+            counts = None
+        elif options['input'] in (None, '-'):
+            counts = self.run(sys.stdin, user, report, options)
+        else:
+            with io.open(options['input'], newline='') as stream:
+                counts = self.run(stream, user, report, options)
+
+        if counts is not None:
+            verb = 'Would change' if options['dry_run'] else 'Changed'
+            for name, label in ((PRIVILEGE, 'privileges'),
+                                (RANGE, 'privilege ranges'),
+                                (HIERARCHY, 'hierarchy links')):
+                self.stdout.write('%s %s: %s.' % (
+                    verb, label, self.format_counts(counts[name])))
+
+        if options['coalesce'] and not options['dry_run']:
+            created, deleted = RolePrivilegeRange.coalesce(
+                options['coalesce'], user=user, log=options['log'])
+            self.stdout.write(
+                'Coalesced %d privileges into %d ranges.' % (
+                    deleted, created))
+
+    @staticmethod
+    def get_user(username):
+        """Return the user with the given username."""
+        user_model = get_user_model()
+        try:
+            return user_model.objects.get(**{
+                user_model.USERNAME_FIELD: username})
+        except user_model.DoesNotExist:
+            raise CommandError('Unknown user %s.' % username)
+
+    def run(self, stream, user, report, options):
+        """Import the records of a stream."""
+        records = (record for _, record in read_records(
+            stream, options['format']))
+        try:
+            return import_records(
+                records, user=user, log=options['log'],
+                dry_run=options['dry_run'],
+                batch_size=options['batch_size'], report=report)
+        except ValueError as error:
+            raise CommandError('Invalid record, %s.' % error)
+
+    @staticmethod
+    def format_counts(counts):
+        """Return the counts as text."""
+        return ', '.join('%d %s' % (counts[key], key) for key in (
+            'created', 'updated', 'unchanged', 'deleted') if key in counts)
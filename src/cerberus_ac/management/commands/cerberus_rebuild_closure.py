@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+
+"""Command to rebuild the role hierarchy closure."""
+
+from django.core.management.base import BaseCommand
+
+from ...cache import invalidate_decisions
+from ...models import RoleHierarchyClosure
+
+
+class Command(BaseCommand):
+    """Rebuild the role hierarchy closure from the RoleHierarchy rows."""
+
+    help = 'Rebuild the role hierarchy closure from the RoleHierarchy rows.'
+
+    def add_arguments(self, parser):
+        """Add the arguments of the command."""
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of closure rows inserted per query.')
+
+    def handle(self, *args, **options):
+        """Rebuild the closure and invalidate decisions."""
+        count = RoleHierarchyClosure.rebuild(options['batch_size'])
+        invalidate_decisions()
+        self.stdout.write('Rebuilt role hierarchy closure: %d rows.' % count)
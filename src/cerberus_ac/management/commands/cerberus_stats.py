@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+"""Command to dump a snapshot of the authorization metrics."""
+
+from django.core.management.base import BaseCommand
+
+from ...access_log import get_access_log_sink
+from ...cache import get_rule_cache_stats
+from ...metrics import get_exporter, get_snapshot, registry
+
+
+class Command(BaseCommand):
+    """Dump a snapshot of the authorization metrics."""
+
+    help = ('Dump a snapshot of the authorization metrics, merged from '
+            'every process when the METRICS_CACHE setting is set.')
+
+    def add_arguments(self, parser):
+        """Add the arguments of the command."""
+        parser.add_argument(
+            '--format', default='json',
+            help='Exporter: json, prometheus or the Python path of a '
+                 'function receiving the snapshot.')
+        parser.add_argument(
+            '--reset', action='store_true',
+            help='Reset the metrics of this process after the dump.')
+
+    def handle(self, *args, **options):
+        """Dump the snapshot, then reset if asked."""
+        exporter = get_exporter(options['format'])
+        snapshot = get_snapshot()
+        if options['format'] == 'json':
+            snapshot = {
+                'metrics': snapshot,
+                'access_log': get_access_log_sink().stats(),
+                'implicit_rules': get_rule_cache_stats(),
+            }
+        self.stdout.write(exporter(snapshot))
+        if options['reset']:
+            registry.reset()
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+
+"""Command to warm up the access control caches."""
+
+from django.core.management.base import BaseCommand
+
+from ...warmup import warmup
+
+
+class Command(BaseCommand):
+    """Warm up the mapping, hierarchy and decision caches."""
+
+    help = ('Compile the mapping, load the role hierarchy in memory and '
+            'compute the decisions of the most frequent accesses.')
+
+    def add_arguments(self, parser):
+        """Add the arguments of the command."""
+        parser.add_argument(
+            '--top', type=int, default=0,
+            help='Number of most frequent accesses to decide.')
+        parser.add_argument(
+            '--days', type=int, default=7,
+            help='Count the accesses of the last days.')
+
+    def handle(self, *args, **options):
+        """Warm the caches up."""
+        timings = warmup(options['top'], options['days'], self.stdout.write)
+        self.stdout.write('Warmed up in %.3fs.' % sum(timings.values()))
@@ -0,0 +1,520 @@
+# -*- coding: utf-8 -*-
+
+"""
+Metrics module providing in-process counters and histograms.
+
+Metrics are collected from the ``authorization_checked``,
+``authorization_bulk_checked`` and ``accessible_filtered`` signals and the
+access log writes when the METRICS setting is True. Snapshots of the
+registry can be exported as JSON or in the Prometheus text format, and
+published to the Django cache named by the METRICS_CACHE setting, so that
+the snapshots of every process can be merged. Each process registers its
+snapshot key in one of ``MAX_PROCESSES`` slots, taken with the atomic
+``add`` of the cache and expiring with the snapshot.
+"""
+
+import json
+import os
+import socket
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+
+from django.core.cache import caches
+
+from .apps import AppSettings, _import
+
+app_settings = AppSettings()
+
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+    2.5, 5.0)
+DEPTH_BUCKETS = (0, 1, 2, 3, 4, 5, 10, 20, 50)
+SIZE_BUCKETS = (1, 10, 50, 100, 500, 1000, 5000, 10000)
+
+PROCESSES_KEY = 'cerberus_ac:metrics:processes'
+MAX_PROCESSES = 256
+
+
+class Metric(object):
+    """Base class of metrics, storing one value per set of label values."""
+
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        """
+        Initialization method.
+
+        Args:
+            name (str): the name of the metric.
+            help_text (str): the description of the metric.
+            labels (tuple): the names of the labels.
+        """
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        """Return the label values of a sample, in label order."""
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def snapshot(self):
+        """
+        Return a copy of the metric.
+
+        Returns:
+            dict: type, help, labels and samples, a list of
+                (label values, value) pairs.
+        """
+        with self.lock:
+            samples = sorted(self.values.items())
+        return {'type': self.kind, 'help': self.help_text,
+                'labels': list(self.labels),
+                'samples': [[list(k), v] for k, v in samples]}
+
+    def reset(self):
+        """Forget every value."""
+        with self.lock:
+            self.values.clear()
+
+
+class Counter(Metric):
+    """Metric counting events."""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """
+        Increment the counter of the given labels.
+
+        Args:
+            amount (int): the increment.
+            **labels: the label values.
+        """
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Histogram(Metric):
+    """Metric counting observations in buckets."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        """
+        Initialization method.
+
+        Args:
+            name (str): the name of the metric.
+            help_text (str): the description of the metric.
+            labels (tuple): the names of the labels.
+            buckets (tuple): the sorted upper bounds of the buckets.
+        """
+        super(Histogram, self).__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        """
+        Count an observation.
+
+        Args:
+            value (float): the observed value.
+            **labels: the label values.
+        """
+        key = self.key(labels)
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = {
+                    'counts': [0] * (len(self.buckets) + 1),
+                    'sum': 0, 'count': 0}
+            state['counts'][index] += 1
+            state['sum'] += value
+            state['count'] += 1
+
+    def snapshot(self):
+        """
+        Return a copy of the metric.
+
+        Returns:
+            dict: as ``Metric.snapshot``, plus the buckets. Values are dicts
+                with the number of observations in each bucket (and above
+                the last one), their sum and their count.
+        """
+        with self.lock:
+            samples = sorted((k, {'counts': list(v['counts']),
+                                  'sum': v['sum'], 'count': v['count']})
+                             for k, v in self.values.items())
+        return {'type': self.kind, 'help': self.help_text,
+                'labels': list(self.labels), 'buckets': list(self.buckets),
+                'samples': [[list(k), v] for k, v in samples]}
+
+
+class MetricsRegistry(object):
+    """Registry of named metrics."""
+
+    def __init__(self):
+        """Initialization method."""
+        self.metrics = OrderedDict()
+        self.published = 0
+        self.slot = None
+
+    def register(self, metric):
+        """Register a metric and return it."""
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help_text, labels=()):
+        """Register a counter and return it."""
+        return self.register(Counter(name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        """Register a histogram and return it."""
+        return self.register(Histogram(name, help_text, labels, buckets))
+
+    def snapshot(self):
+        """Return a snapshot of every metric, by name."""
+        return OrderedDict(
+            (name, metric.snapshot()) for name, metric in self.metrics.items())
+
+    def reset(self):
+        """Forget the values of every metric."""
+        for metric in self.metrics.values():
+            metric.reset()
+
+
+registry = MetricsRegistry()
+
+checks = registry.counter(
+    'cerberus_checks_total', 'Authorization checks.',
+    ('perm', 'resource_type'))
+check_seconds = registry.histogram(
+    'cerberus_check_seconds', 'Duration of the authorization checks.',
+    ('perm', 'resource_type'))
+decisions = registry.counter(
+    'cerberus_decisions_total', 'Decisions of the authorization checks.',
+    ('response_type', 'response'))
+bulk_check_seconds = registry.histogram(
+    'cerberus_bulk_check_seconds', 'Duration of the bulk authorizations.')
+bulk_check_size = registry.histogram(
+    'cerberus_bulk_check_size', 'Number of checks of the bulk authorizations.',
+    buckets=SIZE_BUCKETS)
+accessible_filters = registry.counter(
+    'cerberus_accessible_filters_total',
+    'Querysets filtered on the privileges of a role.',
+    ('perm', 'resource_type'))
+cache_lookups = registry.counter(
+    'cerberus_decision_cache_total', 'Decisions found in caches or not.',
+    ('result', ))
+hierarchy_layers = registry.histogram(
+    'cerberus_hierarchy_layers', 'Number of conveyor layers of the roles.',
+    buckets=DEPTH_BUCKETS)
+decision_depth = registry.histogram(
+    'cerberus_decision_depth', 'Depth of the conveyor giving the decision.',
+    buckets=DEPTH_BUCKETS)
+access_log_flush_size = registry.histogram(
+    'cerberus_access_log_flush_size', 'Number of access attempts written.',
+    buckets=SIZE_BUCKETS)
+
+
+def record_check(perm, resource_type, response, response_type, cache_hit,
+                 timings, layers, depth, **kwargs):
+    """
+    Record the metrics of an authorization check.
+
+    Receiver of the ``authorization_checked`` signal, connected when the
+    METRICS setting is True.
+    """
+    checks.inc(perm=perm, resource_type=resource_type)
+    check_seconds.observe(
+        timings['total'], perm=perm, resource_type=resource_type)
+    decisions.inc(response_type=response_type, response=response)
+    cache_lookups.inc(result='hit' if cache_hit else 'miss')
+    if layers is not None:
+        hierarchy_layers.observe(layers)
+    if depth is not None:
+        decision_depth.observe(depth)
+    publish_if_due()
+
+
+def record_bulk_check(results, cache_hits, timings, layers, depths,
+                      **kwargs):
+    """
+    Record the metrics of a bulk authorization.
+
+    Receiver of the ``authorization_bulk_checked`` signal, connected when
+    the METRICS setting is True. Counters are incremented once per label
+    values, by the number of checks having them.
+    """
+    by_type, by_decision = OrderedDict(), OrderedDict()
+    for (perm, resource_type, _), decision in results.items():
+        by_type[perm, resource_type] = by_type.get(
+            (perm, resource_type), 0) + 1
+        by_decision[decision[1], decision[0]] = by_decision.get(
+            (decision[1], decision[0]), 0) + 1
+    for (perm, resource_type), count in by_type.items():
+        checks.inc(count, perm=perm, resource_type=resource_type)
+    for (response_type, response), count in by_decision.items():
+        decisions.inc(
+            count, response_type=response_type, response=response)
+    cache_lookups.inc(cache_hits, result='hit')
+    cache_lookups.inc(len(results) - cache_hits, result='miss')
+    bulk_check_seconds.observe(timings['total'])
+    bulk_check_size.observe(len(results))
+    if layers is not None:
+        hierarchy_layers.observe(layers)
+    for depth in depths.values():
+        if depth is not None:
+            decision_depth.observe(depth)
+    publish_if_due()
+
+
+def record_filter(perm, resource_type, layers, **kwargs):
+    """
+    Record the metrics of a queryset filtered on the privileges of a role.
+
+    Receiver of the ``accessible_filtered`` signal, connected when the
+    METRICS setting is True.
+    """
+    accessible_filters.inc(perm=perm, resource_type=resource_type)
+    if layers is not None:
+        hierarchy_layers.observe(layers)
+    publish_if_due()
+
+
+def record_flush(attempts):
+    """
+    Record the size of an access log write.
+
+    Args:
+        attempts (list): the written AccessHistory instances.
+    """
+    access_log_flush_size.observe(len(attempts))
+
+
+def process_key():
+    """Return the key identifying this process in the metrics cache."""
+    return 'cerberus_ac:metrics:%s:%d' % (socket.gethostname(), os.getpid())
+
+
+def slot_key(slot):
+    """Return the key of a process slot in the metrics cache."""
+    return '%s:%d' % (PROCESSES_KEY, slot)
+
+
+def publish(cache=None):
+    """
+    Store the snapshot of this process in the metrics cache.
+
+    The first time, or when its slot expired, the process takes the first
+    free slot with ``cache.add``: concurrent processes never overwrite
+    each other's registration, and the slots of dead processes expire and
+    are reused. When every slot is taken, the snapshot is not collected.
+
+    Args:
+        cache (BaseCache): a Django cache, default to the one named by the
+            METRICS_CACHE setting.
+    """
+    if cache is None:
+        cache = caches[app_settings.metrics_cache]
+    timeout = app_settings.metrics_publish_interval * 10
+    key = process_key()
+    cache.set(key, {'time': time.time(), 'metrics': registry.snapshot()},
+              timeout)
+    if registry.slot is not None and (
+            cache.get(slot_key(registry.slot)) == key):
+        cache.set(slot_key(registry.slot), key, timeout)
+    else:
+        registry.slot = take_slot(cache, key, timeout)
+    registry.published = time.time()
+
+
+def take_slot(cache, key, timeout):
+    """
+    Take the first free process slot in the metrics cache.
+
+    Args:
+        cache (BaseCache): a Django cache.
+        key (str): the key of the process snapshot.
+        timeout (int): expiry of the slot, in seconds.
+
+    Returns:
+        int: the slot number, or None if every slot is taken.
+    """
+    keys = [slot_key(i) for i in range(MAX_PROCESSES)]
+    taken = cache.get_many(keys)
+    for slot, candidate in enumerate(keys):
+        if candidate not in taken and cache.add(candidate, key, timeout):
+            return slot
+    return None
+
+
+def publish_if_due():
+    """Publish the snapshot of this process if the interval is elapsed."""
+    if app_settings.metrics_cache and (
+            time.time() - registry.published >=
+            app_settings.metrics_publish_interval):
+        publish()
+
+
+def merge(snapshots):
+    """
+    Merge the snapshots of several processes.
+
+    Args:
+        snapshots (list): snapshots returned by ``MetricsRegistry.snapshot``.
+
+    Returns:
+        dict: the merged snapshot.
+    """
+    merged = OrderedDict()
+    for snapshot in snapshots:
+        for name, metric in snapshot.items():
+            target = merged.setdefault(
+                name, dict(metric, samples=OrderedDict()))
+            for label_values, value in metric['samples']:
+                key = tuple(label_values)
+                current = target['samples'].get(key)
+                if current is None:
+                    target['samples'][key] = value
+                elif metric['type'] == 'histogram':
+                    target['samples'][key] = {
+                        'counts': [a + b for a, b in zip(
+                            current['counts'], value['counts'])],
+                        'sum': current['sum'] + value['sum'],
+                        'count': current['count'] + value['count']}
+                else:
+                    target['samples'][key] = current + value
+    for metric in merged.values():
+        metric['samples'] = [[list(k), v]
+                             for k, v in sorted(metric['samples'].items())]
+    return merged
+
+
+def collect(cache=None):
+    """
+    Return the merged snapshot of every process found in the metrics cache.
+
+    Args:
+        cache (BaseCache): a Django cache, default to the one named by the
+            METRICS_CACHE setting.
+
+    Returns:
+        dict: the merged snapshot.
+    """
+    if cache is None:
+        cache = caches[app_settings.metrics_cache]
+    processes = cache.get_many([slot_key(i) for i in range(MAX_PROCESSES)])
+    published = cache.get_many(sorted(set(processes.values())))
+    return merge(published[key]['metrics'] for key in sorted(published))
+
+
+def get_snapshot():
+    """Return the merged snapshot of every process, or of this process."""
+    if app_settings.metrics_cache:
+        publish()
+        return collect()
+    return registry.snapshot()
+
+
+def quantile(buckets, counts, rank):
+    """
+    Estimate a quantile of a histogram, as the upper bound of its bucket.
+
+    Args:
+        buckets (list): the upper bounds of the buckets.
+        counts (list): the number of observations in each bucket.
+        rank (float): the quantile, between 0 and 1.
+
+    Returns:
+        float: the estimated quantile (None when there is no observation,
+            infinity above the last bucket).
+    """
+    total = sum(counts)
+    if not total:
+        return None
+    seen = 0
+    for bound, count in zip(list(buckets) + [float('inf')], counts):
+        seen += count
+        if seen >= rank * total:
+            return bound
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace(
+        '\n', r'\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, _escape(v)) for k, v in pairs)
+
+
+def to_prometheus(snapshot):
+    """
+    Export a snapshot in the Prometheus text format.
+
+    Args:
+        snapshot (dict): a snapshot returned by ``get_snapshot``.
+
+    Returns:
+        str: the metrics, one sample per line.
+    """
+    lines = []
+    for name, metric in snapshot.items():
+        lines.append('# HELP %s %s' % (name, metric['help']))
+        lines.append('# TYPE %s %s' % (name, metric['type']))
+        for values, value in metric['samples']:
+            if metric['type'] != 'histogram':
+                lines.append('%s%s %s' % (
+                    name, _labels(metric['labels'], values), value))
+                continue
+            cumulative = 0
+            bounds = [repr(float(b)) for b in metric['buckets']] + ['+Inf']
+            for bound, count in zip(bounds, value['counts']):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (name, _labels(
+                    metric['labels'], values, [('le', bound)]), cumulative))
+            lines.append('%s_sum%s %r' % (
+                name, _labels(metric['labels'], values), value['sum']))
+            lines.append('%s_count%s %d' % (
+                name, _labels(metric['labels'], values), value['count']))
+    return '\n'.join(lines) + '\n'
+
+
+def to_json(snapshot):
+    """
+    Export a snapshot as JSON.
+
+    Args:
+        snapshot (dict): a snapshot returned by ``get_snapshot``.
+
+    Returns:
+        str: the JSON snapshot.
+    """
+    return json.dumps(snapshot, indent=2)
+
+
+EXPORTERS = {'prometheus': to_prometheus, 'json': to_json}
+
+
+def get_exporter(name):
+    """
+    Return an exporter given its name or the Python path of a function.
+
+    Args:
+        name (str): ``prometheus``, ``json`` or a Python path.
+
+    Returns:
+        callable: function receiving a snapshot and returning a string.
+    """
+    if name in EXPORTERS:
+        return EXPORTERS[name]
+    return _import(name)
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 17:38
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+from cerberus_ac.utils import chunked, transitive_closure
+
+
+def build_closure(apps, schema_editor):
+    RoleHierarchy = apps.get_model('cerberus_ac', 'RoleHierarchy')
+    RoleHierarchyClosure = apps.get_model(
+        'cerberus_ac', 'RoleHierarchyClosure')
+    links = (((a_type, a_id), (b_type, b_id))
+             for a_type, a_id, b_type, b_id in
+             RoleHierarchy.objects.values_list(
+                 'role_type_a', 'role_id_a', 'role_type_b', 'role_id_b'
+             ).iterator())
+    rows = (RoleHierarchyClosure(
+        descendant_type=descendant[0], descendant_id=descendant[1],
+        ancestor_type=ancestor[0], ancestor_id=ancestor[1], depth=depth)
+        for descendant, ancestor, depth in transitive_closure(links))
+    for chunk in chunked(rows, 1000):
+        RoleHierarchyClosure.objects.bulk_create(chunk)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cerberus_ac', '0002_auto_20170515_0413'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoleHierarchyClosure',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ancestor_type', models.CharField(max_length=255, verbose_name='Ancestor type')),
+                ('ancestor_id', models.CharField(blank=True, max_length=255, verbose_name='Ancestor ID')),
+                ('descendant_type', models.CharField(max_length=255, verbose_name='Descendant type')),
+                ('descendant_id', models.CharField(blank=True, max_length=255, verbose_name='Descendant ID')),
+                ('depth', models.PositiveIntegerField(verbose_name='Depth')),
+            ],
+            options={
+                'verbose_name': 'Role hierarchy closure',
+                'verbose_name_plural': 'Role hierarchy closure',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='rolehierarchyclosure',
+            unique_together=set([('descendant_type', 'descendant_id', 'ancestor_type', 'ancestor_id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='rolehierarchyclosure',
+            index_together=set([('ancestor_type', 'ancestor_id')]),
+        ),
+        migrations.RunPython(build_closure, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 17:42
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cerberus_ac', '0003_role_hierarchy_closure'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccessRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.DateTimeField(db_index=True, verbose_name='Time bucket')),
+                ('role_type', models.CharField(blank=True, max_length=255, verbose_name='Role type')),
+                ('role_id', models.CharField(blank=True, max_length=255, verbose_name='Role ID')),
+                ('response', models.NullBooleanField(default=None, verbose_name='Response')),
+                ('response_type', models.CharField(choices=[('d', 'by default'), ('i', 'implicitly'), ('e', 'explicitly')], max_length=1, verbose_name='Response type')),
+                ('access_type', models.CharField(max_length=255, verbose_name='Access')),
+                ('resource_type', models.CharField(max_length=255, verbose_name='Resource type')),
+                ('resource_id', models.CharField(blank=True, max_length=255, verbose_name='Resource ID')),
+                ('conveyor_type', models.CharField(blank=True, max_length=255, verbose_name='Conveyor type')),
+                ('conveyor_id', models.CharField(blank=True, max_length=255, verbose_name='Conveyor ID')),
+                ('count', models.PositiveIntegerField(default=0, verbose_name='Count')),
+            ],
+            options={
+                'verbose_name': 'Access rollup',
+                'verbose_name_plural': 'Access rollups',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='accessrollup',
+            unique_together=set([('bucket', 'role_type', 'role_id', 'response', 'response_type', 'access_type', 'resource_type', 'resource_id', 'conveyor_type', 'conveyor_id')]),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 17:43
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cerberus_ac', '0004_access_rollup'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='accesshistory',
+            name='datetime',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name='Date and time'),
+        ),
+        migrations.AlterField(
+            model_name='privilegehistory',
+            name='datetime',
+            field=models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='Date and time'),
+        ),
+        migrations.AlterField(
+            model_name='roleprivilege',
+            name='creation_date',
+            field=models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='Created'),
+        ),
+        migrations.AlterField(
+            model_name='roleprivilege',
+            name='modification_date',
+            field=models.DateTimeField(auto_now=True, db_index=True, verbose_name='Last modified'),
+        ),
+        migrations.AlterIndexTogether(
+            name='accesshistory',
+            index_together=set([('role_type', 'role_id', 'datetime'), ('resource_type', 'resource_id', 'datetime')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='privilegehistory',
+            index_together=set([('role_type', 'role_id', 'datetime'), ('resource_type', 'resource_id', 'datetime')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='rolehierarchy',
+            index_together=set([('role_type_b', 'role_id_b', 'role_type_a', 'role_id_a')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='roleprivilege',
+            index_together=set([('role_type', 'role_id', 'resource_type', 'access_type', 'authorized', 'resource_id'), ('resource_type', 'resource_id', 'access_type', 'role_type', 'role_id', 'authorized')]),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 18:14
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cerberus_ac', '0005_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RolePrivilegeRange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('role_type', models.CharField(max_length=255, verbose_name='Role type')),
+                ('role_id', models.CharField(blank=True, max_length=255, verbose_name='Role ID')),
+                ('authorized', models.BooleanField(default=False, verbose_name='Authorized')),
+                ('access_type', models.CharField(max_length=255, verbose_name='Access type')),
+                ('resource_type', models.CharField(max_length=255, verbose_name='Resource type')),
+                ('start', models.BigIntegerField(verbose_name='First resource ID')),
+                ('end', models.BigIntegerField(verbose_name='Last resource ID')),
+                ('creation_date', models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='Created')),
+                ('modification_date', models.DateTimeField(auto_now=True, db_index=True, verbose_name='Last modified')),
+            ],
+            options={
+                'verbose_name': 'Role privilege range',
+                'verbose_name_plural': 'Role privilege ranges',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='roleprivilegerange',
+            unique_together=set([('role_type', 'role_id', 'access_type', 'resource_type', 'start', 'end')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='roleprivilegerange',
+            index_together=set([('role_type', 'role_id', 'resource_type', 'access_type', 'start', 'end')]),
+        ),
+    ]
@@ -7,18 +7,27 @@ Models and mixins for access control.
 - Role
 - RoleHierarchy
 - RolePrivilege
-- PrivilegeHistory
-- AccessHistory
+
+The closure, privilege ranges, history and authorization engine live in
+their own modules, and are imported here so that Django registers them.
 """
 
-from django.conf import settings
-from django.db import models
-from django.db.models import QuerySet, Q
-from django.utils import timezone
+from django.db import connections, models, router, transaction
+from django.db.models import Q, QuerySet
 from django.utils.translation import ugettext_lazy as _
 
 from .apps import AppSettings
-from .utils import get_resource_type_and_id, get_role_type_and_id
+from .cache import get_hierarchy_index
+from .closure import RoleHierarchyClosure
+from .decisions import (  # noqa
+    AuthorizationMixin, _implicit_rule_names, _implicit_rules,
+    accessible_filtered, authorization_bulk_checked, authorization_checked)
+from .history import AccessHistory, AccessRollup, PrivilegeHistory  # noqa
+from .querysets import RolePrivilegeQuerySet
+from .ranges import RolePrivilegeRange, split_ranges  # noqa
+from .utils import (
+    chunked, get_resource_type_and_id, get_role_type_and_id, roles_filter,
+    supports_recursive_queries)
 
 app_settings = AppSettings()
 
@@ -34,8 +43,8 @@ class RoleMixin(object):
     def heirs(self):
         """Return the children of this role."""
         role_type, role_id = get_role_type_and_id(self)
-        return [app_settings.mapping.get_instance(*h)
-                for h in RoleHierarchy.heirs(role_type, role_id)]
+        return app_settings.mapping.get_instances(
+            RoleHierarchy.heirs(role_type, role_id))
 
     def has_role(self, role, role_id='', direct=False):
         """
@@ -59,6 +68,10 @@ class RoleMixin(object):
                 return True
             except RoleHierarchy.DoesNotExist:
                 return False
+        elif app_settings.hierarchy_closure:
+            return RoleHierarchyClosure.objects.filter(
+                descendant_type=role_type_a, descendant_id=role_id_a,
+                ancestor_type=role_type_b, ancestor_id=role_id_b).exists()
         else:
             for layer in RoleHierarchy.all_conveyors(role_type_a, role_id_a):
                 if (role_type_b, role_id_b) in layer:
@@ -87,8 +100,8 @@ class RoleMixin(object):
     def conveyors(self):
         """Return the roles conveying privileges to this role."""
         role_type, role_id = get_role_type_and_id(self)
-        return [app_settings.mapping.get_instance(*c)
-                for c in RoleHierarchy.conveyors(role_type, role_id)]
+        return app_settings.mapping.get_instances(
+            RoleHierarchy.conveyors(role_type, role_id))
 
     def conveys_role_to(self, role, role_id=''):
         """
@@ -134,36 +147,42 @@ class RoleMixin(object):
         return self.can(app_settings.access_permission, resource, resource_id,
                         log=False)
 
-    def accessible(self, resources):
-        if isinstance(resources, (str, QuerySet)):
-            if isinstance(resources, str):
-                resource_type = resources
-                model = app_settings.mapping.get_class(resource_type)
-                if not model:
-                    return []
-                queryset = model.objects
-            else:
-                model = resources.model
-                resource_type = app_settings.mapping.get_type(model)
-                queryset = resources
-
-            self_type, self_id = get_role_type_and_id(self)
-            roles = [(self_type, self_id)]
-            for layer in RoleHierarchy.all_conveyors(self_type, self_id):
-                roles.extend(layer)
-            resources_id = []
-            for role_type, role_id in roles:
-                resources_id.extend(list(RolePrivilege.objects.filter(
-                    role_type=role_type, role_id=role_id,
-                    resource_type=resource_type).values_list(
-                    'resource_id', flat=True
-                )))
+    def accessible(self, resources, perm=None):
+        """
+        Filter the resources this role has privilege ``perm`` on.
 
-            return queryset.filter(id__in=resources_id)
-        else:
-            # FIXME: can optimize a lot here by grouping objects by type,
-            # and doing like above, once for each type
-            return [r for r in resources if self.has_access_to(r)]
+        Querysets (or resource type names) are filtered in the database,
+        see ``RolePrivilege.filter_accessible``, and the result is a lazy
+        queryset. Other iterables are grouped by resource type and checked
+        with one query per type, see ``RolePrivilege.authorize_bulk``.
+
+        Args:
+            resources (str/QuerySet/iterable): a resource type, a queryset
+                of resources, or an iterable of resources.
+            perm (str): the privilege, default to ACCESS_PERMISSION setting.
+
+        Returns:
+            QuerySet/list: the accessible resources.
+        """
+        if perm is None:
+            perm = app_settings.access_permission
+        self_type, self_id = get_role_type_and_id(self)
+
+        if isinstance(resources, str):
+            model = app_settings.mapping.get_class(resources)
+            if not model:
+                return []
+            return RolePrivilege.filter_accessible(
+                self_type, self_id, perm, model.objects.all(), resources)
+        elif isinstance(resources, QuerySet):
+            return RolePrivilege.filter_accessible(
+                self_type, self_id, perm, resources)
+
+        resources = list(resources)
+        checks = [(perm, ) + get_resource_type_and_id(r) for r in resources]
+        decisions = RolePrivilege.authorize_bulk(
+            self_type, self_id, checks, log=False)
+        return [r for r, c in zip(resources, checks) if decisions[c]]
 
     def can(self, perm, resource, resource_id='',
             skip_implicit=None, log=None):
@@ -187,6 +206,28 @@ class RoleMixin(object):
             resource_type=resource_type, resource_id=resource_id,
             skip_implicit=skip_implicit, log=log)
 
+    def can_many(self, checks, skip_implicit=None, log=None):
+        """
+        Check several privileges of this role at once.
+
+        Args:
+            checks (iterable): (perm, resource) or
+                (perm, resource, resource_id) tuples, resource being a
+                resource instance or a string describing it.
+            skip_implicit (bool): True, False or None for project's default.
+            log (bool): True, False or None for project's default.
+
+        Returns:
+            dict: True or False for each given check.
+        """
+        role_type, role_id = get_role_type_and_id(self)
+        checks = list(checks)
+        resolved = [(c[0],) + get_resource_type_and_id(*c[1:]) for c in checks]
+        decisions = RolePrivilege.authorize_bulk(
+            role_type=role_type, role_id=role_id, checks=resolved,
+            skip_implicit=skip_implicit, log=log)
+        return {c: decisions[r] for c, r in zip(checks, resolved)}
+
     # def allow(perm, role, role_id=''): pass
     # def deny(perm, role, role_id=''): pass
     # def forget(perm, role, role_id=''): pass
@@ -251,6 +292,10 @@ class RoleHierarchy(models.Model):
             'role_type_a', 'role_id_a',
             'role_type_b', 'role_id_b'
         )
+        index_together = (
+            # heirs, all_heirs
+            ('role_type_b', 'role_id_b', 'role_type_a', 'role_id_a'),
+        )
 
     def __str__(self):
         a = self.role_type_a
@@ -309,17 +354,14 @@ class RoleHierarchy(models.Model):
             list of lists: list of layers,
                 layers beings lists of (role_type, role_id) conveyors.
         """
-        layers = []
-        conveyors = RoleHierarchy.objects.filter(
-            role_type_a=role_type, role_id_a=role_id)
-        while conveyors:
-            layers.append(list(conveyors.values_list('role_type_b', 'role_id_b')))
-            next_layer_q_object = Q()
-            for conveyor in conveyors:
-                next_layer_q_object |= Q(role_type_a=conveyor.role_type_b,
-                                         role_id_a=conveyor.role_id_b)
-            conveyors = RoleHierarchy.objects.filter(next_layer_q_object)
-        return layers
+        index = get_hierarchy_index()
+        if index is not None:
+            return index.layers(role_type, role_id)
+        if app_settings.hierarchy_closure:
+            return RoleHierarchyClosure.layers(role_type, role_id)
+        return RoleHierarchy.layers(
+            role_type, role_id, ('role_type_a', 'role_id_a'),
+            ('role_type_b', 'role_id_b'))
 
     @staticmethod
     def all_heirs(role_type, role_id):
@@ -334,16 +376,150 @@ class RoleHierarchy(models.Model):
             list of lists: list of layers,
                 layers beings lists of (role_type, role_id) heirs.
         """
+        if app_settings.hierarchy_closure:
+            return RoleHierarchyClosure.layers(
+                role_type, role_id, ancestors=False)
+        return RoleHierarchy.layers(
+            role_type, role_id, ('role_type_b', 'role_id_b'),
+            ('role_type_a', 'role_id_a'))
+
+    @staticmethod
+    def conveyor_depths(role_type, role_id):
+        """
+        Return the role and every role conveying privileges to it, by depth.
+
+        Args:
+            role_type (str): string describing the role type.
+            role_id (str): unique ID of the role.
+
+        Returns:
+            dict: depth of the nearest layer for each (role_type, role_id),
+                the role itself being at depth 0.
+        """
+        depths = {(role_type, role_id): 0}
+        for depth, layer in enumerate(
+                RoleHierarchy.all_conveyors(role_type, role_id), 1):
+            for conveyor in layer:
+                depths.setdefault(conveyor, depth)
+        return depths
+
+    @staticmethod
+    def layers(role_type, role_id, from_fields, to_fields):
+        """
+        Walk the hierarchy from a role and return the roles reached by layer.
+
+        A single recursive query is used when the database supports it,
+        otherwise one query is run per layer.
+
+        Args:
+            role_type (str): string describing the role type.
+            role_id (str): unique ID of the role.
+            from_fields (tuple): names of the type and ID fields to start from.
+            to_fields (tuple): names of the type and ID fields to go to.
+
+        Returns:
+            list of lists: list of layers,
+                layers beings lists of (role_type, role_id) tuples.
+        """
+        connection = connections[router.db_for_read(RoleHierarchy)]
+        if supports_recursive_queries(connection):
+            return RoleHierarchy.recursive_layers(
+                connection, role_type, role_id, from_fields, to_fields)
+        return RoleHierarchy.iterative_layers(
+            role_type, role_id, from_fields, to_fields)
+
+    @staticmethod
+    def recursive_layers(connection, role_type, role_id,
+                         from_fields, to_fields):
+        """
+        Walk the hierarchy in one ``WITH RECURSIVE`` query.
+
+        Each walked path keeps the roles it visited, and stops before
+        visiting one of them again, so that cycles end the recursion. Roles
+        reached by several paths are returned once, at their minimum depth,
+        and the role itself is never returned.
+
+        Args:
+            connection (DatabaseWrapper): the database connection to use.
+            role_type (str): string describing the role type.
+            role_id (str): unique ID of the role.
+            from_fields (tuple): names of the type and ID fields to start from.
+            to_fields (tuple): names of the type and ID fields to go to.
+
+        Returns:
+            list of lists: list of layers,
+                layers beings lists of (role_type, role_id) tuples.
+        """
+        qn = connection.ops.quote_name
+        opts = RoleHierarchy._meta
+        from_type, from_id, to_type, to_id = (
+            qn(opts.get_field(f).column) for f in from_fields + to_fields)
+        # path: |type:id|type:id|...| of the roles visited by a walk
+        sql = (
+            'WITH RECURSIVE walk (role_type, role_id, depth, path) AS ('
+            "SELECT {to_type}, {to_id}, 1, %s || {to_type} || ':' || {to_id} "
+            "|| '|' FROM {table} "
+            'WHERE {from_type} = %s AND {from_id} = %s '
+            'UNION ALL '
+            'SELECT h.{to_type}, h.{to_id}, w.depth + 1, '
+            "w.path || h.{to_type} || ':' || h.{to_id} || '|' "
+            'FROM {table} h INNER JOIN walk w '
+            'ON h.{from_type} = w.role_type AND h.{from_id} = w.role_id '
+            "WHERE {position}(w.path, '|' || h.{to_type} || ':' || "
+            "h.{to_id} || '|') = 0) "
+            'SELECT role_type, role_id, MIN(depth) FROM walk '
+            'WHERE NOT (role_type = %s AND role_id = %s) '
+            'GROUP BY role_type, role_id '
+            'ORDER BY 3, 1, 2'
+        ).format(table=qn(opts.db_table), from_type=from_type,
+                 from_id=from_id, to_type=to_type, to_id=to_id,
+                 position='strpos' if connection.vendor == 'postgresql'
+                 else 'instr')
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, ['|%s:%s|' % (role_type, role_id),
+                                 role_type, role_id, role_type, role_id])
+            rows = cursor.fetchall()
+
+        layers = []
+        for above_role_type, above_role_id, depth in rows:
+            if depth > len(layers):
+                layers.append([])
+            layers[-1].append((above_role_type, above_role_id))
+        return layers
+
+    @staticmethod
+    def iterative_layers(role_type, role_id, from_fields, to_fields):
+        """
+        Walk the hierarchy with one query per layer.
+
+        Roles already reached are skipped, as in ``recursive_layers``.
+
+        Args:
+            role_type (str): string describing the role type.
+            role_id (str): unique ID of the role.
+            from_fields (tuple): names of the type and ID fields to start from.
+            to_fields (tuple): names of the type and ID fields to go to.
+
+        Returns:
+            list of lists: list of layers,
+                layers beings lists of (role_type, role_id) tuples.
+        """
+        from_type, from_id = from_fields
         layers = []
-        heirs = RoleHierarchy.objects.filter(
-            role_type_b=role_type, role_id_b=role_id)
-        while heirs:
-            layers.append(list(heirs.values_list('role_type_a', 'role_id_a')))
+        seen = {(role_type, role_id)}
+        layer = sorted(set(RoleHierarchy.objects.filter(
+            **{from_type: role_type, from_id: role_id}
+        ).values_list(*to_fields)) - seen)
+        while layer:
+            layers.append(layer)
+            seen.update(layer)
             next_layer_q_object = Q()
-            for heir in heirs:
-                next_layer_q_object |= Q(role_type_b=heir.role_type_a,
-                                         role_id_b=heir.role_id_a)
-            heirs = RoleHierarchy.objects.filter(next_layer_q_object)
+            for next_role_type, next_role_id in layer:
+                next_layer_q_object |= Q(**{from_type: next_role_type,
+                                            from_id: next_role_id})
+            layer = sorted(set(RoleHierarchy.objects.filter(
+                next_layer_q_object).values_list(*to_fields)) - seen)
         return layers
 
     @staticmethod
@@ -353,8 +529,55 @@ class RoleHierarchy(models.Model):
         a_set = set((o.role_type_a, o.role_id_a) for o in all_obj)
         return b_set - a_set
 
+    @staticmethod
+    def subgraph(role_type,
+                 role_id,
+                 depth=1,
+                 ancestors=True,
+                 descendants=True):
+        """
+        Return the links around a role, up to a given depth.
+
+        The hierarchy is walked one layer at a time in each direction,
+        with one query per layer (and per chunk of 400 roles).
+
+        Args:
+            role_type (str): string describing the role type.
+            role_id (str): unique ID of the role.
+            depth (int): maximum number of links from the role.
+            ancestors (bool): include the roles conveying privileges.
+            descendants (bool): include the roles inheriting privileges.
+
+        Returns:
+            set: (role_type_a, role_id_a, role_type_b, role_id_b) links.
+        """
+        fields = ('role_type_a', 'role_id_a', 'role_type_b', 'role_id_b')
+        directions = []
+        if ancestors:
+            directions.append((fields[:2], slice(2, 4)))
+        if descendants:
+            directions.append((fields[2:], slice(0, 2)))
+
+        links = set()
+        for from_fields, next_role in directions:
+            seen = {(role_type, role_id)}
+            frontier = list(seen)
+            for step in range(depth):
+                found = []
+                for chunk in chunked(frontier, 400):
+                    for link in RoleHierarchy.objects.filter(
+                            roles_filter(chunk, *from_fields)
+                    ).values_list(*fields):
+                        links.add(link)
+                        found.append(link[next_role])
+                frontier = set(found) - seen
+                if not frontier:
+                    break
+                seen.update(frontier)
+        return links
+
 
-class RolePrivilege(models.Model):
+class RolePrivilege(AuthorizationMixin, models.Model):
     """Role privilege model."""
 
     role_type = models.CharField(_('Role type'), max_length=255)
@@ -367,8 +590,12 @@ class RolePrivilege(models.Model):
     resource_type = models.CharField(_('Resource type'), max_length=255)
     resource_id = models.CharField(_('Resource ID'), max_length=255, blank=True)
 
-    creation_date = models.DateTimeField(_('Created'), auto_now_add=True)
-    modification_date = models.DateTimeField(_('Last modified'), auto_now=True)
+    creation_date = models.DateTimeField(
+        _('Created'), auto_now_add=True, db_index=True)
+    modification_date = models.DateTimeField(
+        _('Last modified'), auto_now=True, db_index=True)
+
+    objects = RolePrivilegeQuerySet.as_manager()
 
     class Meta:
         """Meta class for Django."""
@@ -380,6 +607,14 @@ class RolePrivilege(models.Model):
             'access_type',
             'resource_type', 'resource_id'
         )
+        index_together = (
+            # authorize (resolve_explicit_many), ajax_load_privileges
+            ('resource_type', 'resource_id', 'access_type',
+             'role_type', 'role_id', 'authorized'),
+            # accessible
+            ('role_type', 'role_id', 'resource_type', 'access_type',
+             'authorized', 'resource_id'),
+        )
 
     def __str__(self):
         return '%s %s %s to %s %s %s' % (
@@ -387,180 +622,16 @@ class RolePrivilege(models.Model):
             self.role_id if self.role_id else '', self.access_type,
             self.resource_type, self.resource_id if self.resource_id else '')
 
-    @staticmethod
-    def authorize(role_type,
-                  role_id,
-                  perm,
-                  resource_type,
-                  resource_id,
-                  skip_implicit=None,
-                  log=None):
+    def key(self):
         """
-        Authorize access to a resource to a role.
-
-        This method checks if a role has access to a resource or a type of
-        resource. Calling this method will also try to record an entry log
-        in the corresponding access attempt model.
-
-        Call will not break if there is no access attempt model. Simply,
-        nothing will be recorded.
-
-        Args:
-            role_type (str): the string describing the role.
-            role_id (str): the unique ID of the role.
-            perm (Permission's constant): one of the permissions available
-                in Permission class.
-            resource_type (str): the string describing the resource.
-            resource_id (str): the unique ID of the resource.
-            log (bool): record an entry in access history model or not.
-            skip_implicit (bool): whether to skip implicit authorization.
-                It will always be skipped if you set ACCESS_CONTROL_IMPLICIT
-                setting to False.
+        Return the unique key of the privilege.
 
         Returns:
-            bool: role has perm on resource (or not).
+            tuple: role type, role ID, permission, resource type and
+                resource ID.
         """
-        if skip_implicit is None:
-            skip_implicit = app_settings.skip_implicit
-
-        if log is None:
-            log = app_settings.log_access
-
-        attempt = AccessHistory(role_type=role_type, role_id=role_id,
-                                resource_type=resource_type,
-                                resource_id=resource_id, access_type=perm)
-        attempt.response = None
-        attempt.response_type = AccessHistory.EXPLICIT
-
-        # Check role explicit perms
-        attempt.response = RolePrivilege.authorize_explicit(
-            role_type, role_id, perm, resource_type, resource_id)
-
-        if attempt.response is None:
-
-            # Else check inherited explicit perms
-            for layer in RoleHierarchy.all_conveyors(role_type, role_id):
-                if attempt.response is not None:
-                    break
-                for above_role_type, above_role_id in layer:
-                    attempt.response = RolePrivilege.authorize_explicit(
-                        above_role_type, above_role_id, perm,
-                        resource_type, resource_id)
-
-                    if attempt.response is not None:
-                        attempt.conveyor_type = above_role_type
-                        attempt.conveyor_id = above_role_id
-                        break
-
-        # Else check role implicit perms
-        if attempt.response is None and not skip_implicit:
-            attempt.response = RolePrivilege.authorize_implicit(
-                role_type, role_id, perm, resource_type, resource_id)
-
-            if attempt.response is not None:
-                attempt.response_type = AccessHistory.IMPLICIT
-
-            # Else check inherited implicit perms
-            else:
-
-                for layer in RoleHierarchy.all_conveyors(role_type, role_id):
-                    if attempt.response is not None:
-                        break
-                    for above_role_type, above_role_id in layer:
-                        attempt.response = RolePrivilege.authorize_implicit(
-                            above_role_type, above_role_id, perm,
-                            resource_type, resource_id)
-
-                        if attempt.response is not None:
-                            attempt.response_type = AccessHistory.IMPLICIT
-                            attempt.conveyor_type = above_role_type
-                            attempt.conveyor_id = above_role_id
-                            break
-
-        # Else give default response
-        if attempt.response is None:
-            attempt.response = app_settings.default_response
-            attempt.response_type = AccessHistory.DEFAULT
-
-        if log:
-            attempt.save()
-
-        return attempt.response
-
-    @staticmethod
-    def authorize_explicit(role_type,
-                           role_id,
-                           perm,
-                           resource_type,
-                           resource_id=''):
-        """
-        Run an explicit authorization check.
-
-        Args:
-            role_type (str): a string describing the type of role.
-            role_id (str): the role's ID.
-            perm (str): one of the permissions available in Permission class.
-            resource_type (str): a string describing the type of resource.
-            resource_id (str): the resource's ID.
-
-        Returns:
-
-        """
-        try:
-            privilege = RolePrivilege.objects.get(
-                role_type=role_type, role_id=role_id,
-                resource_type=resource_type, resource_id=resource_id,
-                access_type=perm)
-            return privilege.authorized
-        except RolePrivilege.DoesNotExist:
-            return None
-
-    @staticmethod
-    def authorize_implicit(role_type,
-                           role_id,
-                           perm,
-                           resource_type,
-                           resource_id=''):
-        """
-        Run an implicit authorization check.
-
-        Args:
-            role_type (str): a string describing the type of role.
-            role_id (str): the role's ID.
-            perm (str): one of the permissions available in Permission class.
-            resource_type (str): a string describing the type of resource.
-            resource_id (str): the resource's ID.
-
-        Returns:
-            bool: denied(perm) or allowed(perm) found in implicit_perms().
-            None: if ACCESS_CONTROL_IMPLICIT is False,
-                or perm is in ignored_perms.
-        """
-        role_instance = app_settings.mapping.get_instance(
-            role_type, role_id)
-        if resource_id:
-            attr_name = 'can_%s_%s_%s' % (perm, resource_type, resource_id)
-            if hasattr(role_instance, attr_name):
-                attr = getattr(role_instance, attr_name)
-                if callable(attr):
-                    return attr()
-                return attr
-        attr_name = 'can_%s_%s' % (perm, resource_type)
-        if hasattr(role_instance, attr_name):
-            attr = getattr(role_instance, attr_name)
-            if callable(attr):
-                return attr(resource_id=resource_id)
-            return attr
-        attr_name = 'can_%s' % perm
-        if hasattr(role_instance, attr_name):
-            attr = getattr(role_instance, attr_name)
-            if callable(attr):
-                return attr(
-                    instance=app_settings.mapping.get_instance(
-                        resource_type, resource_id),
-                    resource_type=resource_type, resource_id=resource_id)
-            return attr
-        return None
+        return (self.role_type, self.role_id, self.access_type,
+                self.resource_type, self.resource_id)
 
     @staticmethod
     def allow(role_type,
@@ -582,22 +653,28 @@ class RolePrivilege(models.Model):
             user (User): an instance of settings.AUTH_USER_MODEL.
             log (bool): whether to record an entry in privileges history.
 
+        The resource ID is removed from the range privileges containing
+        it (see ``split_ranges``).
+
         Returns:
             access instance: the created privilege.
         """
-        privilege, created = RolePrivilege.objects.update_or_create(
-            role_type=role_type,
-            role_id=role_id,
-            access_type=perm,
-            resource_type=resource_type,
-            resource_id=resource_id,
-            defaults={'authorized': True})
+        with transaction.atomic():
+            split_ranges([(role_type, role_id, perm, resource_type,
+                           resource_id)])
+            privilege, created = RolePrivilege.objects.update_or_create(
+                role_type=role_type,
+                role_id=role_id,
+                access_type=perm,
+                resource_type=resource_type,
+                resource_id=resource_id,
+                defaults={'authorized': True})
 
-        if log:
-            record = PrivilegeHistory(
-                user=user, action={True: PrivilegeHistory.CREATE}.get(
-                    created, PrivilegeHistory.UPDATE))
-            record.update_from_privilege(privilege)
+            if log:
+                record = PrivilegeHistory(
+                    user=user, action={True: PrivilegeHistory.CREATE}.get(
+                        created, PrivilegeHistory.UPDATE))
+                record.update_from_privilege(privilege)
 
         return privilege, created
 
@@ -621,22 +698,28 @@ class RolePrivilege(models.Model):
             user (User): an instance of settings.AUTH_USER_MODEL.
             log (bool): whether to record an entry in privileges history.
 
+        The resource ID is removed from the range privileges containing
+        it (see ``split_ranges``).
+
         Returns:
             access instance: the created privilege.
         """
-        privilege, created = RolePrivilege.objects.update_or_create(
-            role_type=role_type,
-            role_id=role_id,
-            access_type=perm,
-            resource_type=resource_type,
-            resource_id=resource_id,
-            defaults={'authorized': False})
+        with transaction.atomic():
+            split_ranges([(role_type, role_id, perm, resource_type,
+                           resource_id)])
+            privilege, created = RolePrivilege.objects.update_or_create(
+                role_type=role_type,
+                role_id=role_id,
+                access_type=perm,
+                resource_type=resource_type,
+                resource_id=resource_id,
+                defaults={'authorized': False})
 
-        if log:
-            record = PrivilegeHistory(
-                user=user, action={True: PrivilegeHistory.CREATE}.get(
-                    created, PrivilegeHistory.UPDATE))
-            record.update_from_privilege(privilege)
+            if log:
+                record = PrivilegeHistory(
+                    user=user, action={True: PrivilegeHistory.CREATE}.get(
+                        created, PrivilegeHistory.UPDATE))
+                record.update_from_privilege(privilege)
 
         return privilege, created
 
@@ -660,182 +743,93 @@ class RolePrivilege(models.Model):
             user (User): an instance of settings.AUTH_USER_MODEL.
             log (bool): whether to record an entry in privileges history.
 
+        The resource ID is also removed from the range privileges
+        containing it (see ``split_ranges``).
+
         Returns:
-            int, dict:
-                the number of privileges deleted and a dictionary with the
-                number of deletions per object type (django's delete return).
+            bool: whether a privilege was forgotten.
         """
-        try:
-            privilege = RolePrivilege.objects.get(
-                role_type=role_type, role_id=role_id,
-                resource_type=resource_type, resource_id=resource_id,
-                access_type=perm)
+        with transaction.atomic():
+            split = split_ranges([(role_type, role_id, perm, resource_type,
+                                   resource_id)])
+            try:
+                privilege = RolePrivilege.objects.get(
+                    role_type=role_type, role_id=role_id,
+                    resource_type=resource_type, resource_id=resource_id,
+                    access_type=perm)
+            except RolePrivilege.DoesNotExist:
+                if not split:
+                    return False
+                # the privilege only existed in a range
+                privilege = RolePrivilege(
+                    role_type=role_type, role_id=role_id,
+                    access_type=perm, resource_type=resource_type,
+                    resource_id=resource_id,
+                    authorized=list(split.values())[0])
 
             if log:
                 record = PrivilegeHistory(
                     user=user, action=PrivilegeHistory.DELETE)
-                record.update_from_privilege(privilege)
+                record.update_from_privilege(privilege, save=False)
+                if privilege.pk is None:
+                    record.reference = None
+                record.save()
 
-            privilege.delete()
+            if privilege.pk is not None:
+                privilege.delete()
             return True
-        except RolePrivilege.DoesNotExist:
-            return False
-
-
-# TODO: implement HierarchyHistory model
-# role creation must be recorded
-
-
-class PrivilegeHistory(models.Model):
-    """Privilege history model."""
-
-    CREATE = 'c'
-    # READ = 'r'  # makes no sense here
-    UPDATE = 'u'
-    DELETE = 'd'
-
-    ACTIONS_VERBOSE = {
-        CREATE: 'create',
-        # READ: 'read',
-        UPDATE: 'update',
-        DELETE: 'delete'
-    }
-
-    ACTIONS = (
-        (CREATE, _(ACTIONS_VERBOSE[CREATE])),
-        # (READ, _(ACTIONS_VERBOSE[READ])),
-        (UPDATE, _(ACTIONS_VERBOSE[UPDATE])),
-        (DELETE, _(ACTIONS_VERBOSE[DELETE])),
-    )
-
-    privilege_id = models.PositiveIntegerField(
-        _('Privilege reference ID'), null=True)
-    reference = models.ForeignKey(
-        RolePrivilege, on_delete=models.SET_NULL, null=True,
-        verbose_name=_('Privilege reference'), related_name='history')
-    action = models.CharField(_('Action'), max_length=1, choices=ACTIONS)
-    datetime = models.DateTimeField(_('Date and time'), auto_now_add=True)
-    user = models.ForeignKey(
-        settings.AUTH_USER_MODEL, on_delete=models.SET_NULL,
-        verbose_name=_('User'), related_name='privileges_changes',
-        null=True)
-
-    role_type = models.CharField(_('Role type'), max_length=255, blank=True)
-    role_id = models.CharField(_('Role ID'), max_length=255, blank=True)
 
-    authorized = models.NullBooleanField(_('Authorized'), default=None)
-    access_type = models.CharField(
-        _('Access type'), max_length=255, blank=True)
-
-    resource_type = models.CharField(
-        _('Resource type'), max_length=255, blank=True)
-    resource_id = models.CharField(_('Resource ID'), max_length=255, blank=True)  # noqa
-
-    class Meta:
-        """Meta class for Django."""
-
-        verbose_name = _('Privilege history')
-        verbose_name_plural = _('Privilege history')
+    @staticmethod
+    def allow_many(privileges, user=None, log=True):
+        """
+        Explicitly give many perms in one transaction.
 
-    def __str__(self):
-        if self.reference:
-            privilege = str(self.reference)
-        else:
-            privilege = RolePrivilege(
-                role_type=self.role_type,
-                role_id=self.role_id,
-                authorized=self.authorized,
-                access_type=self.access_type,
-                resource_type=self.resource_type,
-                resource_id=self.resource_id)
+        Args:
+            privileges (iterable): (role_type, role_id, perm, resource_type,
+                resource_id) tuples.
+            user (User): an instance of settings.AUTH_USER_MODEL.
+            log (bool): whether to record entries in privileges history.
 
-        return '[%s] user %s has %sd privilege <%d: %s>' % (
-            self.datetime, self.user,
-            PrivilegeHistory.ACTIONS_VERBOSE[str(self.action)],
-            self.privilege_id, privilege)
+        Returns:
+            dict: the counts returned by ``RolePrivilegeQuerySet.bulk_set``.
+        """
+        return RolePrivilege.objects.bulk_set(
+            (tuple(p) + (True, ) for p in privileges), user=user, log=log)
 
-    def update_from_privilege(self, privilege, save=True):
+    @staticmethod
+    def deny_many(privileges, user=None, log=True):
         """
-        Update this object with given privilege's attributes.
+        Explicitly remove many perms in one transaction.
 
         Args:
-            privilege (RolePrivilege): privilege to update from.
-            save (bool): whether to commit the changes to the database.
-        """
-        self.reference = privilege
-        self.privilege_id = privilege.id
-        self.role_type = privilege.role_type
-        self.role_id = privilege.role_id
-        self.authorized = privilege.authorized
-        self.access_type = privilege.access_type
-        self.resource_type = privilege.resource_type
-        self.resource_id = privilege.resource_id
-        if save:
-            self.save()
-
-
-class AccessHistory(models.Model):
-    """Access history model."""
-
-    DEFAULT = 'd'
-    IMPLICIT = 'i'
-    EXPLICIT = 'e'
-
-    RESPONSE_TYPE_VERBOSE = {
-        DEFAULT: 'by default',
-        IMPLICIT: 'implicitly',
-        EXPLICIT: 'explicitly'
-    }
-
-    RESPONSE_TYPE = (
-        (DEFAULT, _(RESPONSE_TYPE_VERBOSE[DEFAULT])),
-        (IMPLICIT, _(RESPONSE_TYPE_VERBOSE[IMPLICIT])),
-        (EXPLICIT, _(RESPONSE_TYPE_VERBOSE[EXPLICIT]))
-    )
-
-    role_type = models.CharField(_('Role type'), max_length=255, blank=True)
-    role_id = models.CharField(_('Role ID'), max_length=255, blank=True)
-
-    # We don't want to store false info, None says "we don't know"
-    response = models.NullBooleanField(_('Response'), default=None)
-    response_type = models.CharField(
-        _('Response type'), max_length=1, choices=RESPONSE_TYPE)
-    access_type = models.CharField(_('Access'), max_length=255)
-
-    resource_type = models.CharField(_('Resource type'), max_length=255)
-    resource_id = models.CharField(_('Resource ID'), max_length=255, blank=True)  # noqa
+            privileges (iterable): (role_type, role_id, perm, resource_type,
+                resource_id) tuples.
+            user (User): an instance of settings.AUTH_USER_MODEL.
+            log (bool): whether to record entries in privileges history.
 
-    datetime = models.DateTimeField(_('Date and time'), default=timezone.now)
+        Returns:
+            dict: the counts returned by ``RolePrivilegeQuerySet.bulk_set``.
+        """
+        return RolePrivilege.objects.bulk_set(
+            (tuple(p) + (False, ) for p in privileges), user=user, log=log)
 
-    conveyor_type = models.CharField(_('Conveyor type'), max_length=255, blank=True)  # noqa
-    conveyor_id = models.CharField(_('Conveyor ID'), max_length=255, blank=True)  # noqa
+    @staticmethod
+    def forget_many(privileges, user=None, log=True):
+        """
+        Forget many privileges in one transaction.
 
-    class Meta:
-        """Meta class for Django."""
+        Args:
+            privileges (iterable): (role_type, role_id, perm, resource_type,
+                resource_id) tuples.
+            user (User): an instance of settings.AUTH_USER_MODEL.
+            log (bool): whether to record entries in privileges history.
 
-        verbose_name = _('Access history')
-        verbose_name_plural = _('Access history')
+        Returns:
+            dict: the counts returned by ``RolePrivilegeQuerySet.bulk_set``.
+        """
+        return RolePrivilege.objects.bulk_set(
+            (tuple(p) + (None, ) for p in privileges), user=user, log=log)
 
-    def __str__(self):
-        inherited = ''
 
-        if self.role_id:
-            role = '%s %s' % (self.role_type, self.role_id)
-        else:
-            role = self.role_type
-
-        if self.conveyor_type:
-            if self.conveyor_id:
-                inherited = ' (inherited from %s %s)' % (
-                    self.conveyor_type, self.conveyor_id)
-            else:
-                inherited = self.conveyor_type
-
-        authorized = 'authorized' if self.response else 'unauthorized'
-        string = '[%s] %s was %s %s to %s %s %s' % (
-            self.datetime, role,
-            AccessHistory.RESPONSE_TYPE_VERBOSE[str(self.response_type)],
-            authorized, self.access_type, self.resource_type, self.resource_id)
-        if inherited:
-            return string + inherited
-        return string
+# TODO: implement HierarchyHistory model
+# role creation must be recorded
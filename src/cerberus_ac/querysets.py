@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+"""Querysets module, providing bulk changes of role privileges."""
+
+from collections import OrderedDict
+
+from django.db import router, transaction
+from django.db.models import QuerySet
+from django.utils import timezone
+
+from .cache import invalidate_decisions
+from .history import PrivilegeHistory
+from .ranges import split_ranges
+from .utils import chunked, raw_delete
+
+
+def wanted_privileges(privileges):
+    """
+    Return the wanted authorization of each privilege key.
+
+    Args:
+        privileges (iterable): (role_type, role_id, perm, resource_type,
+            resource_id, authorized) tuples. When a privilege is given
+            several times, the last one wins.
+
+    Returns:
+        OrderedDict: the authorization (True, False or None) for each
+            (role_type, role_id, perm, resource_type, resource_id) key,
+            IDs being strings.
+    """
+    wanted = OrderedDict()
+    for privilege in privileges:
+        role_type, role_id, perm, resource_type, resource_id = (
+            privilege[:5])
+        wanted[(role_type, str(role_id), perm, resource_type,
+                str(resource_id))] = privilege[5]
+    return wanted
+
+
+class RolePrivilegeQuerySet(QuerySet):
+    """Role privilege queryset, providing bulk changes."""
+
+    def get_existing(self, keys, batch_size=400):
+        """
+        Return the existing privileges matching several keys.
+
+        Keys are grouped by role, permission and resource type, and each
+        group is fetched with one query per chunk of resource IDs.
+
+        Args:
+            keys (iterable): (role_type, role_id, perm, resource_type,
+                resource_id) tuples.
+            batch_size (int): number of resource IDs per query.
+
+        Returns:
+            dict: the privilege for each existing key.
+        """
+        groups = OrderedDict()
+        for role_type, role_id, perm, resource_type, resource_id in keys:
+            groups.setdefault(
+                (role_type, role_id, perm, resource_type), []).append(
+                resource_id)
+        existing = {}
+        for (role_type, role_id, perm, resource_type), resource_ids in (
+                groups.items()):
+            for chunk in chunked(resource_ids, batch_size):
+                for privilege in self.filter(
+                        role_type=role_type, role_id=role_id,
+                        access_type=perm, resource_type=resource_type,
+                        resource_id__in=chunk):
+                    existing[privilege.key()] = privilege
+        return existing
+
+    def diff(self, privileges, batch_size=400):
+        """
+        Compare many privileges to the existing ones.
+
+        Args:
+            privileges (iterable): (role_type, role_id, perm, resource_type,
+                resource_id, authorized) tuples, authorized being True,
+                False, or None to forget the privilege. When a privilege is
+                given several times, the last one wins.
+            batch_size (int): number of rows per query.
+
+        Returns:
+            dict: the unsaved privileges to ``create``, the existing
+                privileges to ``update`` (with their new value), the
+                ``unchanged`` ones and the ones to ``delete``.
+        """
+        wanted = wanted_privileges(privileges)
+        changes = {'create': [], 'update': [], 'unchanged': [], 'delete': []}
+        if not wanted:
+            return changes
+        existing = self.get_existing(wanted, batch_size)
+        for key, authorized in wanted.items():
+            privilege = existing.get(key)
+            if authorized is None:
+                if privilege is not None:
+                    changes['delete'].append(privilege)
+            elif privilege is None:
+                changes['create'].append(self.model(
+                    role_type=key[0], role_id=key[1], access_type=key[2],
+                    resource_type=key[3], resource_id=key[4],
+                    authorized=authorized))
+            elif privilege.authorized != authorized:
+                privilege.authorized = authorized
+                changes['update'].append(privilege)
+            else:
+                changes['unchanged'].append(privilege)
+        return changes
+
+    def bulk_set(self, privileges, user=None, log=True, batch_size=400):
+        """
+        Allow, deny or forget many privileges in one transaction.
+
+        Existing privileges are selected first (see ``diff``), then changed
+        privileges are updated with one UPDATE per chunk, new ones are
+        inserted with ``bulk_create``, forgotten ones are deleted with one
+        DELETE per chunk, and history entries are inserted with
+        ``bulk_create``. Resource IDs are removed from the range privileges
+        containing them (see ``split_ranges``), a forgotten ID which was in
+        a range counting as deleted. Signals are not sent for privileges:
+        cached decisions are invalidated once.
+
+        Args:
+            privileges (iterable): (role_type, role_id, perm, resource_type,
+                resource_id, authorized) tuples, authorized being True,
+                False, or None to forget the privilege.
+            user (User): an instance of settings.AUTH_USER_MODEL.
+            log (bool): whether to record entries in privileges history.
+            batch_size (int): number of rows per query.
+
+        Returns:
+            dict: the number of privileges created, updated, unchanged and
+                deleted.
+        """
+        db = self.db if self._db else router.db_for_write(self.model)
+        manager = self.model._default_manager.db_manager(db)
+        history = []
+
+        with transaction.atomic(using=db):
+            wanted = wanted_privileges(privileges)
+            split = split_ranges(wanted, using=db)
+            changes = manager.get_queryset().diff(
+                (key + (authorized, ) for key, authorized in wanted.items()),
+                batch_size)
+            deleted = {p.key() for p in changes['delete']}
+            forgotten = [self.model(
+                role_type=key[0], role_id=key[1], access_type=key[2],
+                resource_type=key[3], resource_id=key[4],
+                authorized=authorized) for key, authorized in split.items()
+                if wanted[key] is None and key not in deleted]
+            counts = {'created': len(changes['create']),
+                      'updated': len(changes['update']),
+                      'unchanged': len(changes['unchanged']),
+                      'deleted': len(changes['delete']) + len(forgotten)}
+
+            now = timezone.now()
+            for authorized in (True, False):
+                updated = [p for p in changes['update']
+                           if p.authorized == authorized]
+                for chunk in chunked(updated, batch_size):
+                    manager.filter(pk__in=[p.pk for p in chunk]).update(
+                        authorized=authorized, modification_date=now)
+                history.extend((PrivilegeHistory.UPDATE, p)
+                               for p in updated)
+
+            created = changes['create']
+            if created:
+                manager.bulk_create(created, batch_size=batch_size)
+                if created[0].pk is None:
+                    # primary keys are not set by every database backend
+                    created = list(manager.get_queryset().get_existing(
+                        [p.key() for p in created], batch_size).values())
+                history.extend((PrivilegeHistory.CREATE, p)
+                               for p in created)
+
+            if changes['delete']:
+                history.extend((PrivilegeHistory.DELETE, p)
+                               for p in changes['delete'])
+                self.raw_delete(
+                    db, [p.pk for p in changes['delete']], batch_size)
+            history.extend((PrivilegeHistory.DELETE, p) for p in forgotten)
+
+            if log and history:
+                records = []
+                for action, privilege in history:
+                    record = PrivilegeHistory(user=user, action=action)
+                    record.update_from_privilege(privilege, save=False)
+                    if action == PrivilegeHistory.DELETE:
+                        record.reference = None
+                    records.append(record)
+                PrivilegeHistory.objects.using(db).bulk_create(
+                    records, batch_size=batch_size)
+
+            if history or split:
+                invalidate_decisions(db)
+        return counts
+
+    def raw_delete(self, db, pks, batch_size=400):
+        """
+        Delete privileges with one DELETE per chunk, without signals.
+
+        References from the privileges history are set to NULL first.
+
+        Args:
+            db (str): the database alias.
+            pks (list): the primary keys of the privileges.
+            batch_size (int): number of primary keys per query.
+
+        Returns:
+            int: the number of deleted privileges.
+        """
+        deleted = 0
+        for chunk in chunked(pks, batch_size):
+            PrivilegeHistory.objects.using(db).filter(
+                reference__in=chunk).update(reference=None)
+            deleted += raw_delete(self.model, db, chunk, batch_size)
+        return deleted
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+
+"""
+Ranges module, granting privileges on ranges of integer resource IDs.
+
+Range privileges are used when the RANGE_PRIVILEGES setting is True.
+"""
+
+from bisect import bisect_left, bisect_right
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import models, transaction
+from django.db.models import Q
+from django.utils.translation import ugettext_lazy as _
+
+from .apps import AppSettings
+from .cache import invalidate_decisions
+from .history import PrivilegeHistory
+from .utils import chunked, integer_id, roles_filter
+
+app_settings = AppSettings()
+
+INTEGER_FIELDS = ('AutoField', 'BigAutoField', 'IntegerField',
+                  'BigIntegerField', 'PositiveIntegerField')
+
+
+class RolePrivilegeRange(models.Model):
+    """
+    Role privilege range model.
+
+    A range privilege stands for one privilege per integer resource ID
+    between ``start`` and ``end`` (included). It is used when the
+    RANGE_PRIVILEGES setting is True, with the same precedence as
+    object-level privileges.
+    """
+
+    role_type = models.CharField(_('Role type'), max_length=255)
+    role_id = models.CharField(_('Role ID'), max_length=255, blank=True)
+
+    authorized = models.BooleanField(
+        _('Authorized'), default=app_settings.default_response)
+    access_type = models.CharField(_('Access type'), max_length=255)
+
+    resource_type = models.CharField(_('Resource type'), max_length=255)
+    start = models.BigIntegerField(_('First resource ID'))
+    end = models.BigIntegerField(_('Last resource ID'))
+
+    creation_date = models.DateTimeField(
+        _('Created'), auto_now_add=True, db_index=True)
+    modification_date = models.DateTimeField(
+        _('Last modified'), auto_now=True, db_index=True)
+
+    class Meta:
+        """Meta class for Django."""
+
+        verbose_name = _('Role privilege range')
+        verbose_name_plural = _('Role privilege ranges')
+        unique_together = (
+            'role_type', 'role_id',
+            'access_type',
+            'resource_type', 'start', 'end'
+        )
+        index_together = (
+            # resolve_explicit_many, filter_accessible
+            ('role_type', 'role_id', 'resource_type', 'access_type',
+             'start', 'end'),
+        )
+
+    def __str__(self):
+        """Return the range privilege as text."""
+        return '%s %s %s %s to %s %s-%s' % (
+            'allow' if self.authorized else 'deny', self.role_type,
+            self.role_id if self.role_id else '', self.access_type,
+            self.resource_type, self.start, self.end)
+
+    @staticmethod
+    def coalesce(min_size=2, batch_size=400, user=None, log=True):
+        """
+        Replace runs of consecutive privileges with range privileges.
+
+        Privileges of a role, permission and resource type, with the same
+        authorization and consecutive integer resource IDs, are replaced by
+        one range privilege when there are at least ``min_size`` of them.
+        Each group of privileges is handled in its own transaction.
+
+        Args:
+            min_size (int): minimum number of privileges in a range.
+            batch_size (int): number of privileges deleted per query.
+            user (User): an instance of settings.AUTH_USER_MODEL.
+            log (bool): whether to record entries in privileges history.
+
+        Returns:
+            tuple: the number of created ranges and of deleted privileges.
+
+        Raises:
+            ImproperlyConfigured: when the RANGE_PRIVILEGES setting is
+                False, since ranges would then be ignored.
+        """
+        from .models import RolePrivilege
+
+        if not app_settings.range_privileges:
+            raise ImproperlyConfigured(
+                'coalescing privileges requires the RANGE_PRIVILEGES '
+                'setting')
+
+        groups = RolePrivilege.objects.exclude(resource_id='').values(
+            'role_type', 'role_id', 'access_type', 'resource_type',
+            'authorized').annotate(count=models.Count('pk')).filter(
+            count__gte=min_size).values_list(
+            'role_type', 'role_id', 'access_type', 'resource_type',
+            'authorized').order_by()
+        created = deleted = 0
+        for role_type, role_id, perm, resource_type, authorized in groups:
+            rows = RolePrivilege.objects.filter(
+                role_type=role_type, role_id=role_id, access_type=perm,
+                resource_type=resource_type, authorized=authorized
+            ).values_list('pk', 'resource_id')
+            ids = sorted((i, pk) for i, pk in (
+                (integer_id(resource_id), pk) for pk, resource_id in rows)
+                if i is not None)
+
+            runs, run = [], ids[:1]
+            for item in ids[1:]:
+                if item[0] == run[-1][0] + 1:
+                    run.append(item)
+                else:
+                    runs.append(run)
+                    run = [item]
+            runs.append(run)
+            runs = [r for r in runs if len(r) >= min_size]
+            if not runs:
+                continue
+
+            ranges = [RolePrivilegeRange(
+                role_type=role_type, role_id=role_id, access_type=perm,
+                resource_type=resource_type, authorized=authorized,
+                start=run[0][0], end=run[-1][0]) for run in runs]
+            with transaction.atomic():
+                RolePrivilegeRange.objects.bulk_create(ranges)
+                deleted += RolePrivilege.objects.raw_delete(
+                    RolePrivilege.objects.db,
+                    [pk for run in runs for _, pk in run], batch_size)
+                if log:
+                    records = []
+                    for run, privilege_range in zip(runs, ranges):
+                        record = PrivilegeHistory(
+                            user=user, action=PrivilegeHistory.CREATE)
+                        record.update_from_range(privilege_range, save=False)
+                        records.append(record)
+                        for i, pk in run:
+                            record = PrivilegeHistory(
+                                user=user, action=PrivilegeHistory.DELETE)
+                            record.update_from_privilege(RolePrivilege(
+                                pk=pk, role_type=role_type, role_id=role_id,
+                                access_type=perm, resource_type=resource_type,
+                                authorized=authorized, resource_id=str(i)),
+                                save=False)
+                            record.reference = None
+                            records.append(record)
+                    PrivilegeHistory.objects.bulk_create(
+                        records, batch_size=batch_size)
+            created += len(runs)
+
+        if created:
+            invalidate_decisions()
+        return created, deleted
+
+
+def split_ranges(keys, using=None):
+    """
+    Remove resource IDs from the range privileges containing them.
+
+    A privilege set or forgotten on one resource replaces the ranges of the
+    same role, permission and resource type: each range containing some of
+    the IDs is replaced by the ranges of its other IDs. Nothing is done
+    when the RANGE_PRIVILEGES setting is False.
+
+    Args:
+        keys (iterable): (role_type, role_id, perm, resource_type,
+            resource_id) tuples.
+        using (str): the database alias, default to the write database.
+
+    Returns:
+        dict: for each key which was in a range, the authorization of this
+            range.
+    """
+    removed = {}
+    if not app_settings.range_privileges:
+        return removed
+    groups = {}
+    for role_type, role_id, perm, resource_type, resource_id in keys:
+        i = integer_id(resource_id)
+        if i is not None:
+            groups.setdefault(
+                (role_type, str(role_id), perm, resource_type), set()).add(i)
+    manager = RolePrivilegeRange.objects.db_manager(using)
+    with transaction.atomic(using=manager.db):
+        for (role_type, role_id, perm, resource_type), ids in (
+                groups.items()):
+            ids = sorted(ids)
+            for privilege_range in manager.filter(
+                    role_type=role_type, role_id=role_id, access_type=perm,
+                    resource_type=resource_type,
+                    start__lte=ids[-1], end__gte=ids[0]):
+                inside = ids[bisect_left(ids, privilege_range.start):
+                             bisect_right(ids, privilege_range.end)]
+                if not inside:
+                    continue
+                for i in inside:
+                    removed[(role_type, role_id, perm, resource_type,
+                             str(i))] = privilege_range.authorized
+                bounds = ([privilege_range.start - 1] + inside +
+                          [privilege_range.end + 1])
+                privilege_range.delete()
+                manager.bulk_create(
+                    RolePrivilegeRange(
+                        role_type=role_type, role_id=role_id,
+                        access_type=perm, resource_type=resource_type,
+                        authorized=privilege_range.authorized,
+                        start=previous + 1, end=following - 1)
+                    for previous, following in zip(bounds, bounds[1:])
+                    if following - previous > 1)
+    return removed
+
+
+def resolve_ranges(depths, resource_type, by_perm_and_id, consider):
+    """
+    Find the range privileges containing integer resource IDs.
+
+    Ranges are selected with ``start <= max(IDs)`` and
+    ``end >= min(IDs)`` predicates, one query per chunk of roles.
+
+    Args:
+        depths (dict): depth of each (role_type, role_id) to consider.
+        resource_type (str): a string describing the type of resource.
+        by_perm_and_id (dict): checks for each (perm, resource_id).
+        consider (callable): function receiving the checks matched by a
+            range, the role owning it, False and its authorization.
+    """
+    ids = sorted((integer_id(resource_id), perm)
+                 for perm, resource_id in by_perm_and_id
+                 if integer_id(resource_id) is not None)
+    if not ids:
+        return
+    keys = [i for i, _ in ids]
+    for roles_chunk in chunked(depths, 400):
+        ranges = RolePrivilegeRange.objects.filter(
+            roles_filter(roles_chunk), resource_type=resource_type,
+            access_type__in={perm for _, perm in ids},
+            start__lte=keys[-1], end__gte=keys[0]
+        ).values_list('role_type', 'role_id', 'access_type', 'start',
+                      'end', 'authorized')
+        for p_role_type, p_role_id, perm, start, end, authorized in (
+                ranges):
+            role = (p_role_type, p_role_id)
+            if role not in depths:
+                continue
+            for i, i_perm in ids[bisect_left(keys, start):
+                                 bisect_right(keys, end)]:
+                if i_perm == perm:
+                    consider(by_perm_and_id[(perm, str(i))], role,
+                             False, authorized)
+
+
+def layer_range_filters(depths, perm, resource_type, model):
+    """
+    Return the primary key range filters of each layer of roles.
+
+    The ranges of every role are loaded with one query.
+
+    Args:
+        depths (dict): depth of each (role_type, role_id) to consider.
+        perm (str): the privilege.
+        resource_type (str): a string describing the type of resource.
+        model (Model): the resource model, which primary key must be an
+            integer for ranges to apply.
+
+    Returns:
+        dict: for False (denials) and True (authorizations), the filter of
+            each depth having ranges.
+    """
+    ranges = {False: {}, True: {}}
+    if model._meta.pk.get_internal_type() not in INTEGER_FIELDS:
+        return ranges
+    for p_role_type, p_role_id, authorized, start, end in (
+            RolePrivilegeRange.objects.filter(
+                roles_filter(depths), access_type=perm,
+                resource_type=resource_type
+            ).values_list('role_type', 'role_id', 'authorized',
+                          'start', 'end')):
+        depth = depths.get((p_role_type, p_role_id))
+        if depth is not None:
+            ranges[authorized].setdefault(depth, Q())
+            ranges[authorized][depth] |= Q(pk__range=(start, end))
+    return ranges
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+"""Signals module."""
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .apps import AppSettings
+from .cache import invalidate_decisions
+from .metrics import record_bulk_check, record_check, record_filter
+from .models import (  # noqa
+    RoleHierarchy, RoleHierarchyClosure, RolePrivilege, RolePrivilegeRange,
+    accessible_filtered, authorization_bulk_checked, authorization_checked)
+
+app_settings = AppSettings()
+
+
+@receiver(post_save, sender=RolePrivilege)
+@receiver(post_delete, sender=RolePrivilege)
+@receiver(post_save, sender=RolePrivilegeRange)
+@receiver(post_delete, sender=RolePrivilegeRange)
+@receiver(post_save, sender=RoleHierarchy)
+@receiver(post_delete, sender=RoleHierarchy)
+def policy_changed(sender, using=None, **kwargs):
+    """Invalidate cached decisions when privileges or hierarchy change."""
+    invalidate_decisions(using)
+
+
+@receiver(pre_save, sender=RoleHierarchy)
+def remember_previous_link(sender, instance, raw=False, **kwargs):
+    """Remember the link a hierarchy row had before being edited."""
+    if instance.pk and not raw and app_settings.hierarchy_closure:
+        instance._previous_link = sender.objects.filter(
+            pk=instance.pk).values_list(
+            'role_type_a', 'role_id_a', 'role_type_b', 'role_id_b').first()
+
+
+@receiver(post_save, sender=RoleHierarchy)
+def link_saved(sender, instance, raw=False, using=None, **kwargs):
+    """
+    Update the hierarchy closure when a link is created or edited.
+
+    Raw saves, like the ones of ``loaddata``, schedule a rebuild of the
+    closure instead, run when their transaction commits. Writes sending no
+    signal are not handled: see ``RoleHierarchyClosure``.
+    """
+    if not app_settings.hierarchy_closure:
+        return
+    if raw:
+        schedule_closure_rebuild(using)
+        return
+    link = (instance.role_type_a, instance.role_id_a,
+            instance.role_type_b, instance.role_id_b)
+    previous = getattr(instance, '_previous_link', None)
+    instance._previous_link = link
+    if previous == link:
+        return
+    if previous is not None:
+        RoleHierarchyClosure.remove_link(previous[0], previous[1])
+    RoleHierarchyClosure.add_link(*link)
+
+
+@receiver(post_delete, sender=RoleHierarchy)
+def link_deleted(sender, instance, **kwargs):
+    """Update the hierarchy closure when a link is deleted."""
+    if app_settings.hierarchy_closure:
+        RoleHierarchyClosure.remove_link(
+            instance.role_type_a, instance.role_id_a)
+
+
+def schedule_closure_rebuild(using=None):
+    """
+    Rebuild the hierarchy closure, once, when the transaction commits.
+
+    Args:
+        using (str): alias of the database written to, default to the
+            default database.
+    """
+    connection = transaction.get_connection(using)
+    if not connection.in_atomic_block:
+        rebuild_closure()
+    elif not any(callback[1] is rebuild_closure
+                 for callback in connection.run_on_commit):
+        transaction.on_commit(rebuild_closure, using=using)
+
+
+def rebuild_closure():
+    """Rebuild the hierarchy closure and invalidate cached decisions."""
+    RoleHierarchyClosure.rebuild()
+    invalidate_decisions()
+
+
+if app_settings.metrics:
+    authorization_checked.connect(record_check, sender=RolePrivilege)
+    authorization_bulk_checked.connect(
+        record_bulk_check, sender=RolePrivilege)
+    accessible_filtered.connect(record_filter, sender=RolePrivilege)
@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+
+"""
+Transfer module, streaming privileges and hierarchy links in and out.
+
+Records are dictionaries with a ``model`` key (``privilege``, ``range``
+or ``hierarchy``) and the fields of the model. They are written and read as
+JSON lines or CSV rows, one record at a time, so that memory stays
+constant whatever the number of rows.
+"""
+
+import csv
+import json
+from collections import OrderedDict
+
+from django.db import transaction
+
+from .apps import AppSettings
+from .cache import invalidate_decisions
+from .models import (
+    RoleHierarchy, RoleHierarchyClosure, RolePrivilege, RolePrivilegeRange)
+from .utils import chunked, raw_delete
+
+app_settings = AppSettings()
+
+PRIVILEGE = 'privilege'
+RANGE = 'range'
+HIERARCHY = 'hierarchy'
+
+FIELDS = {
+    PRIVILEGE: ('role_type', 'role_id', 'access_type', 'resource_type',
+                'resource_id', 'authorized'),
+    RANGE: ('role_type', 'role_id', 'access_type', 'resource_type',
+            'start', 'end', 'authorized'),
+    HIERARCHY: ('role_type_a', 'role_id_a', 'role_type_b', 'role_id_b'),
+}
+MODELS = {PRIVILEGE: RolePrivilege, RANGE: RolePrivilegeRange,
+          HIERARCHY: RoleHierarchy}
+CSV_FIELDS = ('model', ) + FIELDS[PRIVILEGE] + (
+    'start', 'end') + FIELDS[HIERARCHY] + ('forget', )
+
+FORMATS = ('jsonl', 'csv')
+
+
+def iter_records(models=(PRIVILEGE, RANGE, HIERARCHY), chunk_size=2000):
+    """
+    Iterate on the records of the given models.
+
+    Rows are read with keyset pagination on the primary key, one query per
+    chunk, so that only one chunk is held in memory.
+
+    Args:
+        models (tuple): ``privilege``, ``range`` and/or ``hierarchy``.
+        chunk_size (int): number of rows read per query.
+
+    Yields:
+        dict: the successive records.
+    """
+    for name in models:
+        fields = FIELDS[name]
+        queryset = MODELS[name].objects.order_by('pk')
+        last = None
+        while True:
+            rows = queryset if last is None else queryset.filter(pk__gt=last)
+            rows = list(rows.values_list('pk', *fields)[:chunk_size])
+            for row in rows:
+                record = dict(zip(fields, row[1:]))
+                record['model'] = name
+                yield record
+            if len(rows) < chunk_size:
+                break
+            last = rows[-1][0]
+
+
+def write_records(records, stream, fmt='jsonl'):
+    """
+    Write records to a text stream.
+
+    Args:
+        records (iterable): the records to write.
+        stream (file): the text stream.
+        fmt (str): ``jsonl`` or ``csv``.
+
+    Returns:
+        int: the number of written records.
+    """
+    count = 0
+    if fmt == 'csv':
+        writer = csv.DictWriter(stream, CSV_FIELDS)
+        writer.writeheader()
+        for count, record in enumerate(records, 1):
+            writer.writerow(record)
+    else:
+        for count, record in enumerate(records, 1):
+            stream.write(json.dumps(record, sort_keys=True) + '\n')
+    return count
+
+
+def _boolean(value):
+    if value is None or isinstance(value, bool):
+        return value
+    value = str(value).strip().lower()
+    if value in ('', 'none', 'null'):
+        return None
+    if value in ('1', 'true', 'yes'):
+        return True
+    if value in ('0', 'false', 'no'):
+        return False
+    raise ValueError('invalid boolean %r' % value)
+
+
+def _text(value):
+    # only a missing value is empty: a resource ID 0 is not type-level
+    return '' if value is None else str(value)
+
+
+def _guess_model(record):
+    if record.get('role_type_a'):
+        return HIERARCHY
+    if record.get('start') not in (None, ''):
+        return RANGE
+    return PRIVILEGE
+
+
+def parse_record(record):
+    """
+    Validate a record read from JSON or CSV.
+
+    The model is guessed from the fields when the ``model`` key is missing.
+    A null ``authorized`` forgets the privilege (or range), a true
+    ``forget`` removes the hierarchy link.
+
+    Args:
+        record (dict): the record.
+
+    Returns:
+        tuple: the model name and the tuple of its field values, followed by
+            the authorization (privileges and ranges) or whether to remove
+            the link (hierarchy).
+
+    Raises:
+        ValueError: if the record is invalid.
+    """
+    name = record.get('model') or _guess_model(record)
+    if name not in FIELDS:
+        raise ValueError('unknown model %r' % name)
+    if name in (PRIVILEGE, RANGE):
+        required = ('role_type', 'access_type', 'resource_type')
+        if 'authorized' not in record:
+            raise ValueError('missing field authorized')
+        values = tuple(_text(record.get(f)) for f in FIELDS[name][:-1])
+        if name == RANGE:
+            values = values[:4] + (int(values[4]), int(values[5]))
+            if values[4] > values[5]:
+                raise ValueError('range start after its end')
+        values += (_boolean(record['authorized']), )
+    else:
+        required = ('role_type_a', 'role_type_b')
+        values = tuple(_text(record.get(f)) for f in FIELDS[name])
+        values += (bool(_boolean(record.get('forget'))), )
+    for field in required:
+        if not record.get(field):
+            raise ValueError('missing field %s' % field)
+    return name, values
+
+
+def read_records(stream, fmt='jsonl'):
+    """
+    Read records from a text stream.
+
+    Args:
+        stream (file): the text stream.
+        fmt (str): ``jsonl`` or ``csv``.
+
+    Yields:
+        tuple: the line number, and the result of ``parse_record``.
+
+    Raises:
+        ValueError: if a record is invalid, with its line number.
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        rows = ((reader.line_num, row) for row in reader)
+    else:
+        rows = ((number, line) for number, line in enumerate(stream, 1)
+                if line.strip())
+    for number, row in rows:
+        try:
+            if fmt != 'csv':
+                row = json.loads(row)
+            yield number, parse_record(row)
+        except ValueError as error:
+            raise ValueError('line %d: %s' % (number, error))
+
+
+def diff_links(links, batch_size=400):
+    """
+    Compare hierarchy links to the existing ones.
+
+    Args:
+        links (iterable): (role_type_a, role_id_a, role_type_b, role_id_b,
+            forget) tuples. When a link is given several times, the last one
+            wins.
+        batch_size (int): number of heirs per query.
+
+    Returns:
+        dict: the unsaved links to ``create``, the ``unchanged`` ones and
+            the existing links to ``delete``.
+    """
+    wanted = OrderedDict()
+    heirs = {}
+    for link in links:
+        wanted[tuple(link[:4])] = link[4]
+        heirs.setdefault(link[0], set()).add(link[1])
+    existing = {}
+    for role_type_a, role_ids_a in heirs.items():
+        for chunk in chunked(role_ids_a, batch_size):
+            for link in RoleHierarchy.objects.filter(
+                    role_type_a=role_type_a, role_id_a__in=chunk):
+                existing[(link.role_type_a, link.role_id_a,
+                          link.role_type_b, link.role_id_b)] = link
+    changes = {'create': [], 'unchanged': [], 'delete': []}
+    for key, forget in wanted.items():
+        link = existing.get(key)
+        if forget:
+            if link is not None:
+                changes['delete'].append(link)
+        elif link is None:
+            changes['create'].append(RoleHierarchy(
+                role_type_a=key[0], role_id_a=key[1],
+                role_type_b=key[2], role_id_b=key[3]))
+        else:
+            changes['unchanged'].append(link)
+    return changes
+
+
+def apply_links(links, batch_size=400):
+    """
+    Create and delete hierarchy links in one transaction.
+
+    Signals are not sent: the caller must rebuild the hierarchy closure
+    and invalidate cached decisions.
+
+    Args:
+        links (iterable): see ``diff_links``.
+        batch_size (int): number of rows per query.
+
+    Returns:
+        dict: the number of links created, unchanged and deleted.
+    """
+    with transaction.atomic():
+        changes = diff_links(links, batch_size)
+        RoleHierarchy.objects.bulk_create(
+            changes['create'], batch_size=batch_size)
+        raw_delete(RoleHierarchy, RoleHierarchy.objects.db,
+                   [link.pk for link in changes['delete']], batch_size)
+    return {'created': len(changes['create']),
+            'unchanged': len(changes['unchanged']),
+            'deleted': len(changes['delete'])}
+
+
+def diff_ranges(ranges, batch_size=400):
+    """
+    Compare range privileges to the existing ones.
+
+    Args:
+        ranges (iterable): (role_type, role_id, perm, resource_type, start,
+            end, authorized) tuples, authorized being True, False, or None
+            to forget the range. When a range is given several times, the
+            last one wins.
+        batch_size (int): number of roles per query.
+
+    Returns:
+        dict: the unsaved ranges to ``create``, the existing ranges to
+            ``update`` (with their new value), the ``unchanged`` ones and
+            the ones to ``delete``.
+    """
+    wanted = OrderedDict()
+    roles = {}
+    for grant in ranges:
+        wanted[tuple(grant[:6])] = grant[6]
+        roles.setdefault((grant[0], grant[3]), set()).add(grant[1])
+    existing = {}
+    for (role_type, resource_type), role_ids in roles.items():
+        for chunk in chunked(role_ids, batch_size):
+            for grant in RolePrivilegeRange.objects.filter(
+                    role_type=role_type, role_id__in=chunk,
+                    resource_type=resource_type):
+                existing[(grant.role_type, grant.role_id, grant.access_type,
+                          grant.resource_type, grant.start,
+                          grant.end)] = grant
+    changes = {'create': [], 'update': [], 'unchanged': [], 'delete': []}
+    for key, authorized in wanted.items():
+        grant = existing.get(key)
+        if authorized is None:
+            if grant is not None:
+                changes['delete'].append(grant)
+        elif grant is None:
+            changes['create'].append(RolePrivilegeRange(
+                role_type=key[0], role_id=key[1], access_type=key[2],
+                resource_type=key[3], start=key[4], end=key[5],
+                authorized=authorized))
+        elif grant.authorized != authorized:
+            grant.authorized = authorized
+            changes['update'].append(grant)
+        else:
+            changes['unchanged'].append(grant)
+    return changes
+
+
+def apply_ranges(ranges, batch_size=400):
+    """
+    Create, update and delete range privileges in one transaction.
+
+    Signals are not sent: the caller must invalidate cached decisions.
+
+    Args:
+        ranges (iterable): see ``diff_ranges``.
+        batch_size (int): number of rows per query.
+
+    Returns:
+        dict: the number of ranges created, updated, unchanged and deleted.
+    """
+    with transaction.atomic():
+        changes = diff_ranges(ranges, batch_size)
+        RolePrivilegeRange.objects.bulk_create(
+            changes['create'], batch_size=batch_size)
+        for authorized in (True, False):
+            updated = [grant.pk for grant in changes['update']
+                       if grant.authorized == authorized]
+            for chunk in chunked(updated, batch_size):
+                RolePrivilegeRange.objects.filter(pk__in=chunk).update(
+                    authorized=authorized)
+        raw_delete(RolePrivilegeRange, RolePrivilegeRange.objects.db,
+                   [grant.pk for grant in changes['delete']], batch_size)
+    return {'created': len(changes['create']),
+            'updated': len(changes['update']),
+            'unchanged': len(changes['unchanged']),
+            'deleted': len(changes['delete'])}
+
+
+def import_records(records, user=None, log=True, dry_run=False,
+                   batch_size=1000, report=None):
+    """
+    Apply records, one transaction per chunk.
+
+    Privileges are applied with ``RolePrivilegeQuerySet.bulk_set``, which
+    records their history in bulk. In dry-run mode, changes are only
+    computed, and reported one by one if ``report`` is given. The hierarchy
+    closure and cached decisions are refreshed once, even when a record
+    fails after some chunks were committed.
+
+    Args:
+        records (iterable): results of ``parse_record``.
+        user (User): an instance of settings.AUTH_USER_MODEL.
+        log (bool): whether to record entries in privileges history.
+        dry_run (bool): whether to only compute the changes.
+        batch_size (int): number of records per transaction.
+        report (callable): function receiving the changes (dry-run mode).
+
+    Returns:
+        dict: the counts of created, updated, unchanged and deleted
+            privileges, ranges and hierarchy links.
+    """
+    counts = {
+        PRIVILEGE: dict.fromkeys(
+            ('created', 'updated', 'unchanged', 'deleted'), 0),
+        RANGE: dict.fromkeys(
+            ('created', 'updated', 'unchanged', 'deleted'), 0),
+        HIERARCHY: dict.fromkeys(('created', 'unchanged', 'deleted'), 0),
+    }
+    try:
+        for chunk in chunked(records, batch_size):
+            privileges = [v for n, v in chunk if n == PRIVILEGE]
+            ranges = [v for n, v in chunk if n == RANGE]
+            links = [v for n, v in chunk if n == HIERARCHY]
+            if dry_run:
+                result = {
+                    PRIVILEGE: _dry_run(
+                        RolePrivilege.objects.diff(privileges), report),
+                    RANGE: _dry_run(diff_ranges(ranges), report),
+                    HIERARCHY: _dry_run(diff_links(links), report)}
+            else:
+                result = {
+                    PRIVILEGE: RolePrivilege.objects.bulk_set(
+                        privileges, user=user, log=log),
+                    RANGE: apply_ranges(ranges),
+                    HIERARCHY: apply_links(links)}
+            for name, result_counts in result.items():
+                for key, value in result_counts.items():
+                    counts[name][key] += value
+    finally:
+        # committed chunks must not leave a stale closure or cache behind
+        if not dry_run:
+            if counts[HIERARCHY]['created'] or counts[HIERARCHY]['deleted']:
+                if app_settings.hierarchy_closure:
+                    RoleHierarchyClosure.rebuild()
+                invalidate_decisions()
+            elif any(counts[RANGE][key]
+                     for key in ('created', 'updated', 'deleted')):
+                invalidate_decisions()
+    return counts
+
+
+def _dry_run(changes, report):
+    actions = {'create': 'created', 'update': 'updated',
+               'unchanged': 'unchanged', 'delete': 'deleted'}
+    if report:
+        for action, sign in (('create', '+'), ('update', '~'),
+                             ('delete', '-')):
+            for instance in changes.get(action, ()):
+                report('%s %s' % (sign, instance))
+    return {actions[action]: len(instances)
+            for action, instances in changes.items()}
@@ -59,7 +59,19 @@ def cerberus_urlpatterns(admin_view_func=lambda x: x):
         # hierarchy
         url(r'^role/hierarchy/$',
             admin_view_func(views.ViewRoleHierarchy.as_view()),
-            name='role_hierarchy')
+            name='role_hierarchy'),
+        url(r'^role/hierarchy/graph/$',
+            admin_view_func(views.ajax_role_hierarchy_graph),
+            name='role_hierarchy_graph'),
+
+        # metrics
+        url(r'^metrics/$',
+            admin_view_func(views.Metrics.as_view()),
+            name='metrics'),
+        # not an admin view: protected by the METRICS_TOKEN setting, or
+        # restricted to staff users
+        url(r'^metrics/prometheus/$', views.prometheus_metrics,
+            name='prometheus_metrics'),
     ]
 
 
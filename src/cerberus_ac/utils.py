@@ -2,12 +2,22 @@
 
 """Utils module."""
 
+import re
+from collections import deque
+from itertools import islice
+
 from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
+from django.db import connections
+from django.db.models import Q, QuerySet
+from django.utils.functional import cached_property
 
 from .apps import AppSettings
 
 app_settings = AppSettings()
 
+# ASCII digits only: str.isdigit accepts characters int() rejects
+INTEGER_ID = re.compile(r'[0-9]+\Z')
+
 
 def get_paginated_data(instances, page, num):
     paginator = Paginator(instances, num)
@@ -23,6 +33,271 @@ def get_paginated_data(instances, page, num):
     return paginated_data
 
 
+def estimate_count(queryset):
+    """
+    Return the number of rows of a queryset estimated by the database.
+
+    Only PostgreSQL is supported, using the row estimate of the query plan,
+    which does not scan the table.
+
+    Args:
+        queryset (QuerySet): the queryset to count.
+
+    Returns:
+        int: the estimated count, or None if not supported.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN ' + sql, params)
+        plan = cursor.fetchone()[0]
+    match = re.search(r'rows=(\d+)', plan)
+    return int(match.group(1)) if match else None
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator using estimated counts for large querysets.
+
+    When the database estimates a queryset has more than
+    ``exact_count_limit`` rows, the estimate is used instead of an exact
+    ``COUNT(*)``, which can take seconds on large tables. The last pages
+    may then be incomplete or empty.
+    """
+
+    exact_count_limit = 100000
+
+    @cached_property
+    def count(self):
+        """Return the estimated or exact number of objects."""
+        if isinstance(self.object_list, QuerySet):
+            estimate = estimate_count(self.object_list)
+            if estimate is not None and estimate > self.exact_count_limit:
+                return estimate
+        return super(EstimatedCountPaginator, self).count
+
+
+def chunked(iterable, size):
+    """
+    Split an iterable into lists of at most ``size`` items.
+
+    Args:
+        iterable (iterable): the items to split.
+        size (int): the maximum size of each chunk.
+
+    Yields:
+        list: the successive chunks.
+    """
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
+def raw_delete(model, db, pks, batch_size=400):
+    """
+    Delete rows with one DELETE query per chunk, without signals.
+
+    Nothing is cascaded: the caller must handle the rows referencing the
+    deleted ones.
+
+    Args:
+        model (Model): the model of the rows.
+        db (str): the database alias.
+        pks (iterable): the primary keys of the rows.
+        batch_size (int): number of primary keys per query.
+
+    Returns:
+        int: the number of deleted rows.
+    """
+    connection = connections[db]
+    table = connection.ops.quote_name(model._meta.db_table)
+    pk_column = connection.ops.quote_name(model._meta.pk.column)
+    deleted = 0
+    for chunk in chunked(pks, batch_size):
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (
+                table, pk_column, ', '.join(['%s'] * len(chunk))), chunk)
+            deleted += cursor.rowcount
+    return deleted
+
+
+def integer_id(resource_id):
+    """
+    Return a resource ID as an integer, if it is the text of an integer.
+
+    Args:
+        resource_id (str): the resource's ID.
+
+    Returns:
+        int: the integer ID, or None.
+    """
+    resource_id = str(resource_id)
+    if INTEGER_ID.match(resource_id) and (
+            str(int(resource_id)) == resource_id):
+        return int(resource_id)
+    return None
+
+
+def roles_filter(roles, type_field='role_type', id_field='role_id'):
+    """
+    Return a filter matching any of the given roles.
+
+    Roles are grouped by type, giving one ``type AND id IN (...)`` condition
+    per type.
+
+    Args:
+        roles (iterable): (role_type, role_id) tuples.
+        type_field (str): name of the role type field.
+        id_field (str): name of the role ID field.
+
+    Returns:
+        Q: the filter.
+    """
+    ids_by_type = {}
+    for role_type, role_id in roles:
+        ids_by_type.setdefault(role_type, []).append(role_id)
+    condition = Q()
+    for role_type in sorted(ids_by_type):
+        condition |= Q(**{type_field: role_type,
+                          id_field + '__in': ids_by_type[role_type]})
+    return condition
+
+
+def transitive_closure(links):
+    """
+    Compute the transitive closure of a role hierarchy.
+
+    Args:
+        links (iterable): (heir, conveyor) pairs, roles being
+            (role_type, role_id) tuples.
+
+    Yields:
+        tuple: (descendant, ancestor, depth) triples, depth being the length
+            of the shortest path from the descendant to the ancestor.
+    """
+    conveyors = {}
+    for heir, conveyor in links:
+        conveyors.setdefault(heir, set()).add(conveyor)
+    for descendant in conveyors:
+        depths = {descendant: 0}
+        queue = deque([descendant])
+        while queue:
+            role = queue.popleft()
+            for conveyor in conveyors.get(role, ()):
+                if conveyor not in depths:
+                    depths[conveyor] = depths[role] + 1
+                    queue.append(conveyor)
+                    yield descendant, conveyor, depths[conveyor]
+
+
+class QueryCounter(object):
+    """
+    Context manager counting the queries run on a database connection.
+
+    Unlike ``CaptureQueriesContext``, it does not force the debug cursor
+    nor keep the queries: the ``count`` attribute is incremented by an
+    execute wrapper (Django 2.0+), or by a proxy of the cursors created
+    by the connection (older versions).
+    """
+
+    def __init__(self, connection):
+        """
+        Initialization method.
+
+        Args:
+            connection (DatabaseWrapper): a Django database connection.
+        """
+        self.connection = connection
+        self.count = 0
+        self._previous = None
+
+    def __call__(self, execute, sql, params, many, context):
+        """Count a query, as an execute wrapper."""
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def __enter__(self):
+        """Start counting the queries of the connection."""
+        connection = self.connection
+        if hasattr(connection, 'execute_wrappers'):
+            connection.execute_wrappers.append(self)
+        else:
+            # instance attributes shadowing the methods of the connection
+            self._previous = {
+                name: connection.__dict__.get(name)
+                for name in ('make_cursor', 'make_debug_cursor')}
+            for name in self._previous:
+                setattr(connection, name, self._wrap(getattr(
+                    connection, name)))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Stop counting the queries of the connection."""
+        connection = self.connection
+        if self._previous is None:
+            connection.execute_wrappers.remove(self)
+            return
+        for name, previous in self._previous.items():
+            if previous is None:
+                delattr(connection, name)
+            else:
+                setattr(connection, name, previous)
+        self._previous = None
+
+    def _wrap(self, make_cursor):
+        def wrapper(cursor):
+            return _CountingCursor(make_cursor(cursor), self)
+        return wrapper
+
+
+class _CountingCursor(object):
+    def __init__(self, cursor, counter):
+        self.cursor = cursor
+        self.counter = counter
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return self.cursor.__exit__(exc_type, exc_value, traceback)
+
+    def execute(self, sql, params=None):
+        self.counter.count += 1
+        return self.cursor.execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        self.counter.count += 1
+        return self.cursor.executemany(sql, param_list)
+
+
+def supports_recursive_queries(connection):
+    """
+    Tell if a database connection supports ``WITH RECURSIVE`` queries.
+
+    Args:
+        connection (DatabaseWrapper): a Django database connection.
+
+    Returns:
+        bool: True for PostgreSQL and SQLite 3.8.3+, False otherwise.
+    """
+    if connection.vendor == 'postgresql':
+        return True
+    if connection.vendor == 'sqlite':
+        from sqlite3 import sqlite_version_info
+        return sqlite_version_info >= (3, 8, 3)
+    return False
+
+
 def get_role_type(role):
     """
     Get a role's type.
@@ -3,19 +3,27 @@
 """Views module."""
 
 import json
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
 
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.crypto import constant_time_compare
 from django.utils.translation import ugettext as _
-from django.views.defaults import bad_request
+from django.views.defaults import bad_request, permission_denied
 
 from suit_dashboard import Box, Column, DashboardView, Grid, Row
 
+from . import metrics
 from .apps import AppSettings
-from .models import RoleHierarchy, RolePrivilege
-from .utils import get_role_id, get_role_type
+from .models import RoleHierarchy, RolePrivilege, RolePrivilegeRange
+from .ranges import INTEGER_FIELDS
+from .utils import chunked, get_role_id, get_role_type
 
 app_settings = AppSettings()
 
+MAX_PRIVILEGES_PAGE = 500
+MAX_GRAPH_DEPTH = 10
+
 
 class Index(DashboardView):
     """Cerberus menu."""
@@ -140,67 +148,220 @@ class EditPrivileges(Privileges):
         return super(EditPrivileges, self).get(request, *args, **kwargs)
 
 
-class ViewRoleHierarchy(Index):
-    """Role hierarchy view."""
+class Metrics(Index):
+    """View to see the authorization metrics."""
 
-    title = _('Role Hierarchy Graph - Cerberus AC')
-    crumbs = ({'name': _('Role Hierarchy Graph'),
-               'url': 'admin:cerberus:role_hierarchy'},)
+    title = _('Metrics - Cerberus AC')
+    crumbs = ({'name': _('Metrics'), 'url': 'admin:cerberus:metrics'},)
 
     def get(self, request, *args, **kwargs):
-        # link
-        # {"source": 3, "target": 11}
-        # node
-        # {"size": 10, "score": 0, "id": "security", "type": "circle"}
-
-        roles = []
-        links = []
-        count = {}
-        for tuple4 in list(RoleHierarchy.objects.values_list(
-                'role_type_a', 'role_id_a', 'role_type_b', 'role_id_b')):
-            role_a = ('%s %s' % (tuple4[0], tuple4[1])) if tuple4[1] else tuple4[0]  # noqa
-            role_b = (('%s %s' % (tuple4[2], tuple4[3])) if tuple4[3] else tuple4[2])  # noqa
-            if role_a not in count:
-                count[role_a] = 1
-                roles.append(role_a)
-            else:
-                count[role_a] += 1
-            if role_b not in count:
-                count[role_b] = 1
-                roles.append(role_b)
-            else:
-                count[role_b] += 1
-            # I think we can add scores on links
-            links.append({'source': roles.index(role_b),
-                          'target': roles.index(role_a)})
-
-        # possible types: circle, square, triangle-up/down, diamond, cross
-        data = {
-            'directed': True,
-            'multigraph': False,
-            'links': links,
-            'nodes': [
-                {'size': min(count[r], 50), 'score': min(count[r] / 100, 1),
-                 'id': r if ' ' not in r else str(
-                     app_settings.mapping.get_instance(*r.split(' '))),
-                 'type': {
-                     # FIXME: put this outside of cerberus: it's genida related
-                     'member': 'circle',
-                     'relative': 'square',
-                     'cohort': 'diamond',
-                     'gene': 'cross',
-                     'copy_number_variant': 'cross',
-                 }.get(r.split(' ')[0], 'triangle-down')}
-                for r in roles
-            ]
-        }
+        snapshot = metrics.get_snapshot()
+
+        def table(name, quantiles=False):
+            metric = snapshot[name]
+            rows = []
+            for values, value in metric['samples']:
+                row = {'labels': dict(zip(metric['labels'], values))}
+                if metric['type'] != 'histogram':
+                    row['count'] = value
+                else:
+                    row['count'] = value['count']
+                    row['mean'] = value['sum'] / (value['count'] or 1)
+                    row['p50'] = metrics.quantile(
+                        metric['buckets'], value['counts'], 0.5)
+                    row['p99'] = metrics.quantile(
+                        metric['buckets'], value['counts'], 0.99)
+                    row['buckets'] = list(zip(
+                        metric['buckets'] + ['+Inf'], value['counts']))
+                rows.append(row)
+            return rows
 
         self.grid = Grid(Row(Column(Box(
-            title='Role Hierarchy Graph',
-            template='cerberus_ac/view_role_hierarchy.html',
-            context=json.dumps(data)))))
+            title=_('Authorization metrics'),
+            template='cerberus_ac/metrics.html',
+            context={
+                'enabled': app_settings.metrics,
+                'checks': table('cerberus_check_seconds'),
+                'decisions': table('cerberus_decisions_total'),
+                'cache': table('cerberus_decision_cache_total'),
+                'layers': table('cerberus_hierarchy_layers'),
+                'depths': table('cerberus_decision_depth'),
+                'flushes': table('cerberus_access_log_flush_size'),
+            }))))
 
-        return super(ViewRoleHierarchy, self).get(request, *args, **kwargs)
+        return super(Metrics, self).get(request, *args, **kwargs)
+
+
+class ViewRoleHierarchy(Index):
+    """
+    Role hierarchy view.
+
+    The graph is loaded from ``ajax_role_hierarchy_graph``, with the
+    parameters of the page URL.
+    """
+
+    title = _('Role Hierarchy Graph - Cerberus AC')
+    crumbs = ({'name': _('Role Hierarchy Graph'),
+               'url': 'admin:cerberus:role_hierarchy'},)
+    grid = Grid(Row(Column(Box(
+        title='Role Hierarchy Graph',
+        template='cerberus_ac/view_role_hierarchy.html'))))
+
+
+def stream_hierarchy_graph(links, roles=()):
+    """
+    Generate the JSON of a role hierarchy graph, piece by piece.
+
+    Links are written as they are read, in chunks of 1000, while nodes are
+    indexed in a dict. Nodes are written last, their size depending on
+    their number of links, and their labels are resolved in batches of 500
+    nodes with ``Mapping.get_instances``.
+
+    Args:
+        links (iterable): (role_type_a, role_id_a, role_type_b, role_id_b)
+            tuples, a inheriting privileges from b.
+        roles (iterable): (role_type, role_id) tuples to include in the nodes
+            even without links.
+
+    Yields:
+        str: pieces of the JSON document.
+    """
+    index = OrderedDict()
+    count = {}
+
+    def node_index(role):
+        if role not in index:
+            index[role] = len(index)
+            count[role] = 0
+        return index[role]
+
+    for role in roles:
+        node_index(role)
+
+    # link: {"source": 3, "target": 11}
+    yield '{"directed": true, "multigraph": false, "links": ['
+    for i, chunk in enumerate(chunked(links, 1000)):
+        edges = []
+        for role_type_a, role_id_a, role_type_b, role_id_b in chunk:
+            role_a = (role_type_a, role_id_a)
+            role_b = (role_type_b, role_id_b)
+            edges.append('{"source": %d, "target": %d}' % (
+                node_index(role_b), node_index(role_a)))
+            count[role_a] += 1
+            count[role_b] += 1
+        yield (', ' if i else '') + ', '.join(edges)
+
+    # node: {"size": 10, "score": 0, "id": "security", "type": "circle"}
+    # possible types: circle, square, triangle-up/down, diamond, cross
+    yield '], "nodes": ['
+    for i, chunk in enumerate(chunked(index, 500)):
+        instances = app_settings.mapping.get_instances(
+            role for role in chunk if role[1])
+        labels = {role: str(instance) for role, instance in zip(
+            [role for role in chunk if role[1]], instances)
+            if instance is not None}
+        yield (', ' if i else '') + ', '.join(json.dumps({
+            'size': min(count[role], 50),
+            'score': min(count[role] / 100, 1),
+            'id': labels.get(role, ' '.join(filter(None, role))),
+            'role_type': role[0],
+            'role_id': role[1],
+            'type': {
+                # FIXME: put this outside of cerberus: it's genida related
+                'member': 'circle',
+                'relative': 'square',
+                'cohort': 'diamond',
+                'gene': 'cross',
+                'copy_number_variant': 'cross',
+            }.get(role[0], 'triangle-down')}) for role in chunk)
+    yield ']}'
+
+
+def privileges_page_parameters(request):
+    """
+    Return the pagination parameters of a privileges request.
+
+    Args:
+        request (HttpRequest): the request, with optional ``offset``,
+            ``limit`` and ``after`` GET parameters.
+
+    Returns:
+        tuple: offset, limit (or None) and after (or None), as integers.
+
+    Raises:
+        ValueError: when a parameter is not an integer, when the limit is
+            not positive, or when the offset is negative.
+    """
+    offset = int(request.GET.get('offset', 0))
+    limit = request.GET.get('limit')
+    limit = min(int(limit), MAX_PRIVILEGES_PAGE) if limit else None
+    after = request.GET.get('after')
+    after = int(after) if after else None
+    if limit is not None and limit <= 0:
+        raise ValueError('limit must be positive')
+    if offset < 0:
+        raise ValueError('offset must not be negative')
+    return offset, limit, after
+
+
+def privileges_page(resource_ids, offset, limit, after=None):
+    """
+    Return a page of resource IDs, and whether there is a next page.
+
+    Args:
+        resource_ids (QuerySet): the resource IDs, ordered by ID.
+        offset (int): the number of IDs to skip, when after is None.
+        limit (int): the size of the page.
+        after (int): the last resource ID of the previous page.
+
+    Returns:
+        tuple: the list of resource IDs of the page, and a boolean.
+    """
+    if after is not None:
+        resource_ids = resource_ids.filter(id__gt=after)
+    else:
+        resource_ids = resource_ids[offset:]
+    resource_ids = list(resource_ids[:limit + 1])
+    return resource_ids[:limit], len(resource_ids) > limit
+
+
+def expand_privileges(privileges, ranges, resource_ids, access_types):
+    """
+    Map resources to their privileges, resolving range privileges.
+
+    Range privileges only apply to the resources without a privilege of the
+    same access type. Access types missing from ``access_types`` are
+    appended to it.
+
+    Args:
+        privileges (QuerySet): the RolePrivilege instances of the role.
+        ranges (QuerySet): the RolePrivilegeRange instances of the role.
+        resource_ids (list): the sorted resource IDs.
+        access_types (list): the access types, updated in place.
+
+    Returns:
+        dict: resource IDs as strings to dicts of access types to booleans.
+    """
+    by_resource = {}
+    found = []
+    for resource_id, access_type, authorized in privileges.values_list(
+            'resource_id', 'access_type', 'authorized'):
+        by_resource.setdefault(resource_id, {})[access_type] = authorized
+        found.append(access_type)
+    if resource_ids:
+        for access_type, authorized, start, end in ranges.filter(
+                start__lte=resource_ids[-1],
+                end__gte=resource_ids[0]).values_list(
+                'access_type', 'authorized', 'start', 'end'):
+            for resource_id in resource_ids[bisect_left(resource_ids, start):
+                                            bisect_right(resource_ids, end)]:
+                by_resource.setdefault(str(resource_id), {}).setdefault(
+                    access_type, authorized)
+            found.append(access_type)
+    for access_type in found:
+        if access_type not in access_types:
+            access_types.append(access_type)
+    return by_resource
 
 
 # Ajax views ------------------------------------------------------------------
@@ -268,27 +429,138 @@ def ajax_load_roles_and_resources(request, role_type, resource_type):
 
 
 def ajax_load_privileges(request, role_type, role_id, resource_type):
+    """
+    Return the privileges of a role on the resources of a type.
+
+    Without parameters, the response is a list with one dict per resource,
+    ordered by ID, mapping access types to True, False or None.
+
+    With the ``limit`` parameter, and either ``offset`` or ``after`` (the
+    last resource ID of the previous page), only a page of resources is
+    returned, as a dict with ``privileges``, a list of
+    (resource ID, privileges dict) pairs, and ``next``, the ``after``
+    value of the next page or None. ``limit`` must be positive and
+    ``offset`` not negative. ``after`` is an integer: keyset pagination
+    assumes the resources have comparable integer IDs, other resources
+    must be paginated with ``offset``.
+
+    Access types are the ACCESS_TYPES setting, plus the other access types
+    found in the privileges of the role. When the RANGE_PRIVILEGES setting
+    is True and resource IDs are integers, the resources without privilege
+    take the authorization of the range privileges containing them.
+    """
     if not request.is_ajax():
         return bad_request(request, ValueError('not an ajax request'))
 
-    resource_class = app_settings.mapping.get_class(resource_type)
-    resource_instances = resource_class.objects.order_by('id')
+    try:
+        offset, limit, after = privileges_page_parameters(request)
+    except ValueError as e:
+        return bad_request(request, e)
 
-    default_access_types = ('read', 'update', 'delete')
+    resource_class = app_settings.mapping.get_class(resource_type)
+    integer_ids = (
+        resource_class._meta.pk.get_internal_type() in INTEGER_FIELDS)
+    if after is not None and not integer_ids:
+        return bad_request(request, ValueError('after needs integer IDs'))
+    resource_ids = resource_class.objects.order_by('id').values_list(
+        'id', flat=True)
+    privileges = RolePrivilege.objects.filter(
+        role_type=role_type, role_id=role_id, resource_type=resource_type)
+    ranges = RolePrivilegeRange.objects.none()
+    if app_settings.range_privileges and integer_ids:
+        ranges = RolePrivilegeRange.objects.filter(
+            role_type=role_type, role_id=role_id,
+            resource_type=resource_type)
+
+    access_types = list(app_settings.access_types)
+    has_next = False
+    if limit:
+        # access types of every page, not just this one
+        found = set(privileges.values_list(
+            'access_type', flat=True).distinct())
+        found.update(ranges.values_list('access_type', flat=True).distinct())
+        access_types.extend(sorted(found - set(access_types)))
+        resource_ids, has_next = privileges_page(
+            resource_ids, offset, limit, after)
+        privileges = privileges.filter(
+            resource_id__in=[str(i) for i in resource_ids])
+    else:
+        resource_ids = list(resource_ids)
+
+    by_resource = expand_privileges(
+        privileges, ranges, resource_ids, access_types)
+    rows = []
+    for resource_id in resource_ids:
+        current_privileges = dict.fromkeys(access_types)
+        current_privileges.update(by_resource.get(str(resource_id), {}))
+        rows.append(current_privileges)
+
+    if not limit:
+        data = rows
+    else:
+        data = {
+            'privileges': list(zip(resource_ids, rows)),
+            'next': resource_ids[-1] if has_next else None,
+        }
 
-    data = []
+    return HttpResponse(json.dumps(data), content_type="application/json")
 
-    for resource in resource_instances:
-        current_privileges = {}
-        db_access_types = []
-        for privilege in RolePrivilege.objects.filter(
-                role_type=role_type, role_id=role_id,
-                resource_type=resource_type, resource_id=resource.id):
-            current_privileges[privilege.access_type] = privilege.authorized
-            db_access_types.append(privilege.access_type)
-        for default_access_type in default_access_types:
-            if default_access_type not in db_access_types:
-                current_privileges[default_access_type] = None
-        data.append(current_privileges)
 
-    return HttpResponse(json.dumps(data), content_type="application/json")
+def ajax_role_hierarchy_graph(request):
+    """
+    Return the role hierarchy graph as a streamed JSON response.
+
+    Without parameters, the whole hierarchy is returned. With the
+    ``role_type`` and ``role_id`` parameters, only the roles linked to this
+    role up to ``depth`` links (default 1, at most ``MAX_GRAPH_DEPTH``)
+    are returned, ``direction``
+    being ``ancestors``, ``descendants`` or ``both`` (default).
+    """
+    role_type = request.GET.get('role_type')
+    if not role_type:
+        links = RoleHierarchy.objects.values_list(
+            'role_type_a', 'role_id_a', 'role_type_b', 'role_id_b').iterator()
+        return StreamingHttpResponse(
+            stream_hierarchy_graph(links), content_type='application/json')
+
+    role_id = request.GET.get('role_id', '')
+    direction = request.GET.get('direction', 'both')
+    try:
+        depth = min(int(request.GET.get('depth', 1)), MAX_GRAPH_DEPTH)
+        if depth <= 0:
+            raise ValueError('depth must be positive')
+    except ValueError as e:
+        return bad_request(request, e)
+    if direction not in ('ancestors', 'descendants', 'both'):
+        return bad_request(request, ValueError('invalid direction'))
+
+    links = RoleHierarchy.subgraph(
+        role_type, role_id, depth,
+        ancestors=direction != 'descendants',
+        descendants=direction != 'ancestors')
+    return StreamingHttpResponse(
+        stream_hierarchy_graph(sorted(links), [(role_type, role_id)]),
+        content_type='application/json')
+
+
+def prometheus_metrics(request):
+    """
+    Return the authorization metrics in the Prometheus text format.
+
+    This view is not an admin view, so that scrapers can read it. When the
+    METRICS_TOKEN setting is set, requests must send it in an
+    ``Authorization: Bearer <token>`` header, otherwise only staff users
+    can read it.
+    """
+    token = app_settings.metrics_token
+    if token:
+        allowed = constant_time_compare(
+            request.META.get('HTTP_AUTHORIZATION', ''), 'Bearer ' + token)
+    else:
+        user = getattr(request, 'user', None)
+        allowed = user is not None and user.is_active and user.is_staff
+    if not allowed:
+        return permission_denied(request, ValueError('not allowed'))
+    return HttpResponse(
+        metrics.to_prometheus(metrics.get_snapshot()),
+        content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+"""Warm-up module, preparing the caches of a process before it serves."""
+
+import time
+from datetime import timedelta
+
+from django.db.models import Count, Sum
+from django.utils import timezone
+
+from .apps import AppSettings
+from .cache import load_hierarchy_index
+from .models import AccessHistory, AccessRollup, Role, RolePrivilege
+
+app_settings = AppSettings()
+
+
+def warmup_mapping():
+    """
+    Compile the mapping and the implicit rule tables of the role classes.
+
+    Returns:
+        tuple: the number of mapped types and of implicit rule tables.
+    """
+    mapping = app_settings.mapping
+    mapping.compile()
+    mapping.compile_types()
+    resource_types = mapping.resource_types()
+    tables = 0
+    for role_class in set(mapping.role_classes()) | {Role}:
+        for perm in app_settings.access_types:
+            for resource_type in resource_types:
+                RolePrivilege.implicit_rules(role_class, perm, resource_type)
+                tables += 1
+    return len(set(mapping.role_types()) | set(resource_types)), tables
+
+
+def most_accessed(top, days):
+    """
+    Return the most frequently checked accesses.
+
+    They are counted in AccessRollup rows when the ACCESS_LOG_ROLLUP setting
+    is True, in AccessHistory rows otherwise.
+
+    Args:
+        top (int): the number of accesses to return.
+        days (int): only count the accesses of the last days.
+
+    Returns:
+        list: (role_type, role_id, perm, resource_type, resource_id) tuples,
+            the most frequent first.
+    """
+    fields = ('role_type', 'role_id', 'access_type', 'resource_type',
+              'resource_id')
+    since = timezone.now() - timedelta(days=days)
+    if app_settings.access_log_rollup:
+        queryset = AccessRollup.objects.filter(bucket__gte=since).values(
+            *fields).annotate(cerberus_count=Sum('count'))
+    else:
+        queryset = AccessHistory.objects.filter(datetime__gte=since).values(
+            *fields).annotate(cerberus_count=Count('pk'))
+    return list(queryset.order_by('-cerberus_count').values_list(
+        *fields)[:top])
+
+
+def warmup_decisions(top, days=7, report=None):
+    """
+    Compute the decisions of the most frequently checked accesses.
+
+    The decisions are stored in the shared cache when the SHARED_CACHE
+    setting is set. Otherwise they are only computed, which still loads the
+    database caches and the cached implicit rules.
+
+    Args:
+        top (int): the number of accesses to decide.
+        days (int): only count the accesses of the last days.
+        report (callable): function receiving progress messages.
+
+    Returns:
+        int: the number of decided accesses.
+    """
+    checks_by_role = {}
+    for role_type, role_id, perm, resource_type, resource_id in (
+            most_accessed(top, days)):
+        checks_by_role.setdefault((role_type, role_id), []).append(
+            (perm, resource_type, resource_id))
+
+    decided = 0
+    for done, (role, checks) in enumerate(sorted(checks_by_role.items()), 1):
+        RolePrivilege.authorize_bulk(role[0], role[1], checks, log=False)
+        decided += len(checks)
+        if report and (done % 100 == 0 or done == len(checks_by_role)):
+            report('  decided %d accesses of %d/%d roles' % (
+                decided, done, len(checks_by_role)))
+    return decided
+
+
+def warmup(top=0, days=7, report=None):
+    """
+    Prepare the caches of this process.
+
+    The mapping and the implicit rule tables are compiled, the role
+    hierarchy is loaded in memory when the HIERARCHY_CACHE setting is True,
+    and the decisions of the ``top`` most frequently checked accesses are
+    computed (see ``warmup_decisions``).
+
+    Args:
+        top (int): the number of accesses to decide, 0 to skip this step.
+        days (int): only count the accesses of the last days.
+        report (callable): function receiving progress messages.
+
+    Returns:
+        dict: the duration of each step, in seconds.
+    """
+    report = report or (lambda message: None)
+    timings = {}
+
+    started = time.time()
+    types, tables = warmup_mapping()
+    timings['mapping'] = time.time() - started
+    report('Compiled mapping: %d types, %d implicit rule tables (%.3fs)' % (
+        types, tables, timings['mapping']))
+
+    if app_settings.hierarchy_cache:
+        started = time.time()
+        index = load_hierarchy_index()
+        timings['hierarchy'] = time.time() - started
+        report('Loaded role hierarchy: %d links (%.3fs)' % (
+            len(index), timings['hierarchy']))
+    else:
+        report('Skipped role hierarchy: HIERARCHY_CACHE is False')
+
+    if top:
+        started = time.time()
+        decided = warmup_decisions(top, days, report)
+        timings['decisions'] = time.time() - started
+        report('%s %d decisions (%.3fs)' % (
+            'Cached' if app_settings.shared_cache else
+            'Computed (SHARED_CACHE is not set)',
+            decided, timings['decisions']))
+
+    return timings
@@ -0,0 +1,3 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmark scripts, run manually (not collected as tests)."""
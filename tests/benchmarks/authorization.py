@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+
+"""
+Latencies and query counts of the authorization engine.
+
+This script builds synthetic role hierarchies (deep chains, wide fan-in
+groups, diamond DAGs) on top of a configurable number of privilege rows,
+then measures the wall time, the p50/p99 latencies and the number of queries
+of ``authorize`` (explicit, inherited, implicit and default paths),
+``filter_accessible``, ``all_conveyors``, ``allow``/``deny``/``forget`` and
+the ajax views. Results are written as a JSON report, which can be compared
+with the report of another commit.
+
+Usage::
+
+    PYTHONPATH=src python tests/benchmarks/authorization.py \\
+        --output before.json
+    PYTHONPATH=src python tests/benchmarks/authorization.py \\
+        --rows 1000000 --output after.json --compare before.json
+
+The subject of every check is the role ``node 0``: in the ``chain`` dataset
+it inherits from ``depth`` roles in a row, in the ``fanin`` dataset it is a
+member of ``width`` groups, and in the ``diamond`` dataset it is below
+``depth`` layers of ``diamond-width`` roles, each role conveying privileges
+to every role of the layer below. Filler privileges are given to other roles.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+DATASETS = ('chain', 'fanin', 'diamond')
+
+
+def parse_args(argv):
+    """Parse the command line arguments."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--datasets', nargs='+', choices=DATASETS,
+                        default=list(DATASETS))
+    parser.add_argument('--rows', type=int, default=10000,
+                        help='number of filler privilege rows (default 10k)')
+    parser.add_argument('--resources', type=int, default=1000,
+                        help='number of resources')
+    parser.add_argument('--depth', type=int, default=20,
+                        help='length of chains, number of diamond layers')
+    parser.add_argument('--width', type=int, default=100,
+                        help='number of fan-in groups')
+    parser.add_argument('--diamond-width', type=int, default=10,
+                        help='number of roles per diamond layer')
+    parser.add_argument('--repeat', type=int, default=100,
+                        help='number of timed runs per operation')
+    parser.add_argument('--no-closure', action='store_true',
+                        help='disable the hierarchy closure table')
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--engine', choices=('sqlite3', 'postgresql'),
+                        default='sqlite3')
+    parser.add_argument('--name', default=':memory:',
+                        help='database name (file path for SQLite)')
+    parser.add_argument('--user', default='')
+    parser.add_argument('--password', default='')
+    parser.add_argument('--host', default='')
+    parser.add_argument('--port', default='')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='path of the JSON report')
+    parser.add_argument('--compare', help='path of a JSON report to compare')
+    return parser.parse_args(argv)
+
+
+def setup_django(args):
+    """Configure Django to use the benchmark database."""
+    import django
+    from django.conf import settings
+
+    settings.configure(
+        USE_TZ=True,
+        DATABASES={
+            'default': {
+                'ENGINE': 'django.db.backends.' + args.engine,
+                'NAME': args.name,
+                'USER': args.user,
+                'PASSWORD': args.password,
+                'HOST': args.host,
+                'PORT': args.port,
+            }
+        },
+        INSTALLED_APPS=[
+            'django.contrib.auth',
+            'django.contrib.contenttypes',
+            'cerberus_ac',
+        ],
+        CERBERUS_LOG_ACCESS=False,
+        CERBERUS_LOG_PRIVILEGES=False,
+        CERBERUS_LOG_HIERARCHY=False,
+        CERBERUS_HIERARCHY_CLOSURE=not args.no_closure,
+        # resources are Role rows of type "doc", roles are of type "node"
+        CERBERUS_MAPPING=(
+            ('cerberus_ac.models.Role', {'name': 'doc', 'attr': 'resource'}),
+        ),
+    )
+    django.setup()
+
+
+def can_benchmark(self, instance, resource_type, resource_id):
+    """Implicit rule granting the benchmark privilege to the top roles."""
+    return True if self.rid == 'top' else None
+
+
+def bulk_create(model, objects, batch_size):
+    """Insert objects in batches and return their number."""
+    from cerberus_ac.utils import chunked
+
+    count = 0
+    for chunk in chunked(objects, batch_size):
+        model.objects.bulk_create(chunk)
+        count += len(chunk)
+    return count
+
+
+def load_filler(args):
+    """Load the resources and the filler privileges."""
+    from cerberus_ac.models import Role, RolePrivilege
+
+    bulk_create(Role, (Role(type='doc', rid=str(i))
+                       for i in range(args.resources)), args.batch_size)
+    resource_ids = [str(pk) for pk in Role.objects.filter(
+        type='doc').order_by('pk').values_list('pk', flat=True)]
+
+    def privileges():
+        for i in range(args.rows):
+            yield RolePrivilege(
+                role_type='filler', role_id=str(i // len(resource_ids)),
+                access_type='read', resource_type='doc',
+                resource_id=resource_ids[i % len(resource_ids)],
+                authorized=random.random() >= 0.1)
+
+    count = bulk_create(RolePrivilege, privileges(), args.batch_size)
+    print('Loaded %d resources and %d filler privileges' % (
+        len(resource_ids), count))
+    return resource_ids
+
+
+def dataset_links(args, dataset):
+    """
+    Return the (heir, conveyor) links of a dataset.
+
+    The role inheriting from the others is ``0``, the roles at the top of
+    the hierarchy are ``top``.
+    """
+    if dataset == 'chain':
+        nodes = [str(i) for i in range(args.depth)] + ['top']
+        return list(zip(nodes, nodes[1:]))
+    elif dataset == 'fanin':
+        return [('0', 'top' if i == args.width else str(i))
+                for i in range(1, args.width + 1)]
+    layers = [['0']] + [
+        ['%d.%d' % (depth, i) for i in range(args.diamond_width)]
+        for depth in range(1, args.depth + 1)] + [['top']]
+    return [(heir, conveyor)
+            for heirs, conveyors in zip(layers, layers[1:])
+            for heir in heirs for conveyor in conveyors]
+
+
+def load_dataset(args, dataset, resource_ids):
+    """
+    Replace the hierarchy with the one of a dataset.
+
+    The subject is allowed to read the first resource, its top conveyors
+    are allowed to read the second one, and random roles of the hierarchy
+    are given privileges on a tenth of the resources.
+    """
+    from cerberus_ac.models import (
+        Role, RoleHierarchy, RoleHierarchyClosure, RolePrivilege)
+
+    RolePrivilege.objects.filter(role_type='node').delete()
+    RoleHierarchy.objects.all().delete()
+    RoleHierarchyClosure.objects.all().delete()
+    Role.objects.filter(type='node').delete()
+
+    links = dataset_links(args, dataset)
+    nodes = sorted({n for link in links for n in link})
+    bulk_create(Role, (Role(type='node', rid=n) for n in nodes),
+                args.batch_size)
+    bulk_create(RoleHierarchy, (
+        RoleHierarchy(role_type_a='node', role_id_a=heir,
+                      role_type_b='node', role_id_b=conveyor)
+        for heir, conveyor in links), args.batch_size)
+    if not args.no_closure:
+        RoleHierarchyClosure.rebuild(batch_size=args.batch_size)
+
+    privileges = {('0', resource_ids[0]): True, ('top', resource_ids[1]): True}
+    for resource_id in random.sample(
+            resource_ids[2:], max(1, len(resource_ids) // 10)):
+        privileges[(random.choice(nodes), resource_id)] = (
+            random.random() >= 0.2)
+    bulk_create(RolePrivilege, (
+        RolePrivilege(role_type='node', role_id=role_id, access_type='read',
+                      resource_type='doc', resource_id=resource_id,
+                      authorized=authorized)
+        for (role_id, resource_id), authorized in privileges.items()),
+        args.batch_size)
+    print('Loaded %s: %d roles, %d links' % (dataset, len(nodes), len(links)))
+
+
+def operations(resource_ids):
+    """
+    Return the benchmarked operations.
+
+    Each operation is a (name, function) pair, the function running the
+    operation once for the subject role.
+    """
+    from django.test import RequestFactory
+    from cerberus_ac.models import Role, RoleHierarchy, RolePrivilege
+    from cerberus_ac.views import (
+        ajax_load_privileges, ajax_role_hierarchy_graph)
+
+    factory = RequestFactory()
+    ajax = {'HTTP_X_REQUESTED_WITH': 'XMLHttpRequest'}
+    first, second, last = resource_ids[0], resource_ids[1], resource_ids[-1]
+
+    def authorize(perm, resource_id):
+        return lambda: RolePrivilege.authorize(
+            'node', '0', perm, 'doc', resource_id, log=False)
+
+    def allow_deny_forget():
+        RolePrivilege.allow('node', '0', 'update', 'doc', last, log=False)
+        RolePrivilege.deny('node', '0', 'update', 'doc', last, log=False)
+        RolePrivilege.forget('node', '0', 'update', 'doc', last, log=False)
+
+    def load_privileges():
+        return ajax_load_privileges(
+            factory.get('/', {'limit': 500}, **ajax), 'node', '0', 'doc')
+
+    def hierarchy_graph():
+        response = ajax_role_hierarchy_graph(factory.get(
+            '/', {'role_type': 'node', 'role_id': '0', 'depth': 2}))
+        return b''.join(response.streaming_content)
+
+    return (
+        ('authorize explicit', authorize('read', first)),
+        ('authorize inherited', authorize('read', second)),
+        ('authorize implicit', authorize('benchmark', first)),
+        ('authorize default', authorize('delete', first)),
+        ('accessible', lambda: list(RolePrivilege.filter_accessible(
+            'node', '0', 'read', Role.objects.filter(type='doc'), 'doc')
+            .values_list('pk', flat=True))),
+        ('all_conveyors', lambda: RoleHierarchy.all_conveyors('node', '0')),
+        ('allow/deny/forget', allow_deny_forget),
+        ('ajax_load_privileges', load_privileges),
+        ('ajax_role_hierarchy_graph', hierarchy_graph),
+    )
+
+
+def percentile(values, rank):
+    """Return the given percentile of sorted values."""
+    return values[min(len(values) - 1, int(len(values) * rank / 100.0))]
+
+
+def measure(args, resource_ids):
+    """Return the query count and latencies of every operation."""
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    results = {}
+    for name, operation in operations(resource_ids):
+        with CaptureQueriesContext(connection) as queries:
+            operation()
+        timings = []
+        started = time.time()
+        for _ in range(args.repeat):
+            run_started = time.time()
+            operation()
+            timings.append((time.time() - run_started) * 1000)
+        wall = time.time() - started
+        timings.sort()
+        results[name] = {
+            'queries': len(queries),
+            'wall_s': round(wall, 6),
+            'mean_ms': round(sum(timings) / len(timings), 6),
+            'p50_ms': round(percentile(timings, 50), 6),
+            'p99_ms': round(percentile(timings, 99), 6),
+        }
+        print('    %-26s %3d queries  p50 %8.3fms  p99 %8.3fms' % (
+            name, len(queries), results[name]['p50_ms'],
+            results[name]['p99_ms']))
+    return results
+
+
+def git_revision():
+    """Return the current git commit, or None."""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(__file__),
+            stderr=subprocess.STDOUT).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report, previous):
+    """Print the ratios of the p50/p99 latencies with a previous report."""
+    print('\n=== compared with %s ===' % previous['meta']['commit'])
+    for dataset, results in sorted(report['results'].items()):
+        for name, result in sorted(results.items()):
+            old = previous['results'].get(dataset, {}).get(name)
+            if not old:
+                continue
+            print('%-8s %-26s p50 x%.2f  p99 x%.2f  queries %+d' % (
+                dataset, name,
+                result['p50_ms'] / (old['p50_ms'] or 1e-9),
+                result['p99_ms'] / (old['p99_ms'] or 1e-9),
+                result['queries'] - old['queries']))
+
+
+def main(argv=None):
+    """Run the benchmark."""
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    setup_django(args)
+
+    import django
+    from django.core.management import call_command
+    from django.db import connection
+    from cerberus_ac.models import Role
+
+    Role.can_benchmark = can_benchmark
+    call_command('migrate', verbosity=0)
+    random.seed(args.seed)
+    resource_ids = load_filler(args)
+
+    report = {
+        'meta': {
+            'commit': git_revision(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'vendor': connection.vendor,
+            'args': {k: v for k, v in vars(args).items()
+                     if k not in ('password', 'output', 'compare')},
+        },
+        'results': {},
+    }
+    for dataset in args.datasets:
+        load_dataset(args, dataset, resource_ids)
+        report['results'][dataset] = measure(args, resource_ids)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+        print('\nReport written to %s' % args.output)
+    if args.compare:
+        with open(args.compare) as previous:
+            compare(report, json.load(previous))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+
+"""
+Query plans and latencies of the privilege lookup paths.
+
+This script loads synthetic privileges, hierarchy links and access history
+in a database, then prints the query plan and the latencies of the lookups
+done by ``authorize_explicit``, ``accessible``, ``heirs``, ``conveyors`` and
+the admin filters, before (migration 0004) and after (latest migration) the
+lookup indexes added by migration 0005.
+
+Usage::
+
+    PYTHONPATH=src python tests/benchmarks/query_plans.py --rows 1000000
+    PYTHONPATH=src python tests/benchmarks/query_plans.py --rows 10000000 \\
+        --engine postgresql --name cerberus --user postgres
+
+Data is loaded only if the privilege table is empty, so the same database
+can be reused between runs (use ``--reset`` to reload it).
+"""
+
+from __future__ import print_function
+
+import argparse
+import random
+import sys
+import time
+from datetime import timedelta
+
+BEFORE = '0004_access_rollup'
+AFTER = None  # latest migration
+
+PERMS = ('read', 'update', 'delete')
+RESOURCE_TYPES = ('document', 'folder', 'project')
+
+
+def parse_args(argv):
+    """Parse the command line arguments."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rows', type=int, default=1000000,
+                        help='number of privilege rows (default 1M)')
+    parser.add_argument('--roles', type=int, default=0,
+                        help='number of roles (default rows / 50)')
+    parser.add_argument('--fanout', type=int, default=4,
+                        help='number of heirs per role in the hierarchy')
+    parser.add_argument('--repeat', type=int, default=200,
+                        help='number of timed runs per query')
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--engine', choices=('sqlite3', 'postgresql'),
+                        default='sqlite3')
+    parser.add_argument('--name', default='cerberus_benchmark.sqlite3',
+                        help='database name (file path for SQLite)')
+    parser.add_argument('--user', default='')
+    parser.add_argument('--password', default='')
+    parser.add_argument('--host', default='')
+    parser.add_argument('--port', default='')
+    parser.add_argument('--reset', action='store_true',
+                        help='delete and reload the synthetic data')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def setup_django(args):
+    """Configure Django to use the benchmark database."""
+    import django
+    from django.conf import settings
+
+    settings.configure(
+        USE_TZ=True,
+        DATABASES={
+            'default': {
+                'ENGINE': 'django.db.backends.' + args.engine,
+                'NAME': args.name,
+                'USER': args.user,
+                'PASSWORD': args.password,
+                'HOST': args.host,
+                'PORT': args.port,
+            }
+        },
+        INSTALLED_APPS=[
+            'django.contrib.auth',
+            'django.contrib.contenttypes',
+            'cerberus_ac',
+        ],
+        CERBERUS_LOG_ACCESS=False,
+        CERBERUS_LOG_PRIVILEGES=False,
+        CERBERUS_LOG_HIERARCHY=False,
+        CERBERUS_MAPPING=(
+            ('cerberus_ac.models.Role', {'name': 'role', 'attr': 'role'}),
+        ),
+    )
+    django.setup()
+
+
+def load_data(args):
+    """
+    Load synthetic data, unless already loaded.
+
+    Privileges are spread evenly over roles, permissions and resource types.
+    Roles form a tree where each role has ``fanout`` heirs, and one in ten
+    privileges is a denial. Bulk inserts bypass the signals, so the
+    hierarchy closure is rebuilt at the end.
+    """
+    from django.utils import timezone
+    from cerberus_ac.models import (
+        AccessHistory, RoleHierarchy, RoleHierarchyClosure, RolePrivilege)
+    from cerberus_ac.utils import chunked
+
+    if args.reset:
+        for model in (RolePrivilege, RoleHierarchy, RoleHierarchyClosure,
+                      AccessHistory):
+            model.objects.all().delete()
+    elif RolePrivilege.objects.exists():
+        print('Reusing existing data')
+        return
+
+    roles = args.roles
+    random.seed(args.seed)
+    started = time.time()
+
+    def privileges():
+        for i in range(args.rows):
+            step = i // roles
+            yield RolePrivilege(
+                role_type='role', role_id=str(i % roles),
+                access_type=PERMS[step % len(PERMS)],
+                resource_type=RESOURCE_TYPES[
+                    (step // len(PERMS)) % len(RESOURCE_TYPES)],
+                resource_id=str(step // len(PERMS) // len(RESOURCE_TYPES)),
+                authorized=random.random() >= 0.1)
+
+    def links():
+        for heir in range(1, roles):
+            yield RoleHierarchy(
+                role_type_a='role', role_id_a=str(heir),
+                role_type_b='role', role_id_b=str((heir - 1) // args.fanout))
+
+    def attempts():
+        now = timezone.now()
+        for i in range(args.rows // 10):
+            yield AccessHistory(
+                role_type='role', role_id=str(random.randrange(roles)),
+                response=random.random() >= 0.1, response_type='E',
+                access_type=random.choice(PERMS),
+                resource_type=random.choice(RESOURCE_TYPES),
+                resource_id=str(random.randrange(max_resource_id(args))),
+                datetime=now - timedelta(seconds=i))
+
+    for model, objects in ((RolePrivilege, privileges()),
+                           (RoleHierarchy, links()),
+                           (AccessHistory, attempts())):
+        count = 0
+        for chunk in chunked(objects, args.batch_size):
+            model.objects.bulk_create(chunk)
+            count += len(chunk)
+        print('Loaded %d %s rows' % (count, model.__name__))
+
+    count = RoleHierarchyClosure.rebuild(batch_size=args.batch_size)
+    print('Built %d closure rows' % count)
+    print('Loaded data in %.1fs' % (time.time() - started))
+
+
+def max_resource_id(args):
+    """Return the number of resource IDs per resource type."""
+    per_role = args.rows // args.roles
+    return max(1, per_role // len(PERMS) // len(RESOURCE_TYPES))
+
+
+def lookups(args):
+    """
+    Return the benchmarked lookups.
+
+    Each lookup is a (name, queryset factory) pair, the querysets being the
+    ones built by the corresponding code paths for a random role/resource.
+    """
+    from django.utils import timezone
+    from cerberus_ac.models import (
+        AccessHistory, PrivilegeHistory, RoleHierarchy, RolePrivilege)
+
+    def role_id():
+        return str(random.randrange(args.roles))
+
+    def resource_id():
+        return str(random.randrange(max_resource_id(args)))
+
+    def roles():
+        # a role and its conveyors, as found by conveyor_depths
+        role = random.randrange(args.roles)
+        chain = [role]
+        while role:
+            role = (role - 1) // args.fanout
+            chain.append(role)
+        return [str(r) for r in chain]
+
+    return (
+        ('authorize_explicit', lambda: RolePrivilege.objects.filter(
+            resource_type=random.choice(RESOURCE_TYPES),
+            access_type__in=['read'], resource_id__in=[resource_id()],
+            role_type__in=['role'], role_id__in=roles()
+        ).values_list('role_type', 'role_id', 'access_type', 'resource_id',
+                      'authorized')),
+        ('accessible', lambda: RolePrivilege.objects.filter(
+            role_type='role', role_id=role_id(),
+            resource_type=random.choice(RESOURCE_TYPES)
+        ).values_list('resource_id', flat=True)),
+        ('heirs', lambda: RoleHierarchy.objects.filter(
+            role_type_b='role', role_id_b=role_id()
+        ).values_list('role_type_a', 'role_id_a')),
+        ('conveyors', lambda: RoleHierarchy.objects.filter(
+            role_type_a='role', role_id_a=role_id()
+        ).values_list('role_type_b', 'role_id_b')),
+        ('admin privileges by date', lambda: RolePrivilege.objects.filter(
+            modification_date__gte=timezone.now() - timedelta(days=1)
+        ).order_by('-creation_date')[:100]),
+        ('audit of a role', lambda: AccessHistory.objects.filter(
+            role_type='role', role_id=role_id()
+        ).order_by('-datetime')[:100]),
+        ('audit of a resource', lambda: AccessHistory.objects.filter(
+            resource_type=random.choice(RESOURCE_TYPES),
+            resource_id=resource_id()
+        ).order_by('-datetime')[:100]),
+        ('latest accesses', lambda: AccessHistory.objects.order_by(
+            '-datetime')[:100]),
+        ('privilege history of a role', lambda: PrivilegeHistory.objects
+            .filter(role_type='role', role_id=role_id())
+            .order_by('-datetime')[:100]),
+    )
+
+
+def explain(queryset):
+    """Return the query plan of a queryset, as printed by the database."""
+    from django.db import connection
+
+    sql, params = queryset.query.sql_with_params()
+    if connection.vendor == 'sqlite':
+        statement = 'EXPLAIN QUERY PLAN '
+    else:
+        statement = 'EXPLAIN (ANALYZE, BUFFERS) '
+    with connection.cursor() as cursor:
+        cursor.execute(statement + sql, params)
+        rows = cursor.fetchall()
+    return '\n'.join('    ' + ' '.join(str(c) for c in row) for row in rows)
+
+
+def percentile(values, rank):
+    """Return the given percentile of sorted values."""
+    return values[min(len(values) - 1, int(len(values) * rank / 100.0))]
+
+
+def measure(args, phase):
+    """Print the query plans and latencies of every lookup."""
+    from django.db import connection
+
+    print('\n=== %s (%s) ===' % (phase, connection.vendor))
+    for name, make_queryset in lookups(args):
+        print('\n%s\n%s' % (name, explain(make_queryset())))
+        timings = []
+        for _ in range(args.repeat):
+            queryset = make_queryset()
+            started = time.time()
+            list(queryset)
+            timings.append((time.time() - started) * 1000)
+        timings.sort()
+        print('    p50 %.3fms  p99 %.3fms  max %.3fms' % (
+            percentile(timings, 50), percentile(timings, 99), timings[-1]))
+
+
+def main(argv=None):
+    """Run the benchmark."""
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    args.roles = args.roles or max(1, args.rows // 50)
+    setup_django(args)
+
+    from django.core.management import call_command
+    from django.db import connection
+
+    call_command('migrate', verbosity=0)
+    load_data(args)
+
+    for phase, migration in (('before', BEFORE), ('after', AFTER)):
+        call_command('migrate', 'cerberus_ac', *filter(None, [migration]),
+                     verbosity=0)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        random.seed(args.seed)
+        measure(args, phase)
+
+
+if __name__ == '__main__':
+    main()
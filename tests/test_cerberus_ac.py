@@ -2,16 +2,44 @@
 
 """Main test script."""
 
-from django.test import TestCase, override_settings
+import json
+import random
+import tempfile
+from collections import OrderedDict
+from io import StringIO
+
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.db import connections
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
 import pytest
 from django_fake_model import models as f
 
-from cerberus_ac.apps import AppSettings
+from cerberus_ac.access_log import BufferedAccessLogSink
+from cerberus_ac.apps import AppSettings, Mapping
+from cerberus_ac.cache import (
+    DecisionCache, RuleResultCache, _invalidate_decisions, cached_rule,
+    decision_cache, get_policy_generation,
+    get_rule_cache_stats, reset_rule_cache_stats, rule_result_cache)
+from cerberus_ac.metrics import (
+    MAX_PROCESSES, collect, merge, publish, quantile, record_bulk_check,
+    record_check, record_filter, registry, slot_key, to_prometheus)
 from cerberus_ac.models import (
-    AccessHistory, PrivilegeHistory, Role, RoleHierarchy, RoleMixin,
-    RolePrivilege)
-from cerberus_ac.utils import get_resource_id, get_resource_type
+    AccessHistory, AccessRollup, PrivilegeHistory, Role, RoleHierarchy,
+    RoleHierarchyClosure, RoleMixin, RolePrivilege, RolePrivilegeRange,
+    _implicit_rule_names, _implicit_rules, accessible_filtered,
+    authorization_bulk_checked, authorization_checked)
+from cerberus_ac.signals import rebuild_closure
+from cerberus_ac.transfer import import_records, parse_record
+from cerberus_ac.utils import (
+    EstimatedCountPaginator, QueryCounter, estimate_count, get_resource_id,
+    get_resource_type, get_role_type_and_id, integer_id, transitive_closure)
+from cerberus_ac.warmup import most_accessed
 
 app_settings = AppSettings()
 
@@ -67,6 +95,28 @@ class MainTestCase(TestCase):
         """Test the mapping setting."""
         assert app_settings.mapping
 
+    def test_mapping_lookups(self):
+        """Test the compiled mapping lookups."""
+        mapping = Mapping((
+            ('collections.OrderedDict', {'name': 'odict', 'attr': 'resource'}),
+            ('cerberus_ac.models.Role', {'name': 'role', 'attr': 'role'}),
+        ))
+
+        class SubDict(OrderedDict):
+            """Subclass of a mapped class."""
+
+        assert mapping.get_class('odict') is OrderedDict
+        assert mapping.get_class('missing') is None
+        assert mapping.get_type(OrderedDict()) == 'odict'
+        assert mapping.get_type(SubDict) == 'odict'
+        assert mapping.get_type(SubDict()) == 'odict'
+        assert mapping.get_type(dict) == 'dict'
+        assert mapping.resource_types() == ['odict']
+        assert mapping.role_types() == ['role']
+        assert mapping.role_classes() == [Role]
+        assert mapping.user_classes() == []
+        assert app_settings.mapping.get_type(FakeUser) == 'FakeUser'
+
     def test_import_classes(self):
         """Test classes imported correctly."""
         assert set(app_settings.mapping.role_classes()) == {Role, FakeUser, FakeGroup}  # noqa
@@ -125,6 +175,120 @@ class MainTestCase(TestCase):
         assert set(self.users[0].conveyors()) == {
             self.groups[0], self.groups[1], self.roles[0]}
 
+    def test_role_hierarchy_layers(self):
+        """Test recursive and iterative hierarchy walks agree."""
+        self.groups[0].take_role(self.roles[1])
+        self.roles[1].take_role('chain', '1')
+        connection = connections['default']
+        a_fields = ('role_type_a', 'role_id_a')
+        b_fields = ('role_type_b', 'role_id_b')
+        for role in ('FakeUser', '1'), ('FakeGroup', '3'), ('chain', '1'):
+            for fields in (a_fields, b_fields), (b_fields, a_fields):
+                assert RoleHierarchy.recursive_layers(
+                    connection, role[0], role[1], *fields
+                ) == RoleHierarchy.iterative_layers(role[0], role[1], *fields)
+        assert RoleHierarchy.all_conveyors('FakeUser', '1') == [
+            [('FakeGroup', '1'), ('FakeGroup', '2'), ('security', '')],
+            [('audit', '15')],
+            [('chain', '1')]]
+        Role.objects.create(type='chain', rid='1').take_role(self.users[0])
+        # the cycle back to the user ends the walk
+        assert len(RoleHierarchy.layers('FakeUser', '1', a_fields,
+                                        b_fields)) == 3
+        assert self.users[0].has_role('chain', '1')
+
+    def test_role_hierarchy_closure(self):
+        """Test the closure is maintained on hierarchy changes."""
+        def closure():
+            return set(RoleHierarchyClosure.objects.values_list(
+                'descendant_type', 'descendant_id',
+                'ancestor_type', 'ancestor_id', 'depth'))
+
+        assert ('FakeUser', '1', 'FakeGroup', '2', 1) in closure()
+        self.groups[1].take_role(self.roles[2])
+        assert ('FakeUser', '2', 'data', '', 2) in closure()
+        assert ('FakeUser', '2', 'FakeGroup', '3', 3) in closure()
+        link = RoleHierarchy.objects.get(
+            role_type_a='FakeGroup', role_id_a='2', role_type_b='data')
+        link.role_type_b = 'security'
+        link.save()
+        assert ('FakeUser', '2', 'data', '', 2) not in closure()
+        assert ('FakeUser', '2', 'security', '', 2) in closure()
+        link.delete()
+        assert not self.users[1].has_role('security')
+        assert self.users[0].has_role('security')
+        expected = closure()
+        call_command('cerberus_rebuild_closure', stdout=StringIO())
+        assert closure() == expected
+
+    def test_role_hierarchy_closure_refresh(self):
+        """Test removed links refresh the closure of every descendant."""
+        def closure():
+            return set(RoleHierarchyClosure.objects.values_list(
+                'descendant_type', 'descendant_id',
+                'ancestor_type', 'ancestor_id', 'depth'))
+
+        def expected():
+            links = [((a_type, a_id), (b_type, b_id))
+                     for a_type, a_id, b_type, b_id in
+                     RoleHierarchy.objects.values_list(
+                         'role_type_a', 'role_id_a',
+                         'role_type_b', 'role_id_b')]
+            return {d + a + (depth,)
+                    for d, a, depth in transitive_closure(links)}
+
+        rng = random.Random(4)
+        for _ in range(40):
+            RoleHierarchy.objects.get_or_create(
+                role_type_a='node', role_id_a=str(rng.randrange(12)),
+                role_type_b='node', role_id_b=str(rng.randrange(12)))
+        assert closure() == expected()
+        links = list(RoleHierarchy.objects.filter(role_type_a='node'))
+        rng.shuffle(links)
+        for link in links:
+            link.delete()
+            assert closure() == expected()
+
+        # the number of queries does not depend on the number of descendants
+        counts = []
+        for size in (3, 30):
+            for i in range(size):
+                RoleHierarchy.objects.create(
+                    role_type_a='leaf%d' % size, role_id_a=str(i),
+                    role_type_b='root', role_id_b=str(size))
+            RoleHierarchy.objects.create(
+                role_type_a='root', role_id_a=str(size),
+                role_type_b='top', role_id_b='')
+            link = RoleHierarchy.objects.get(
+                role_type_a='root', role_id_a=str(size))
+            with CaptureQueriesContext(connections['default']) as queries:
+                link.delete()
+            counts.append(len(queries))
+        assert counts[0] == counts[1]
+        assert closure() == expected()
+
+    def test_role_hierarchy_closure_raw_save(self):
+        """Test raw saves schedule a rebuild of the closure."""
+        connection = connections['default']
+
+        def pending():
+            return [callback[1] for callback in connection.run_on_commit
+                    if callback[1] is rebuild_closure]
+
+        RoleHierarchy(role_type_a='loaded', role_id_a='1',
+                      role_type_b='security', role_id_b='').save_base(
+            raw=True)
+        RoleHierarchy(role_type_a='loaded', role_id_a='2',
+                      role_type_b='loaded', role_id_b='1').save_base(
+            raw=True)
+        assert not RoleHierarchyClosure.objects.filter(
+            descendant_type='loaded').exists()
+        assert len(pending()) == 1
+        pending()[0]()
+        assert RoleHierarchyClosure.objects.filter(
+            descendant_type='loaded', descendant_id='2',
+            ancestor_type='security', depth=2).exists()
+
     def test_role_hierarchy_history(self):
         """Test role hierarchy history."""
         pass  # TODO: need implementation of HierarchyHistory first
@@ -167,6 +331,954 @@ class MainTestCase(TestCase):
         assert not self.users[2].can('read', self.resources[2])
         # test clashing same-level permissions
 
+    def test_decision_cache(self):
+        """Test request-scoped memoization of decisions."""
+        with decision_cache():
+            assert self.users[2].can('read', self.resources[2], log=False)
+            with self.assertNumQueries(0):
+                assert self.users[2].can(
+                    'read', self.resources[2], log=False)
+            RolePrivilege.deny('data', '', 'read', 'FakeResource', '3')
+            assert not self.users[2].can('read', self.resources[2], log=False)
+
+        cache = DecisionCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        assert cache.get('a') == 1
+        cache.set('c', 3)
+        assert cache.get('b') is None
+        assert len(cache) == 2
+
+    @override_settings(CERBERUS_SHARED_CACHE='default')
+    def test_shared_decision_cache(self):
+        """Test cross-process decision cache and policy generation."""
+        assert self.users[2].can('read', self.resources[2], log=False)
+        with self.assertNumQueries(0):
+            assert self.users[2].can('read', self.resources[2], log=False)
+        RolePrivilege.deny('data', '', 'read', 'FakeResource', '3')
+        assert not self.users[2].can('read', self.resources[2], log=False)
+        self.users[2].take_role('security')
+        RolePrivilege.allow('security', '', 'read', 'FakeResource', '1')
+        assert self.users[2].can('read', self.resources[0], log=False)
+
+    @override_settings(CERBERUS_SHARED_CACHE='default')
+    def test_invalidation_on_commit(self):
+        """Test decisions are invalidated again when the write commits."""
+        cache = caches['default']
+        connection = connections['default']
+
+        def pending():
+            return [callback[1] for callback in connection.run_on_commit
+                    if callback[1] is _invalidate_decisions]
+
+        generation = get_policy_generation(cache)
+        RolePrivilege.allow('FakeGroup', '1', 'write', 'FakeResource', '1')
+        RolePrivilege.objects.bulk_set(
+            [('FakeGroup', '2', 'write', 'FakeResource', '1', True)])
+        assert get_policy_generation(cache) > generation
+        # decisions cached before the commit are dropped when it commits
+        assert len(pending()) == 1
+        assert not self.users[2].can('write', self.resources[0], log=False)
+        generation = get_policy_generation(cache)
+        pending()[0]()
+        assert get_policy_generation(cache) > generation
+
+    def test_get_instances(self):
+        """Test the batch resolution of instances."""
+        security, audit, data = self.roles
+        resource = self.resources[1]
+        pairs = [
+            ('FakeResource', str(resource.id)),
+            ('security', ''),
+            ('FakeResource', 'not-an-id'),
+            ('audit', '15'),
+            ('FakeResource', resource.id),
+            ('unknown', '1'),
+            ('FakeResource', '0'),
+            ('FakeResource', ''),
+        ]
+        with self.assertNumQueries(2):
+            instances = app_settings.mapping.get_instances(pairs)
+        assert instances == [
+            resource, security, None, audit, resource, None, None, None]
+        assert instances == [
+            app_settings.mapping.get_instance(*p) for p in pairs]
+
+        with self.assertNumQueries(3):
+            conveyors = self.users[0].conveyors()
+        assert set(conveyors) == {self.groups[0], self.groups[1], security}
+
+    def test_estimated_count_paginator(self):
+        """Test the paginator falls back on exact counts."""
+        queryset = RolePrivilege.objects.order_by('id')
+        assert estimate_count(queryset) is None
+        paginator = EstimatedCountPaginator(queryset, 2)
+        assert paginator.count == queryset.count()
+        assert list(paginator.page(1).object_list) == list(queryset[:2])
+
+    def test_load_privileges(self):
+        """Test the privileges matrix is loaded in one query per page."""
+        from cerberus_ac.views import ajax_load_privileges
+        factory = RequestFactory()
+
+        def load(**params):
+            request = factory.get(
+                '/', params, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            response = ajax_load_privileges(
+                request, 'FakeUser', '1', 'FakeResource')
+            return json.loads(response.content.decode('utf-8'))
+
+        empty = {'read': None, 'update': None, 'delete': None,
+                 'do stuff on': None}
+        ids = [r.id for r in self.resources]
+        with self.assertNumQueries(2):
+            data = load()
+        assert data == [dict(empty, **{'do stuff on': True}),
+                        dict(empty, **{'do stuff on': False}), empty]
+        with self.assertNumQueries(3):
+            page = load(limit=2)
+        assert page == {'privileges': [[ids[0], data[0]], [ids[1], data[1]]],
+                        'next': ids[1]}
+        assert load(limit=2, after=ids[1]) == {
+            'privileges': [[ids[2], data[2]]], 'next': None}
+        assert load(limit=1, offset=1) == {
+            'privileges': [[ids[1], data[1]]], 'next': ids[1]}
+        for params in ({'limit': -1}, {'limit': 0}, {'offset': -5},
+                       {'limit': 2, 'offset': -5}, {'after': 'x'}):
+            request = factory.get(
+                '/', params, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            assert ajax_load_privileges(
+                request, 'FakeUser', '1', 'FakeResource').status_code == 400
+
+    def test_role_hierarchy_graph(self):
+        """Test the role hierarchy graph endpoint."""
+        from cerberus_ac.views import (
+            MAX_GRAPH_DEPTH, ajax_role_hierarchy_graph,
+            stream_hierarchy_graph)
+        factory = RequestFactory()
+
+        def graph(**params):
+            response = ajax_role_hierarchy_graph(factory.get('/', params))
+            data = json.loads(b''.join(response.streaming_content).decode())
+            nodes = [(n['role_type'], n['role_id']) for n in data['nodes']]
+            return nodes, {(nodes[link['target']], nodes[link['source']])
+                           for link in data['links']}
+
+        nodes, links = graph()
+        assert len(nodes) == 9
+        assert len(links) == RoleHierarchy.objects.count()
+        assert (('FakeUser', '1'), ('FakeGroup', '1')) in links
+
+        self.groups[0].take_role(self.roles[1])
+        nodes, links = graph(role_type='FakeUser', role_id='1',
+                             direction='ancestors')
+        assert nodes[0] == ('FakeUser', '1')
+        assert set(nodes) == {('FakeUser', '1'), ('FakeGroup', '1'),
+                              ('FakeGroup', '2'), ('security', '')}
+        nodes, links = graph(role_type='audit', role_id='15', depth=2)
+        assert set(nodes) == {('audit', '15'), ('FakeGroup', '1'),
+                              ('FakeUser', '1'), ('FakeUser', '2')}
+        assert RoleHierarchy.subgraph('FakeUser', '1', 5) == {
+            ('FakeUser', '1', 'FakeGroup', '1'),
+            ('FakeUser', '1', 'FakeGroup', '2'),
+            ('FakeUser', '1', 'security', ''),
+            ('FakeGroup', '1', 'audit', '15')}
+
+        response = ajax_role_hierarchy_graph(factory.get(
+            '/', {'role_type': 'FakeUser', 'role_id': '1', 'depth': 0}))
+        assert response.status_code == 400
+        assert graph(role_type='FakeUser', role_id='1', depth=10 ** 6) == (
+            graph(role_type='FakeUser', role_id='1', depth=MAX_GRAPH_DEPTH))
+
+        consumed = []
+
+        def links():
+            for i in range(2500):
+                consumed.append(i)
+                yield 'FakeUser', str(i), 'FakeGroup', '1'
+
+        pieces = stream_hierarchy_graph(links())
+        assert next(pieces).endswith('"links": [')
+        assert next(pieces).count('"source"') == 1000
+        assert len(consumed) == 1000
+
+    def test_accessible(self):
+        """Test accessible resources follow the authorization rules."""
+        user = self.users[0]
+        perm = 'do stuff on'
+        RolePrivilege.allow('FakeGroup', '1', perm, 'FakeResource', '2')
+        RolePrivilege.allow('FakeGroup', '1', perm, 'FakeResource', '3')
+        RolePrivilege.deny('FakeGroup', '2', perm, 'FakeResource', '3')
+        RolePrivilege.allow('audit', '15', perm, 'FakeResource', '3')
+
+        def expected():
+            return [r for r in self.resources
+                    if user.can(perm, r, skip_implicit=True, log=False)]
+
+        queryset = user.accessible(
+            FakeResource.objects.order_by('id'), perm=perm)
+        with self.assertNumQueries(1):
+            resources = list(queryset)
+        assert resources == expected() == [self.resources[0]]
+        assert list(user.accessible('FakeResource', perm)) == expected()
+        assert user.accessible(self.resources + [self.roles[0]], perm) == (
+            expected())
+        assert list(self.users[2].accessible(
+            FakeResource.objects.all(), perm)) == [self.resources[2]]
+        assert not user.accessible(FakeResource.objects.all()).exists()
+
+        RolePrivilege.forget('FakeGroup', '2', perm, 'FakeResource', '3')
+        assert list(user.accessible(
+            FakeResource.objects.order_by('id'), perm)) == expected() == [
+            self.resources[0], self.resources[2]]
+
+        with override_settings(CERBERUS_DEFAULT_RESPONSE=True):
+            assert list(user.accessible(
+                FakeResource.objects.order_by('id'), 'other')) == (
+                self.resources)
+            assert list(user.accessible(
+                FakeResource.objects.order_by('id'), perm)) == expected()
+
+        # one layer per link, still a flat query
+        for i in range(60):
+            RoleHierarchy.objects.create(
+                role_type_a='node', role_id_a=str(i),
+                role_type_b='node', role_id_b=str(i + 1))
+        RolePrivilege.allow('node', '60', perm, 'FakeResource', '1')
+        assert list(RolePrivilege.filter_accessible(
+            'node', '0', perm, FakeResource.objects.all())) == [
+            self.resources[0]]
+
+    def test_implicit_rules(self):
+        """Test implicit rules are dispatched without loading instances."""
+        resource = self.resources[0]
+        args = ('FakeUser', str(self.users[0].id), 'read', 'FakeResource')
+        with self.assertNumQueries(0):
+            assert RolePrivilege.authorize_implicit(
+                *args, resource_id=resource.id) is None
+            assert RolePrivilege.implicit_rules(
+                FakeUser, 'many', 'FakeResource') == (frozenset(), None, None)
+
+        seen = []
+
+        def can_read(self, instance, resource_type, resource_id):
+            seen.append(instance)
+            return resource_id == resource.id
+
+        FakeUser.can_read = can_read
+        FakeUser.can_read_FakeResource_2 = False
+        _implicit_rule_names.clear()
+        _implicit_rules.clear()
+        try:
+            with self.assertNumQueries(1):
+                assert RolePrivilege.authorize_implicit(
+                    *args, resource_id=resource.id)
+            with self.assertNumQueries(1):
+                assert RolePrivilege.authorize_implicit(
+                    *args, resource_id='2') is False
+            with self.assertNumQueries(2):
+                assert not RolePrivilege.authorize_implicit(
+                    *args, resource_id='3')
+                assert seen[-1] == self.resources[2]
+            assert RolePrivilege.authorize_implicit(
+                'FakeGroup', '1', 'read', 'FakeResource', '1') is None
+        finally:
+            del FakeUser.can_read
+            del FakeUser.can_read_FakeResource_2
+            _implicit_rule_names.clear()
+            _implicit_rules.clear()
+
+    def test_cached_rule(self):
+        """Test cached implicit rules run once per key and TTL."""
+        calls = []
+        versions = [1]
+
+        @cached_rule(60, version=lambda: versions[0])
+        def can_audit(self, instance, resource_type, resource_id):
+            calls.append(resource_id)
+            return resource_id == '1'
+
+        FakeUser.can_audit = can_audit
+        _implicit_rule_names.clear()
+        _implicit_rules.clear()
+        reset_rule_cache_stats()
+        try:
+            for _ in range(3):
+                for resource_id in ('1', '2'):
+                    assert RolePrivilege.authorize_implicit(
+                        'FakeUser', '1', 'audit', 'FakeResource',
+                        resource_id) == (resource_id == '1')
+            assert calls == ['1', '2']
+            stats = get_rule_cache_stats()[can_audit.__qualname__]
+            assert stats == {'hits': 4, 'misses': 2}
+
+            versions[0] = 2
+            assert self.users[0].can_audit(
+                instance=None, resource_type='FakeResource', resource_id='1')
+            assert calls == ['1', '2', '1']
+        finally:
+            del FakeUser.can_audit
+            _implicit_rule_names.clear()
+            _implicit_rules.clear()
+            rule_result_cache.clear()
+
+        cache = RuleResultCache(max_size=2)
+        cache.set('a', 1, timeout=0)
+        cache.set('b', None)
+        cache.set('c', 3)
+        assert cache.get('a', 'missing') == 'missing'
+        assert cache.get('b', 'missing') is None
+        cache.set('d', 4)
+        assert cache.get('b') is None and cache.get('d') == 4
+
+    @override_settings(CERBERUS_COUNT_QUERIES=True)
+    def test_authorization_checked(self):
+        """Test the instrumentation signal of authorize."""
+        received = []
+
+        def receiver(sender, **kwargs):
+            received.append(kwargs)
+
+        RolePrivilege.allow('FakeGroup', '1', 'write', 'FakeResource', '1')
+        authorization_checked.connect(receiver)
+        try:
+            with decision_cache():
+                for _ in range(2):
+                    assert RolePrivilege.authorize(
+                        'FakeUser', '1', 'write', 'FakeResource', '1')
+        finally:
+            authorization_checked.disconnect(receiver)
+        assert RolePrivilege.authorize(
+            'FakeUser', '1', 'write', 'FakeResource', '1')
+
+        assert len(received) == 2
+        first, second = received
+        assert first['response'] is True
+        assert first['response_type'] == AccessHistory.EXPLICIT
+        assert (first['conveyor_type'], first['conveyor_id']) == (
+            'FakeGroup', '1')
+        assert not first['cache_hit'] and second['cache_hit']
+        assert first['depth'] == 1 and first['layers'] == 1
+        assert second['depth'] is second['layers'] is None
+        assert first['queries'] == 3 and second['queries'] == 1
+        assert set(first['timings']) == {
+            'hierarchy', 'explicit', 'implicit', 'cache', 'log', 'total'}
+        assert set(second['timings']) == {'cache', 'log', 'total'}
+
+        authorization_checked.connect(receiver)
+        try:
+            with override_settings(CERBERUS_COUNT_QUERIES=False):
+                RolePrivilege.authorize(
+                    'FakeUser', '1', 'write', 'FakeResource', '1')
+        finally:
+            authorization_checked.disconnect(receiver)
+        assert received[-1]['queries'] is None
+        connection = connections['default']
+        with QueryCounter(connection) as counter:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+                assert list(cursor) == [(1, )]
+        assert counter.count == 1
+        assert not connection.queries_logged
+
+    def test_metrics(self):
+        """Test the metrics registry and its exporters."""
+        from cerberus_ac.views import prometheus_metrics
+
+        registry.reset()
+        authorization_checked.connect(record_check)
+        try:
+            RolePrivilege.allow('FakeGroup', '1', 'write', 'FakeResource', '1')
+            for resource_id in ('1', '2'):
+                RolePrivilege.authorize(
+                    'FakeUser', '1', 'write', 'FakeResource', resource_id)
+        finally:
+            authorization_checked.disconnect(record_check)
+
+        snapshot = registry.snapshot()
+        assert snapshot['cerberus_checks_total']['samples'] == [
+            [['write', 'FakeResource'], 2]]
+        assert snapshot['cerberus_decisions_total']['samples'] == [
+            [['d', 'False'], 1], [['e', 'True'], 1]]
+        depth = snapshot['cerberus_decision_depth']['samples'][0][1]
+        assert depth['count'] == 1 and depth['counts'][1] == 1
+
+        text = to_prometheus(snapshot)
+        assert ('cerberus_checks_total{perm="write",'
+                'resource_type="FakeResource"} 2') in text
+        assert 'cerberus_decision_depth_bucket{le="1.0"} 1' in text
+        assert 'cerberus_decision_depth_bucket{le="+Inf"} 1' in text
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        assert prometheus_metrics(request).status_code == 403
+        request.user = User(username='staff', is_staff=True)
+        response = prometheus_metrics(request)
+        assert response.content.decode('utf-8') == text
+        with override_settings(CERBERUS_METRICS_TOKEN='secret'):
+            assert prometheus_metrics(
+                RequestFactory().get('/')).status_code == 403
+            response = prometheus_metrics(RequestFactory().get(
+                '/', HTTP_AUTHORIZATION='Bearer secret'))
+            assert response.content.decode('utf-8') == text
+
+        merged = merge([snapshot, snapshot])
+        assert merged['cerberus_checks_total']['samples'] == [
+            [['write', 'FakeResource'], 4]]
+        assert merged['cerberus_decision_depth']['samples'][0][1][
+            'counts'][1] == 2
+        assert quantile([1, 2, 5], [1, 8, 1, 0], 0.5) == 2
+        assert quantile([1, 2, 5], [0, 0, 0, 1], 0.99) == float('inf')
+
+        cache = caches['default']
+        publish(cache)
+        assert collect(cache) == merge([snapshot])
+        assert registry.slot == 0
+        # another process registered concurrently, in its own slot
+        assert cache.add(slot_key(1), 'other', None)
+        cache.set('other', {'time': 0, 'metrics': snapshot}, None)
+        publish(cache)
+        assert registry.slot == 0
+        assert collect(cache) == merge([snapshot, snapshot])
+        # the slot of this process expired: the first free one is reused
+        cache.delete(slot_key(0))
+        registry.slot = None
+        publish(cache)
+        assert registry.slot == 0
+        assert collect(cache) == merge([snapshot, snapshot])
+        # every slot is taken: the snapshot is not collected
+        cache.delete(slot_key(0))
+        cache.set_many({slot_key(i): 'other' for i in range(MAX_PROCESSES)})
+        publish(cache)
+        assert registry.slot is None
+        assert collect(cache) == merge([snapshot])
+        cache.delete_many([slot_key(i) for i in range(MAX_PROCESSES)])
+
+        out = StringIO()
+        call_command('cerberus_stats', '--reset', stdout=out)
+        dumped = json.loads(out.getvalue())
+        assert dumped['metrics']['cerberus_checks_total']['samples'] == [
+            [['write', 'FakeResource'], 2]]
+        assert not registry.snapshot()['cerberus_checks_total']['samples']
+
+    def test_bulk_metrics(self):
+        """Test bulk authorizations and filters are recorded in metrics."""
+        checks = [('write', 'FakeResource', str(resource.id))
+                  for resource in self.resources]
+        registry.reset()
+        authorization_bulk_checked.connect(record_bulk_check)
+        accessible_filtered.connect(record_filter)
+        try:
+            RolePrivilege.allow('FakeGroup', '1', 'write', 'FakeResource', '1')
+            with decision_cache():
+                RolePrivilege.authorize_bulk(
+                    'FakeUser', '1', checks, log=False)
+                RolePrivilege.authorize_bulk(
+                    'FakeUser', '1', checks[:2], log=False)
+            assert list(RolePrivilege.filter_accessible(
+                'FakeUser', '1', 'write', FakeResource.objects.all())) == [
+                self.resources[0]]
+        finally:
+            authorization_bulk_checked.disconnect(record_bulk_check)
+            accessible_filtered.disconnect(record_filter)
+
+        count = len(checks)
+        snapshot = registry.snapshot()
+        assert snapshot['cerberus_checks_total']['samples'] == [
+            [['write', 'FakeResource'], count + 2]]
+        assert snapshot['cerberus_decisions_total']['samples'] == [
+            [['d', 'False'], count], [['e', 'True'], 2]]
+        assert snapshot['cerberus_decision_cache_total']['samples'] == [
+            [['hit'], 2], [['miss'], count]]
+        assert snapshot['cerberus_bulk_check_size']['samples'][0][1][
+            'count'] == 2
+        depth = snapshot['cerberus_decision_depth']['samples'][0][1]
+        assert depth['count'] == 1 and depth['counts'][1] == 1
+        assert snapshot['cerberus_accessible_filters_total']['samples'] == [
+            [['write', 'FakeResource'], 1]]
+        assert snapshot['cerberus_hierarchy_layers']['samples'][0][1][
+            'count'] == 2
+
+    def test_hierarchy_index(self):
+        """Test the in-process hierarchy gives the same layers."""
+        roles = [get_role_type_and_id(r)
+                 for r in self.users + self.groups + self.roles]
+        expected = {r: RoleHierarchy.all_conveyors(*r) for r in roles}
+        with override_settings(CERBERUS_HIERARCHY_CACHE=True):
+            assert {r: RoleHierarchy.all_conveyors(*r)
+                    for r in roles} == expected
+            with self.assertNumQueries(0):
+                RoleHierarchy.all_conveyors(*roles[0])
+            self.groups[0].take_role(self.roles[1])
+            assert RoleHierarchy.all_conveyors(*roles[0]) == [
+                [('FakeGroup', '1'), ('FakeGroup', '2'), ('security', '')],
+                [('audit', '15')]]
+
+    def test_hierarchy_layers_with_cycles(self):
+        """Test every backend gives the same layers with cycles."""
+        # a diamond (a > b > d, a > c > d, a > d) and cycles back to a and b
+        for heir, conveyor in ('ab', 'ac', 'ad', 'bd', 'cd', 'de', 'ea',
+                               'eb', 'ee'):
+            RoleHierarchy.objects.create(
+                role_type_a='node', role_id_a=heir,
+                role_type_b='node', role_id_b=conveyor)
+        expected = [[('node', 'b'), ('node', 'c'), ('node', 'd')],
+                    [('node', 'e')]]
+        fields = ('role_type_a', 'role_id_a'), ('role_type_b', 'role_id_b')
+        assert RoleHierarchy.recursive_layers(
+            connections['default'], 'node', 'a', *fields) == expected
+        assert RoleHierarchy.iterative_layers('node', 'a', *fields) == (
+            expected)
+        assert RoleHierarchyClosure.layers('node', 'a') == expected
+        with override_settings(CERBERUS_HIERARCHY_CACHE=True):
+            assert RoleHierarchy.all_conveyors('node', 'a') == expected
+        assert RoleHierarchy.recursive_layers(
+            connections['default'], 'node', 'e', *fields[::-1]) == [
+            [('node', 'd')], [('node', 'a'), ('node', 'b'), ('node', 'c')]]
+
+    def test_warmup(self):
+        """Test the warm-up command."""
+        for _ in range(3):
+            self.users[0].can('read', self.resources[1])
+        self.users[1].can('read', self.resources[0])
+        self.users[2].can('write', self.resources[0])
+        assert most_accessed(2, 1) == [
+            ('FakeUser', '1', 'read', 'FakeResource', '2'),
+            ('FakeUser', '2', 'read', 'FakeResource', '1')]
+
+        out = StringIO()
+        with override_settings(CERBERUS_HIERARCHY_CACHE=True):
+            call_command('cerberus_warmup', '--top', '2', stdout=out)
+        output = out.getvalue()
+        assert 'Compiled mapping: 4 types' in output
+        assert 'Loaded role hierarchy: 7 links' in output
+        assert 'decided 2 accesses of 2/2 roles' in output
+        assert 'Computed (SHARED_CACHE is not set) 2 decisions' in output
+
+    def test_bulk_set(self):
+        """Test allowing, denying and forgetting many privileges at once."""
+        existing = RolePrivilege.objects.count()
+        history = PrivilegeHistory.objects.count()
+        RolePrivilege.allow('role', '1', 'read', 'FakeResource', '1')
+        privileges = [('role', 1, 'read', 'FakeResource', i)
+                      for i in range(1, 51)]
+        # select, update, insert, select (no pks), history
+        with self.assertNumQueries(7):
+            counts = RolePrivilege.deny_many(privileges)
+        assert counts == {
+            'created': 49, 'updated': 1, 'unchanged': 0, 'deleted': 0}
+        assert RolePrivilege.objects.count() == existing + 50
+        assert not RolePrivilege.objects.filter(
+            role_type='role', authorized=True).exists()
+        assert PrivilegeHistory.objects.count() == history + 51
+
+        counts = RolePrivilege.objects.bulk_set(
+            [p + (False, ) for p in privileges[:10]] +
+            [p + (True, ) for p in privileges[10:20]] +
+            [p + (None, ) for p in privileges[20:]] +
+            [('role', 1, 'read', 'FakeResource', 99, None)],
+            batch_size=25)
+        assert counts == {
+            'created': 0, 'updated': 10, 'unchanged': 10, 'deleted': 30}
+        assert RolePrivilege.objects.count() == existing + 20
+        deleted = PrivilegeHistory.objects.filter(
+            role_type='role', action=PrivilegeHistory.DELETE)
+        assert deleted.count() == 30
+        assert not deleted.exclude(reference=None).exists()
+        assert not deleted.filter(privilege_id=None).exists()
+
+        assert RolePrivilege.authorize(
+            'role', '1', 'read', 'FakeResource', '15', log=False)
+        assert RolePrivilege.forget_many(
+            privileges[:20], log=False)['deleted'] == 20
+        assert not RolePrivilege.authorize(
+            'role', '1', 'read', 'FakeResource', '15', log=False)
+        assert not RolePrivilege.objects.filter(role_type='role').exists()
+        assert PrivilegeHistory.objects.count() == history + 51 + 40
+        assert RolePrivilege.allow_many([]) == {
+            'created': 0, 'updated': 0, 'unchanged': 0, 'deleted': 0}
+
+    def test_export_import(self):
+        """Test the export and import commands."""
+        out = StringIO()
+        call_command('cerberus_export', '--chunk-size', '2', stdout=out)
+        lines = out.getvalue().splitlines()
+        assert len(lines) == RolePrivilege.objects.count() + 7
+        records = [json.loads(line) for line in lines]
+        assert records[-1]['model'] == 'hierarchy'
+        privileges = [r for r in records if r['model'] == 'privilege']
+        privileges[0]['authorized'] = not privileges[0]['authorized']
+        privileges[1]['authorized'] = None
+        records.append({'role_type_a': 'FakeUser', 'role_id_a': '3',
+                        'role_type_b': 'FakeGroup', 'role_id_b': '1'})
+        records.append({'model': 'hierarchy', 'role_type_a': 'FakeUser',
+                        'role_id_a': '1', 'role_type_b': 'FakeGroup',
+                        'role_id_b': '1', 'forget': True})
+        records.append(dict(privileges[2], resource_id='new'))
+
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl') as stream:
+            stream.write('\n'.join(json.dumps(r) for r in records))
+            stream.flush()
+            out = StringIO()
+            count = RolePrivilege.objects.count()
+            call_command('cerberus_import', stream.name, '--dry-run',
+                         verbosity=2, stdout=out)
+            assert RolePrivilege.objects.count() == count
+            output = out.getvalue()
+            assert '+ FakeUser 3 is part of FakeGroup 1' in output
+            assert '- FakeUser 1 is part of FakeGroup 1' in output
+            assert ('Would change privileges: 1 created, 1 updated, '
+                    '%d unchanged, 1 deleted.' % (count - 2)) in output
+
+            history = PrivilegeHistory.objects.count()
+            out = StringIO()
+            call_command('cerberus_import', stream.name, '--batch-size', '3',
+                         stdout=out)
+            assert 'Changed hierarchy links: 1 created, 7 unchanged, ' \
+                '1 deleted.' in out.getvalue()
+        assert RolePrivilege.objects.count() == count
+        assert PrivilegeHistory.objects.count() == history + 3
+        assert RoleHierarchy.objects.filter(role_id_a='3').exists()
+        assert not RoleHierarchy.objects.filter(
+            role_type_a='FakeUser', role_id_a='1', role_id_b='1').exists()
+
+        out = StringIO()
+        call_command('cerberus_export', '--format', 'csv', '--model',
+                     'privilege', stdout=out)
+        rows = out.getvalue().splitlines()
+        assert rows[0].startswith('model,role_type,role_id,')
+        assert len(rows) == count + 1
+        with tempfile.NamedTemporaryFile('w', suffix='.csv') as stream:
+            stream.write(out.getvalue().replace(',True,', ',maybe,', 1))
+            stream.flush()
+            with pytest.raises(CommandError) as error:
+                call_command('cerberus_import', stream.name, '--format',
+                             'csv', stdout=StringIO())
+            assert 'invalid boolean' in str(error.value)
+
+        assert parse_record({
+            'role_type': 'FakeUser', 'access_type': 'read', 'authorized': 1,
+            'resource_type': 'FakeResource', 'resource_id': 0})[1][4] == '0'
+
+        def failing_records():
+            yield parse_record({
+                'role_type_a': 'FakeUser', 'role_id_a': '3',
+                'role_type_b': 'FakeGroup', 'role_id_b': '2'})
+            raise ValueError('line 2: invalid record')
+
+        RoleHierarchyClosure.rebuild()
+        with pytest.raises(ValueError):
+            import_records(failing_records(), batch_size=1)
+        assert RoleHierarchyClosure.objects.filter(
+            descendant_type='FakeUser', descendant_id='3',
+            ancestor_type='FakeGroup', ancestor_id='2').exists()
+
+    @override_settings(CERBERUS_TYPE_PRIVILEGES=True)
+    def test_type_privileges(self):
+        """Test type-level privileges, given with an empty resource ID."""
+        user = self.users[0]
+        perm = 'inspect'
+        RolePrivilege.allow('FakeGroup', '1', perm, 'FakeResource')
+        RolePrivilege.deny('FakeGroup', '2', perm, 'FakeResource', '2')
+        RolePrivilege.deny('audit', '15', perm, 'FakeResource', '1')
+
+        def expected():
+            return [r for r in self.resources
+                    if user.can(perm, r, skip_implicit=True, log=False)]
+
+        accessible = expected()
+        assert accessible == [self.resources[0], self.resources[2]]
+        with self.assertNumQueries(2):
+            assert user.can_many([(perm, r) for r in self.resources],
+                                 skip_implicit=True, log=False) == {
+                (perm, r): r in accessible for r in self.resources}
+        queryset = user.accessible(
+            FakeResource.objects.order_by('id'), perm=perm)
+        assert list(queryset) == expected()
+        with override_settings(CERBERUS_TYPE_PRIVILEGES=False):
+            assert not user.can(perm, self.resources[0], log=False)
+            assert not user.accessible('FakeResource', perm).exists()
+
+        # a type-level allow of the role itself only excludes its denials
+        RolePrivilege.allow('FakeUser', '1', perm, 'FakeResource')
+        RolePrivilege.deny('FakeUser', '1', perm, 'FakeResource', '3')
+        queryset = user.accessible(
+            FakeResource.objects.order_by('id'), perm=perm)
+        assert [a for a in queryset.query.annotations
+                if a.startswith(('cerberus_allow', 'cerberus_deny'))] == [
+            'cerberus_deny_0']
+        assert list(queryset) == expected() == self.resources[:2]
+        assert RolePrivilege.authorize_explicit(
+            'FakeUser', '1', perm, 'FakeResource', '2')
+        assert not RolePrivilege.authorize_explicit(
+            'FakeUser', '1', perm, 'FakeResource', '3')
+
+    @override_settings(CERBERUS_TYPE_PRIVILEGES=True,
+                       CERBERUS_RANGE_PRIVILEGES=True)
+    def test_type_privileges_mixed_layer(self):
+        """Test accessible agrees with authorize in mixed layers."""
+        user = self.users[0]
+        perm = 'inspect'
+        resources = self.resources + [
+            FakeResource.objects.create() for _ in range(6)]
+        # an object-level denial wins over a sibling's object-level allow,
+        # even with a type-level denial in the same layer
+        RolePrivilege.deny('FakeGroup', '1', perm, 'FakeResource', '9')
+        RolePrivilege.deny('FakeGroup', '1', perm, 'FakeResource')
+        RolePrivilege.allow('FakeGroup', '2', perm, 'FakeResource', '9')
+        RolePrivilege.allow('security', '', perm, 'FakeResource', '8')
+        assert not user.can(perm, resources[8], log=False)
+        assert list(user.accessible(
+            FakeResource.objects.order_by('id'), perm)) == [resources[7]]
+
+        roles = [('FakeUser', '1'), ('FakeGroup', '1'), ('FakeGroup', '2'),
+                 ('security', ''), ('audit', '15')]
+        generator = random.Random(0)
+        for _ in range(25):
+            RolePrivilege.objects.filter(access_type=perm).delete()
+            RolePrivilegeRange.objects.all().delete()
+            for role in roles:
+                for resource_id in [''] + [str(r.pk) for r in resources]:
+                    authorized = generator.choice((None, None, True, False))
+                    if authorized is not None:
+                        RolePrivilege.objects.create(
+                            role_type=role[0], role_id=role[1],
+                            access_type=perm, resource_type='FakeResource',
+                            resource_id=resource_id, authorized=authorized)
+                start = generator.randint(1, 9)
+                RolePrivilegeRange.objects.create(
+                    role_type=role[0], role_id=role[1], access_type=perm,
+                    resource_type='FakeResource', start=start,
+                    end=generator.randint(start, 9),
+                    authorized=generator.choice((True, False)))
+            assert list(user.accessible(
+                FakeResource.objects.order_by('id'), perm)) == [
+                r for r in resources
+                if user.can(perm, r, skip_implicit=True, log=False)]
+
+    @override_settings(CERBERUS_RANGE_PRIVILEGES=True)
+    def test_privilege_ranges(self):
+        """Test range privileges and their coalescing."""
+        user = self.users[0]
+        perm = 'inspect'
+        resources = self.resources + [
+            FakeResource.objects.create() for _ in range(7)]
+        RolePrivilegeRange.objects.create(
+            role_type='FakeGroup', role_id='1', access_type=perm,
+            resource_type='FakeResource', start=2, end=8, authorized=True)
+        RolePrivilegeRange.objects.create(
+            role_type='FakeGroup', role_id='2', access_type=perm,
+            resource_type='FakeResource', start=5, end=5, authorized=False)
+        RolePrivilege.deny('FakeUser', '1', perm, 'FakeResource', '3')
+
+        checks = [(perm, r) for r in resources]
+        with self.assertNumQueries(3):
+            decisions = user.can_many(checks, skip_implicit=True, log=False)
+        accessible = [r for r in resources if decisions[(perm, r)]]
+        assert [r.pk for r in accessible] == [2, 4, 6, 7, 8]
+        assert list(user.accessible(
+            FakeResource.objects.order_by('id'), perm)) == accessible
+        with override_settings(CERBERUS_RANGE_PRIVILEGES=False):
+            assert not user.can(perm, resources[1], log=False)
+            assert not user.accessible('FakeResource', perm).exists()
+
+        for resource_id in ('1', '2', '3', '4', '5', '7', '9', '10', '007'):
+            RolePrivilege.allow('role', '1', perm, 'FakeResource',
+                                resource_id, log=False)
+        before = RolePrivilege.authorize_bulk(
+            'role', '1', [(perm, 'FakeResource', str(i))
+                          for i in range(12)], skip_implicit=True, log=False)
+        out = StringIO()
+        call_command('cerberus_import', '--coalesce', '2', stdout=out)
+        assert 'Coalesced 7 privileges into 2 ranges.' in out.getvalue()
+        assert set(RolePrivilegeRange.objects.filter(
+            role_type='role').values_list('start', 'end')) == {(1, 5), (9, 10)}
+        assert set(RolePrivilege.objects.filter(
+            role_type='role').values_list('resource_id', flat=True)) == {
+            '7', '007'}
+        assert RolePrivilege.authorize_bulk(
+            'role', '1', list(before), skip_implicit=True, log=False
+        ) == before
+
+        out = StringIO()
+        call_command('cerberus_export', '--model', 'range', stdout=out)
+        records = [json.loads(line) for line in out.getvalue().splitlines()]
+        assert len(records) == 4
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl') as stream:
+            stream.write(json.dumps(dict(records[-1], authorized=None)))
+            stream.flush()
+            out = StringIO()
+            call_command('cerberus_import', stream.name, stdout=out)
+        assert 'Changed privilege ranges: 0 created, 0 updated, ' \
+            '0 unchanged, 1 deleted.' in out.getvalue()
+        assert RolePrivilegeRange.objects.count() == 3
+
+    @override_settings(CERBERUS_RANGE_PRIVILEGES=True)
+    def test_privilege_range_splitting(self):
+        """Test single privileges can be changed after coalescing."""
+        from cerberus_ac.views import ajax_load_privileges
+        perm = 'inspect'
+        resources = self.resources + [
+            FakeResource.objects.create() for _ in range(3)]
+        checks = [(perm, 'FakeResource', str(r.pk)) for r in resources]
+        RolePrivilege.allow_many(('role', '1') + c for c in checks)
+        assert RolePrivilegeRange.coalesce() == (1, 6)
+        assert PrivilegeHistory.objects.filter(
+            role_type='role', action=PrivilegeHistory.CREATE,
+            resource_id='1-6').exists()
+
+        def ranges():
+            return sorted(RolePrivilegeRange.objects.values_list(
+                'start', 'end'))
+
+        def allowed():
+            decisions = RolePrivilege.authorize_bulk(
+                'role', '1', checks, skip_implicit=True, log=False)
+            return [r.pk for r, c in zip(resources, checks) if decisions[c]]
+
+        assert allowed() == [1, 2, 3, 4, 5, 6]
+        assert RolePrivilege.forget('role', '1', perm, 'FakeResource', '3')
+        assert ranges() == [(1, 2), (4, 6)]
+        assert allowed() == [1, 2, 4, 5, 6]
+        record = PrivilegeHistory.objects.latest('id')
+        assert (record.action, record.resource_id, record.authorized) == (
+            PrivilegeHistory.DELETE, '3', True)
+        assert not RolePrivilege.forget(
+            'role', '1', perm, 'FakeResource', '3')
+
+        RolePrivilege.deny('role', '1', perm, 'FakeResource', '5')
+        assert ranges() == [(1, 2), (4, 4), (6, 6)]
+        assert allowed() == [1, 2, 4, 6]
+        assert RolePrivilege.forget_many([
+            ('role', '1', perm, 'FakeResource', '1'),
+            ('role', '1', perm, 'FakeResource', '5')])['deleted'] == 2
+        assert ranges() == [(2, 2), (4, 4), (6, 6)]
+        assert allowed() == [2, 4, 6]
+
+        request = RequestFactory().get(
+            '/', HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        rows = json.loads(ajax_load_privileges(
+            request, 'role', '1', 'FakeResource').content.decode('utf-8'))
+        assert [row[perm] for row in rows] == [
+            None, True, None, True, None, True]
+
+        with override_settings(CERBERUS_RANGE_PRIVILEGES=False):
+            with pytest.raises(ImproperlyConfigured):
+                RolePrivilegeRange.coalesce()
+            with pytest.raises(CommandError):
+                call_command('cerberus_import', '--coalesce', '2')
+        assert RolePrivilegeRange.objects.count() == 3
+        assert integer_id('\u00b2') is None
+
+    def test_explicit_resolution(self):
+        """Test explicit privileges of conveyors are resolved at once."""
+        RolePrivilege.allow('FakeGroup', '1', 'write', 'FakeResource', '1')
+        RolePrivilege.deny('FakeGroup', '2', 'write', 'FakeResource', '1')
+        RolePrivilege.allow('security', '', 'write', 'FakeResource', '1')
+        with self.assertNumQueries(2):
+            assert not self.users[0].can(
+                'write', self.resources[0], skip_implicit=True, log=False)
+        assert not self.users[0].can('write', self.resources[0])
+        attempt = AccessHistory.objects.latest('id')
+        assert attempt.response_type == AccessHistory.EXPLICIT
+        assert (attempt.conveyor_type, attempt.conveyor_id) == (
+            'FakeGroup', '2')
+        RolePrivilege.forget('FakeGroup', '2', 'write', 'FakeResource', '1')
+        assert self.users[0].can('write', self.resources[0])
+        attempt = AccessHistory.objects.latest('id')
+        assert (attempt.conveyor_type, attempt.conveyor_id) == (
+            'FakeGroup', '1')
+
+    def test_bulk_authorization(self):
+        """Test checking several privileges at once."""
+        checks = [('do stuff on', r) for r in self.resources]
+        checks.append(('update', 'FakeResource', '3'))
+        with self.assertNumQueries(3):
+            decisions = self.users[2].can_many(checks, skip_implicit=True)
+        assert decisions == {
+            checks[0]: False, checks[1]: False, checks[2]: True,
+            checks[3]: True}
+        assert AccessHistory.objects.filter(
+            role_type='FakeUser', role_id='3').count() == 4
+        assert AccessHistory.objects.get(
+            role_type='FakeUser', role_id='3', access_type='update'
+        ).conveyor_type == 'data'
+        assert RolePrivilege.authorize_bulk(
+            'FakeUser', '3', [('read', 'FakeResource', '3')], log=False
+        ) == {('read', 'FakeResource', '3'): True}
+
+    def test_buffered_access_log(self):
+        """Test buffering of access attempts."""
+        count = AccessHistory.objects.count()
+        sink = BufferedAccessLogSink(
+            batch_size=3, flush_interval=0, max_size=4,
+            overflow=BufferedAccessLogSink.DROP_OLDEST)
+        sink.record([AccessHistory(access_type='read') for _ in range(2)])
+        assert AccessHistory.objects.count() == count
+        sink.record([AccessHistory(access_type='read')])
+        assert AccessHistory.objects.count() == count + 3
+        sink.batch_size = 10
+        sink.record([AccessHistory(access_type='read') for _ in range(6)])
+        assert sink.stats()['dropped'] == 2
+        sink.flush()
+        assert AccessHistory.objects.count() == count + 7
+        sink.overflow = BufferedAccessLogSink.BLOCK
+        sink.record([AccessHistory(access_type='read') for _ in range(6)])
+        assert AccessHistory.objects.count() == count + 11
+        assert sink.stats() == {
+            'buffered': 2, 'recorded': 15, 'written': 11, 'dropped': 2,
+            'failed': 0}
+        sink.flush()
+        assert AccessHistory.objects.count() == count + 13
+
+    @override_settings(CERBERUS_ACCESS_LOG_ROLLUP=True)
+    def test_access_rollups(self):
+        """Test access attempts are counted in rollups."""
+        count = AccessHistory.objects.count()
+        for _ in range(3):
+            assert self.users[0].can('do stuff on', self.resources[0])
+            assert not self.users[0].can('do stuff on', self.resources[1])
+        assert AccessHistory.objects.count() == count + 3
+        assert AccessRollup.objects.get(
+            role_type='FakeUser', role_id='1', resource_id='1',
+            response=True).count == 3
+        assert AccessRollup.objects.get(
+            role_type='FakeUser', role_id='1', resource_id='2',
+            response=False).count == 3
+        with self.settings(CERBERUS_ACCESS_LOG_SAMPLE_RATE=1.0):
+            assert self.users[0].can('do stuff on', self.resources[0])
+        assert AccessHistory.objects.count() == count + 4
+
+    def test_access_rollups_batch(self):
+        """Test a batch of attempts is counted with a bounded query count."""
+        now = timezone.now()
+
+        def attempts(*resource_ids):
+            return [AccessHistory(
+                role_type='FakeUser', role_id='1', response=True,
+                response_type=AccessHistory.EXPLICIT, access_type='read',
+                resource_type='FakeResource', resource_id=str(i),
+                datetime=now) for i in resource_ids]
+
+        # one select, one insert, and the savepoints
+        with self.assertNumQueries(6):
+            AccessRollup.record(attempts(1, 1, 2, 3), interval=3600)
+        # one select, one update per distinct increment, one insert
+        with self.assertNumQueries(8):
+            AccessRollup.record(
+                attempts(1, 2, 2, 3, 3, 4, 5, 5), interval=3600)
+        assert dict(AccessRollup.objects.filter(
+            access_type='read').values_list('resource_id', 'count')) == {
+            '1': 3, '2': 3, '3': 3, '4': 1, '5': 2}
+        # rollups created concurrently are incremented instead
+        rollups = [AccessRollup(count=2, bucket=AccessRollup.get_bucket(
+            now, 3600), **{f: getattr(attempt, f)
+                           for f in AccessRollup.KEY_FIELDS[1:]})
+            for attempt in attempts(5, 6)]
+        AccessRollup.create_many(rollups)
+        assert dict(AccessRollup.objects.filter(
+            access_type='read').values_list('resource_id', 'count')) == {
+            '1': 3, '2': 3, '3': 3, '4': 1, '5': 4, '6': 2}
+
     def test_role_privileges_history(self):
         """Test role privileges history."""
         for i in (1, 2, 3):
@@ -194,6 +1306,7 @@ class MainTestCase(TestCase):
             RolePrivilege.objects.all(),
             RoleHierarchy.objects.all(),
             AccessHistory.objects.all(),
+            AccessRollup.objects.all(),
             PrivilegeHistory.objects.all(),
             # HierarchyHistory.objects.all()[0],
         ]: